@@ -1,11 +1,19 @@
-import os, re, io, uuid, zipfile, subprocess, json
+import os, re, uuid, zipfile, subprocess, json, hashlib, shutil, threading, time, asyncio, struct, bisect
+import xml.etree.ElementTree as ET
 from functools import lru_cache
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from array import array
+from contextlib import asynccontextmanager, contextmanager
 from pathlib import Path
+from urllib.parse import quote
 import math
+import httpx
 import requests
+from requests.adapters import HTTPAdapter
 from fastapi import FastAPI, HTTPException, UploadFile, File, Body
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse, JSONResponse, RedirectResponse
+from fastapi.responses import FileResponse, JSONResponse, RedirectResponse, Response
 from starlette.staticfiles import StaticFiles
 
 import subprocess, unicodedata
@@ -16,16 +24,64 @@ def slugify_filename(name: str) -> str:
     name = re.sub(r"[^\w.\-]+", "_", name).strip("._")
     return name or "file"
 
-def is_valid_stl(p: Path) -> bool:
+try:  # NumPy è opzionale: senza, le mesh si leggono in Python puro (più lento)
+    import numpy as _np
+except ImportError:
+    _np = None
+
+# record di uno STL binario: normale, 3 vertici, attributo (50 byte, non allineati)
+_STL_RECORD_DTYPE = None if _np is None else _np.dtype([("n", "<f4", (3,)), ("v", "<f4", (9,)), ("a", "<u2")])
+_STL_ASCII_PROBE = 1 << 16
+
+
+def _stl_layout(p: Path):
+    """Riconosce uno STL: ``("binary", triangoli)``, ``("ascii", None)`` o ``None``.
+
+    Il binario è valido se il numero di triangoli dell'header è coerente con
+    la dimensione del file (sono tollerati byte in coda, non un file troncato).
+    """
     try:
-        return p.exists() and p.stat().st_size >= 84
-    except Exception:
-        return False
+        size = p.stat().st_size
+        with open(p, "rb") as f:
+            head = f.read(_STL_ASCII_PROBE)
+    except OSError:
+        return None
+    if len(head) < 84:
+        return None
+    count = int.from_bytes(head[80:84], "little")
+    if count and size == 84 + count * 50:
+        return "binary", count
+    text = head.lstrip()
+    if text[:5].lower() == b"solid" and b"facet" in text and b"vertex" in text:
+        return "ascii", None
+    if count and size > 84 + count * 50:
+        return "binary", count
+    return None
+
+
+def is_valid_stl(p: Path) -> bool:
+    return _stl_layout(p) is not None
+
+
+def _stl_records(p: Path):
+    """Triangoli di uno STL binario come vista strutturata NumPy su ``mmap``.
 
-def prusa_export_stl(in_path: Path, export_dir: Path) -> Path:
+    Nessuna copia: le pagine vengono lette dal kernel quando servono, quindi
+    anche mesh da diversi GB non occupano RAM. ``None`` se il file non è uno
+    STL binario valido o se NumPy non è installato.
+    """
+    layout = _stl_layout(p)
+    if _np is None or layout is None or layout[0] != "binary":
+        return None
+    return _np.memmap(p, dtype=_STL_RECORD_DTYPE, mode="r", offset=84, shape=(layout[1],))
+
+def prusa_export_stl(in_path: Path, export_dir: Path, timeout: float | None = None) -> Path:
     export_dir.mkdir(parents=True, exist_ok=True)
     cmd = ["prusaslicer", "--export-stl", "--output", str(export_dir), str(in_path)]
-    cp = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    try:
+        cp = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, timeout=timeout)
+    except subprocess.TimeoutExpired:
+        raise HTTPException(status_code=504, detail="Conversione modello→STL troppo lunga (PrusaSlicer)")
     if cp.returncode != 0:
         print("[PrusaSlicer] ERRORE:\n", cp.stdout)
         raise HTTPException(status_code=400, detail="Conversione 3MF→STL fallita (PrusaSlicer)")
@@ -34,14 +90,29 @@ def prusa_export_stl(in_path: Path, export_dir: Path) -> Path:
         raise HTTPException(status_code=400, detail="Nessuno STL prodotto da PrusaSlicer")
     best = stls[0]
     if not is_valid_stl(best):
-        raise HTTPException(status_code=400, detail="STL troppo corto prodotto da PrusaSlicer")
+        raise HTTPException(status_code=400, detail="STL non valido prodotto da PrusaSlicer")
     return best
 
-app = FastAPI(title="Spoolsite API")
+@asynccontextmanager
+async def _lifespan(app):
+    _http_session()
+    # sonda Spoolman una volta all'avvio, in background: la prima richiesta trova già l'endpoint
+    threading.Thread(target=_warm_spoolman_discovery, name="spoolman-discovery", daemon=True).start()
+    _start_upload_janitor()
+    yield
+    _UPLOAD_GC_STOP.set()
+    _CONVERT_POOL.shutdown(wait=False, cancel_futures=True)
+    _SLICE_BATCH_POOL.shutdown(wait=False, cancel_futures=True)
+    _close_http_session()
+    await _close_http_async_client()
+
+
+app = FastAPI(title="Spoolsite API", lifespan=_lifespan)
 
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"], allow_credentials=True, allow_methods=["*"], allow_headers=["*"]
+    allow_origins=["*"], allow_credentials=True, allow_methods=["*"], allow_headers=["*"],
+    expose_headers=["X-Toolpath-Offset", "X-Toolpath-Count", "X-Toolpath-Next-Offset"]
 )
 
 # ---- Config ----
@@ -116,53 +187,201 @@ def _tail_lines(text, limit: int = 20) -> list[str]:
     return lines
 
 
-def _spoolman_urls(paths: list[str]) -> list[str]:
-    urls: list[str] = []
-    for base in SPOOLMAN_BASES:
-        for path in paths:
-            if not path:
-                continue
-            p = path if path.startswith("/") else f"/{path}"
-            urls.append(f"{base}{p}")
-    return urls
+# ---- Client HTTP condiviso ----
+# Una Session requests per tutta la vita dell'app (creata nel lifespan): le
+# connessioni verso Spoolman e verso i siti dei modelli restano in keep-alive
+# invece di rifare TCP/TLS a ogni chiamata. requests non parla HTTP/2.
+HTTP_POOL_CONNECTIONS = int(os.getenv("HTTP_POOL_CONNECTIONS", "10"))
+HTTP_POOL_MAXSIZE = int(os.getenv("HTTP_POOL_MAXSIZE", "20"))
+_HTTP_SESSION = None
+_HTTP_SESSION_LOCK = threading.Lock()
 
 
-def _get(paths, params=None):
-    if isinstance(paths, str):
-        path_list = [paths]
-    else:
-        path_list = list(paths)
+def _new_http_session():
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=HTTP_POOL_CONNECTIONS, pool_maxsize=HTTP_POOL_MAXSIZE)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def _http_session():
+    global _HTTP_SESSION
+    if _HTTP_SESSION is None:
+        # fuori dal lifespan (script, import diretto) la sessione nasce al primo uso
+        with _HTTP_SESSION_LOCK:
+            if _HTTP_SESSION is None:
+                _HTTP_SESSION = _new_http_session()
+    return _HTTP_SESSION
+
+
+def _close_http_session():
+    global _HTTP_SESSION
+    with _HTTP_SESSION_LOCK:
+        session, _HTTP_SESSION = _HTTP_SESSION, None
+    if session is not None:
+        session.close()
+
 
-    attempted: list[str] = []
-    last_err: str | None = None
+# Per i download asincroni (/fetch_model) un httpx.AsyncClient, anch'esso
+# condiviso e chiuso nel lifespan.
+_HTTP_ASYNC_CLIENT = None
+
+
+def _http_async_client():
+    global _HTTP_ASYNC_CLIENT
+    if _HTTP_ASYNC_CLIENT is None or _HTTP_ASYNC_CLIENT.is_closed:
+        _HTTP_ASYNC_CLIENT = httpx.AsyncClient(
+            follow_redirects=True,
+            limits=httpx.Limits(max_connections=HTTP_POOL_MAXSIZE, max_keepalive_connections=HTTP_POOL_CONNECTIONS),
+        )
+    return _HTTP_ASYNC_CLIENT
+
+
+async def _close_http_async_client():
+    global _HTTP_ASYNC_CLIENT
+    client, _HTTP_ASYNC_CLIENT = _HTTP_ASYNC_CLIENT, None
+    if client is not None:
+        await client.aclose()
+
+
+# ---- Discovery endpoint Spoolman ----
+# Le combinazioni base x path non vengono più provate in sequenza a ogni
+# chiamata: la base che ha risposto viene memorizzata una volta per tutti i
+# path (per le liste fisse anche il path vincente) e si torna a sondare solo
+# quando smette di funzionare. Le basi vengono sondate in
+# parallelo (vince la prima che risponde) e una base che fallisce più volte di
+# fila viene saltata per SPOOLMAN_BREAKER_COOLDOWN_S (circuit breaker).
+SPOOLMAN_TIMEOUT_S = float(os.getenv("SPOOLMAN_TIMEOUT_S", "12"))
+SPOOLMAN_PROBE_TIMEOUT_S = float(os.getenv("SPOOLMAN_PROBE_TIMEOUT_S", "3"))
+SPOOLMAN_BREAKER_FAILURES = int(os.getenv("SPOOLMAN_BREAKER_FAILURES", "3"))
+SPOOLMAN_BREAKER_COOLDOWN_S = float(os.getenv("SPOOLMAN_BREAKER_COOLDOWN_S", "60"))
+_SPOOLMAN_SPOOL_PATHS = [
+    "/api/v1/spool",
+    "/api/v1/spool/",
+    "/api/v1/spools",
+    "/api/spool",
+    "/api/spools",
+]
+_SPOOLMAN_LOCK = threading.Lock()
+_SPOOLMAN_BASE = None    # base che ha risposto per ultima, valida per tutti i path
+_SPOOLMAN_ROUTES = {}    # tuple(paths) di una lista fissa -> path che ha risposto
+_SPOOLMAN_BREAKERS = {}  # base -> {"failures": n, "open_until": monotonic}
+
+
+def _spoolman_headers():
     headers = {}
     if SPOOLMAN_TOKEN:
         headers["Authorization"] = f"Bearer {SPOOLMAN_TOKEN}"
+    return headers
+
+
+def _spoolman_join(base, path):
+    return f"{base}{path if path.startswith('/') else '/' + path}"
+
+
+def _breaker_is_open(base):
+    with _SPOOLMAN_LOCK:
+        state = _SPOOLMAN_BREAKERS.get(base)
+        return bool(state and state["open_until"] > time.monotonic())
+
 
-    for url in _spoolman_urls(path_list):
-        attempted.append(url)
+def _breaker_record(base, ok):
+    with _SPOOLMAN_LOCK:
+        if ok:
+            _SPOOLMAN_BREAKERS.pop(base, None)
+            return
+        state = _SPOOLMAN_BREAKERS.setdefault(base, {"failures": 0, "open_until": 0.0})
+        state["failures"] += 1
+        if state["failures"] >= SPOOLMAN_BREAKER_FAILURES:
+            state["open_until"] = time.monotonic() + SPOOLMAN_BREAKER_COOLDOWN_S
+
+
+def _probe_base(base, path_list, params, timeout):
+    """Prova i path su una base; si ferma al primo errore di connessione."""
+    headers = _spoolman_headers()
+    last_err = None
+    for path in path_list:
+        if not path:
+            continue
+        url = _spoolman_join(base, path)
         try:
-            r = requests.get(
-                url,
-                params=params,
-                timeout=12,
-                headers=headers,
-                verify=SPOOLMAN_VERIFY_TLS,
-            )
+            r = _http_session().get(url, params=params, timeout=timeout, headers=headers, verify=SPOOLMAN_VERIFY_TLS)
             if r.status_code == 404:
                 last_err = f"404 {url}"
                 continue
             r.raise_for_status()
-            return r.json()
-        except requests.RequestException as e:
+            data = r.json()
+        except (requests.ConnectionError, requests.Timeout) as e:
+            # host giù: inutile provare gli altri path sulla stessa base
+            _breaker_record(base, False)
+            return None, None, f"{type(e).__name__}: {e}"
+        except (requests.RequestException, ValueError) as e:
             last_err = f"{type(e).__name__}: {e}"
             continue
+        _breaker_record(base, True)
+        return path, data, None
+    return None, None, last_err
 
-    detail = f"Spoolman non raggiungibile. Tentativi: {attempted}"
-    if last_err:
-        detail += f"  Errore: {last_err}"
+
+def _discover_spoolman(path_list, params, timeout, remember_path=True):
+    global _SPOOLMAN_BASE
+    bases = [b for b in SPOOLMAN_BASES if not _breaker_is_open(b)] or list(SPOOLMAN_BASES)
+    errors = []
+    pool = ThreadPoolExecutor(max_workers=len(bases), thread_name_prefix="spoolman-probe")
+    try:
+        futures = {pool.submit(_probe_base, b, path_list, params, timeout): b for b in bases}
+        for fut in as_completed(futures):
+            base = futures[fut]
+            path, data, err = fut.result()
+            if path is not None:
+                with _SPOOLMAN_LOCK:
+                    _SPOOLMAN_BASE = base
+                    if remember_path:
+                        _SPOOLMAN_ROUTES[tuple(path_list)] = path
+                return data
+            errors.append(f"{base}: {err}")
+    finally:
+        # le sonde più lente finiscono da sole, senza bloccare la risposta
+        pool.shutdown(wait=False)
+    detail = f"Spoolman non raggiungibile. Tentativi: {bases} x {path_list}"
+    if errors:
+        detail += f"  Errore: {'; '.join(errors)}"
     raise HTTPException(status_code=502, detail=detail)
 
+
+def _get(paths, params=None, remember_path=True):
+    """GET su Spoolman. ``remember_path=False`` per i path che cambiano a ogni
+    chiamata (lookup per id): si riusa la base ma non si memorizza il path."""
+    if isinstance(paths, str):
+        path_list = [paths]
+    else:
+        path_list = list(paths)
+    key = tuple(path_list)
+
+    with _SPOOLMAN_LOCK:
+        base = _SPOOLMAN_BASE
+        known = _SPOOLMAN_ROUTES.get(key) if remember_path else None
+    if base is not None:
+        path, data, _ = _probe_base(base, [known] if known else path_list, params, SPOOLMAN_TIMEOUT_S)
+        if path is not None:
+            if remember_path and known is None:
+                with _SPOOLMAN_LOCK:
+                    _SPOOLMAN_ROUTES[key] = path
+            return data
+        # la base (o il path) memorizzati non rispondono più: si torna a sondare
+        if known is not None:
+            with _SPOOLMAN_LOCK:
+                _SPOOLMAN_ROUTES.pop(key, None)
+    return _discover_spoolman(path_list, params, SPOOLMAN_TIMEOUT_S, remember_path)
+
+
+def _warm_spoolman_discovery():
+    try:
+        _discover_spoolman(_SPOOLMAN_SPOOL_PATHS, {"limit": 1}, SPOOLMAN_PROBE_TIMEOUT_S)
+    except HTTPException as e:
+        print(f"[spoolman] nessun endpoint raggiungibile all'avvio: {e.detail}")
+
 def _ensure_color_hex(v):
     if not v:
         return None
@@ -274,13 +493,60 @@ def _detect_transparent(spool: dict, filament: dict):
     ])
     return bool(TRANSPARENT_PAT.search(txt))
 
-def _extract_filament_from_spool(spool):
+FILAMENT_PAGE_SIZE = 1000
+# tetto alle pagine lette: un server che ignora offset non fa girare il ciclo all'infinito
+FILAMENT_MAX_PAGES = 50
+
+
+def _fetch_filament_index(spool_list):
+    """Indice id -> filamento per le bobine che riportano solo ``filament_id``.
+
+    Una sola lista paginata di ``/api/v1/filament`` al posto di una richiesta per
+    bobina; se Spoolman non espone la lista si torna al lookup per id.
+    """
+    wanted = set()
+    for s in spool_list:
+        f = s.get("filament")
+        if isinstance(f, dict) and f:
+            continue
+        fid = _first(s, ["filament_id", "filamentId"])
+        if fid:
+            wanted.add(str(fid))
+    if not wanted:
+        return {}
+
+    index = {}
+    offset = 0
+    try:
+        for _ in range(FILAMENT_MAX_PAGES):
+            page = _get(
+                ["/api/v1/filament", "/api/v1/filaments", "/api/filament", "/api/filaments"],
+                params={"limit": FILAMENT_PAGE_SIZE, "offset": offset},
+            )
+            if isinstance(page, dict):
+                page = page.get("results") or page.get("filaments") or []
+            known = len(index)
+            for f in page or []:
+                if isinstance(f, dict) and f.get("id") is not None:
+                    index[str(f["id"])] = f
+            # pagina corta, tutti gli id trovati o nessun id nuovo (offset ignorato)
+            if len(page or []) < FILAMENT_PAGE_SIZE or wanted.issubset(index) or len(index) == known:
+                break
+            offset += FILAMENT_PAGE_SIZE
+    except HTTPException as e:
+        print(f"[inventory] lista filamenti non disponibile, lookup per id: {e.detail}")
+    return index
+
+
+def _extract_filament_from_spool(spool, filaments=None):
     f = spool.get("filament")
     if isinstance(f, dict) and f:
         return f
     fid = _first(spool, ["filament_id", "filamentId"])
     if fid:
-        return _get([
+        if filaments is not None and str(fid) in filaments:
+            return filaments[str(fid)]
+        found = _get([
             f"/api/v1/filament/{fid}",
             f"/api/v1/filament/{fid}/",
             f"/api/v1/filaments/{fid}",
@@ -289,7 +555,10 @@ def _extract_filament_from_spool(spool):
             f"/api/filament/{fid}/",
             f"/api/filaments/{fid}",
             f"/api/filaments/{fid}/",
-        ])
+        ], remember_path=False)
+        if filaments is not None:
+            filaments[str(fid)] = found
+        return found
     legacy = {}
     for k in ("filament_name", "name", "product"):
         if spool.get(k): legacy["name"] = spool[k]; break
@@ -306,25 +575,17 @@ def _extract_filament_from_spool(spool):
     return legacy if legacy else {}
 
 # ---- Builder inventario (riusato da /inventory e /slice/estimate) ----
-def _build_inventory_items():
-    sp = _get(
-        [
-            "/api/v1/spool",
-            "/api/v1/spool/",
-            "/api/v1/spools",
-            "/api/spool",
-            "/api/spools",
-        ],
-        params={"allow_archived": False, "limit": 1000},
-    )
+def _fetch_spool_list():
+    sp = _get(_SPOOLMAN_SPOOL_PATHS, params={"allow_archived": False, "limit": 1000})
     if isinstance(sp, dict):
-        spool_list = sp.get("results") or sp.get("spools") or []
-    else:
-        spool_list = sp
+        return sp.get("results") or sp.get("spools") or []
+    return sp or []
+
 
+def _items_from_spools(spool_list, filaments=None):
     buckets = {}
     for s in spool_list:
-        f = _extract_filament_from_spool(s)
+        f = _extract_filament_from_spool(s, filaments)
         color_hex = _ensure_color_hex(_raw_color_hex(s, f)) or "#777777"
         material = f.get("material") or "N/A"
         diameter = str(f.get("diameter") or "")
@@ -356,6 +617,95 @@ def _build_inventory_items():
         })
     return items
 
+# ---- Cache inventario Spoolman ----
+# Snapshot in memoria con TTL: entro INVENTORY_TTL_S si serve la copia in cache,
+# fino a INVENTORY_MAX_STALE_S si serve la copia vecchia e la si aggiorna in un
+# thread in background (stale-while-revalidate). Solo oltre, o a freddo, la
+# richiesta aspetta Spoolman. Un solo fetch alla volta verso Spoolman.
+INVENTORY_TTL_S = float(os.getenv("INVENTORY_TTL_S", "30"))
+INVENTORY_MAX_STALE_S = float(os.getenv("INVENTORY_MAX_STALE_S", "3600"))
+_INVENTORY_LOCK = threading.Lock()
+_INVENTORY_FETCH_LOCK = threading.Lock()
+_INVENTORY_SNAPSHOT = None
+_INVENTORY_REFRESHING = False
+
+
+def _load_inventory_snapshot():
+    """Scarica le bobine e sostituisce lo snapshot (da chiamare con _INVENTORY_FETCH_LOCK)."""
+    global _INVENTORY_SNAPSHOT
+    spools = _fetch_spool_list()
+    filaments = _fetch_filament_index(spools)
+    items = _items_from_spools(spools, filaments)
+    snap = {
+        "spools": spools,
+        "filaments": filaments,
+        "items": items,
+        "index": {it["key"]: it for it in items},
+        "fetched_at": time.monotonic(),
+    }
+    with _INVENTORY_LOCK:
+        _INVENTORY_SNAPSHOT = snap
+    return snap
+
+
+def _refresh_inventory_background():
+    global _INVENTORY_REFRESHING
+    try:
+        with _INVENTORY_FETCH_LOCK:
+            _load_inventory_snapshot()
+    except Exception as exc:  # si continua a servire lo snapshot precedente
+        detail = getattr(exc, "detail", None) or exc
+        print(f"[inventory] refresh fallito: {type(exc).__name__}: {detail}")
+    finally:
+        with _INVENTORY_LOCK:
+            _INVENTORY_REFRESHING = False
+
+
+def _schedule_inventory_refresh():
+    global _INVENTORY_REFRESHING
+    with _INVENTORY_LOCK:
+        if _INVENTORY_REFRESHING:
+            return
+        _INVENTORY_REFRESHING = True
+    threading.Thread(target=_refresh_inventory_background, name="inventory-refresh", daemon=True).start()
+
+
+def _inventory_snapshot():
+    requested_at = time.monotonic()
+    with _INVENTORY_LOCK:
+        snap = _INVENTORY_SNAPSHOT
+    if snap is not None:
+        age = requested_at - snap["fetched_at"]
+        if age < INVENTORY_TTL_S:
+            return snap
+        if age < INVENTORY_MAX_STALE_S:
+            _schedule_inventory_refresh()
+            return snap
+    with _INVENTORY_FETCH_LOCK:
+        with _INVENTORY_LOCK:
+            snap = _INVENTORY_SNAPSHOT
+        # un'altra richiesta ha già aggiornato mentre aspettavamo il lock
+        if snap is not None and snap["fetched_at"] >= requested_at:
+            return snap
+        return _load_inventory_snapshot()
+
+
+def _invalidate_inventory_cache():
+    global _INVENTORY_SNAPSHOT
+    with _INVENTORY_LOCK:
+        if _INVENTORY_SNAPSHOT is not None:
+            # solo "scaduto": le letture continuano a ricevere lo snapshot
+            # precedente mentre il refresh in background lo sostituisce
+            _INVENTORY_SNAPSHOT = dict(_INVENTORY_SNAPSHOT, fetched_at=time.monotonic() - INVENTORY_TTL_S)
+
+
+def _build_inventory_items():
+    return _inventory_snapshot()["items"]
+
+
+def _find_inventory_item(key):
+    return _inventory_snapshot()["index"].get(key)
+
 # ---- Rotazioni (compat futura per Cura >=5) ----
 def _identity3():
     return [[1,0,0],[0,1,0],[0,0,1]]
@@ -454,24 +804,11 @@ def health():
 # ---- API Spoolman ----
 @app.get("/spools")
 def spools():
-    sp = _get(
-        [
-            "/api/v1/spool",
-            "/api/v1/spool/",
-            "/api/v1/spools",
-            "/api/spool",
-            "/api/spools",
-        ],
-        params={"allow_archived": False, "limit": 1000},
-    )
-    if isinstance(sp, dict):
-        spool_list = sp.get("results") or sp.get("spools") or []
-    else:
-        spool_list = sp
+    snap = _inventory_snapshot()
 
     out = []
-    for s in spool_list:
-        f = _extract_filament_from_spool(s)
+    for s in snap["spools"]:
+        f = _extract_filament_from_spool(s, snap["filaments"])
         color_hex = _ensure_color_hex(_raw_color_hex(s, f))
         is_transparent = _detect_transparent(s, f)
         price_per_kg = _price_per_kg_from_spool(s, f)
@@ -497,119 +834,957 @@ def inventory():
     items = _build_inventory_items()
     return _no_cache({"items": items, "hourly_rate": HOURLY_RATE, "currency": CURRENCY})
 
+@app.post("/inventory/invalidate")
+def inventory_invalidate(wait: bool = False):
+    """Forza il refresh dell'inventario (es. dopo aver modificato le bobine in Spoolman).
+
+    Di default il refresh parte in background e le richieste continuano a
+    ricevere lo snapshot precedente; con ``?wait=true`` si attende Spoolman.
+    """
+    _invalidate_inventory_cache()
+    if wait:
+        with _INVENTORY_FETCH_LOCK:
+            snap = _load_inventory_snapshot()
+        return _no_cache({"ok": True, "refreshed": True, "items": len(snap["items"])})
+    _schedule_inventory_refresh()
+    return _no_cache({"ok": True, "refreshed": False})
+
 # ---- Upload / Download modelli ----
 # Extend supported extensions beyond the default Cura ones.  CuraEngine only
 # natively slices STL/OBJ/3MF, but we can transparently convert other formats
 # (such as STEP or STP) to STL via the `assimp_disabled` utility if it is available.
 ALLOWED_EXT = {".stl", ".obj", ".3mf", ".zip", ".step", ".stp"}
 
-def _find_model_in_dir(root: Path):
-    # Include STEP/STP so that models packaged in ZIPs can be picked up and
-    # subsequently converted to STL.  3MF, STL and OBJ still take precedence.
-    order = [".3mf", ".stl", ".obj", ".step", ".stp"]
-    best = None
-    for ext in order:
-        for p in root.rglob(f"*{ext}"):
-            best = p; break
-        if best: break
-    return best
+# Include STEP/STP so that models packaged in ZIPs can be picked up and
+# subsequently converted to STL.  3MF, STL and OBJ still take precedence.
+MODEL_EXT_ORDER = [".3mf", ".stl", ".obj", ".step", ".stp"]
+
+
+def _model_ext_rank(path: Path) -> int:
+    ext = path.suffix.lower()
+    return MODEL_EXT_ORDER.index(ext) if ext in MODEL_EXT_ORDER else len(MODEL_EXT_ORDER)
+
+UPLOAD_MAX_BYTES = int(os.getenv("UPLOAD_MAX_BYTES", str(1 << 30)))
+UPLOAD_CHUNK = 1 << 20
+
+
+async def _save_upload(file: UploadFile, target: Path):
+    """Copy an upload to disk in chunks, hashing and size-checking on the fly.
+
+    Returns ``(size, sha256_hex)``; the partial file is removed on error.
+    """
+    if UPLOAD_MAX_BYTES and file.size and file.size > UPLOAD_MAX_BYTES:
+        raise HTTPException(status_code=413, detail=f"File troppo grande (max {UPLOAD_MAX_BYTES} byte)")
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        with open(target, "wb") as out:
+            while True:
+                chunk = await file.read(UPLOAD_CHUNK)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if UPLOAD_MAX_BYTES and size > UPLOAD_MAX_BYTES:
+                    raise HTTPException(status_code=413, detail=f"File troppo grande (max {UPLOAD_MAX_BYTES} byte)")
+                digest.update(chunk)
+                out.write(chunk)
+    except BaseException:
+        target.unlink(missing_ok=True)
+        raise
+    sha = digest.hexdigest()
+    _remember_file_hash(target, sha)
+    return size, sha
+
+
+# ---- Estrazione selettiva ZIP ----
+# Degli archivi si legge solo la central directory: i membri vengono ordinati
+# per MODEL_EXT_ORDER (poi per profondità e nome) e su disco finisce soltanto
+# il modello scelto, copiato a blocchi. Immagini, PDF e varianti restano
+# compressi nello zip. Limiti anti zip-bomb sul singolo membro: dimensione
+# dichiarata/effettiva e rapporto di compressione.
+ZIP_MAX_MEMBER_BYTES = int(os.getenv("ZIP_MAX_MEMBER_BYTES", str(UPLOAD_MAX_BYTES or 1 << 30)))
+ZIP_MAX_RATIO = float(os.getenv("ZIP_MAX_RATIO", "200"))
+# sotto questa dimensione il rapporto non viene controllato (file minuscoli comprimono tantissimo)
+_ZIP_RATIO_MIN_BYTES = 1 << 20
+
+
+def _zip_member_parts(name: str):
+    """Componenti sicure del percorso di un membro (niente assoluti né "..")."""
+    parts = [p for p in name.replace("\\", "/").split("/") if p not in ("", ".", "..")]
+    if parts and parts[0].endswith(":"):
+        parts = parts[1:]
+    return parts
+
+
+def _zip_rank_models(z: zipfile.ZipFile) -> list:
+    """Membri modello dello zip in ordine di preferenza, dalla sola central directory."""
+    ranked = []
+    for info in z.infolist():
+        if info.is_dir():
+            continue
+        parts = _zip_member_parts(info.filename)
+        if not parts or parts[0] == "__MACOSX" or parts[-1].startswith("._"):
+            continue
+        ext = Path(parts[-1]).suffix.lower()
+        if ext not in MODEL_EXT_ORDER:
+            continue
+        ranked.append((MODEL_EXT_ORDER.index(ext), len(parts), "/".join(parts).lower(), info))
+    ranked.sort(key=lambda r: r[:3])
+    return [r[3] for r in ranked]
+
+
+def _zip_too_large(info: zipfile.ZipInfo):
+    return HTTPException(status_code=413, detail=f"Membro ZIP troppo grande o sospetto: {info.filename}")
+
+
+def _zip_check_ratio(info: zipfile.ZipInfo, size: int):
+    if ZIP_MAX_RATIO and size > _ZIP_RATIO_MIN_BYTES and size > ZIP_MAX_RATIO * max(info.compress_size, 1):
+        raise _zip_too_large(info)
+
+
+def _zip_extract_member(z: zipfile.ZipFile, info: zipfile.ZipInfo, dest: Path) -> Path:
+    """Estrae un solo membro in streaming sotto ``dest`` rispettando i limiti."""
+    if ZIP_MAX_MEMBER_BYTES and info.file_size > ZIP_MAX_MEMBER_BYTES:
+        raise _zip_too_large(info)
+    _zip_check_ratio(info, info.file_size)
+    target = dest.joinpath(*_zip_member_parts(info.filename))
+    target.parent.mkdir(parents=True, exist_ok=True)
+    written = 0
+    try:
+        with z.open(info) as src, open(target, "wb") as out:
+            while True:
+                chunk = src.read(UPLOAD_CHUNK)
+                if not chunk:
+                    break
+                written += len(chunk)
+                # la dimensione dichiarata può mentire: si ricontrolla su quanto letto
+                if ZIP_MAX_MEMBER_BYTES and written > ZIP_MAX_MEMBER_BYTES:
+                    raise _zip_too_large(info)
+                _zip_check_ratio(info, written)
+                out.write(chunk)
+    except BaseException:
+        target.unlink(missing_ok=True)
+        raise
+    return target
+
+
+def _extract_model_from_zip(path: Path, dest: Path):
+    """Sceglie ed estrae il modello preferito dello zip; ``None`` se non ce ne sono."""
+    try:
+        with zipfile.ZipFile(path) as z:
+            ranked = _zip_rank_models(z)
+            if not ranked:
+                return None
+            return _zip_extract_member(z, ranked[0], dest)
+    except (zipfile.BadZipFile, zipfile.LargeZipFile, NotImplementedError) as e:
+        raise HTTPException(status_code=400, detail=f"ZIP non valido: {e}")
+
+
+# ---- Archivio modelli content-addressed ----
+# Ogni modello vive in UPLOAD_ROOT/_models/<sha256>/ insieme ai suoi derivati
+# (zip estratto, STL convertito, anteprime); la cache degli slicing è già per
+# hash. Un upload identico riusa la directory esistente senza riconvertire e
+# il nuovo nome logico diventa un hardlink al file originale.
+MODEL_STORE_ROOT = UPLOAD_ROOT / "_models"
+_MODEL_STAGING_ROOT = UPLOAD_ROOT / "_incoming"
+_MODEL_STORE_LOCK = threading.Lock()
+
+
+def _model_store_dir(sha: str) -> Path:
+    return MODEL_STORE_ROOT / sha
+
+
+def _model_store_load(store: Path):
+    try:
+        return json.loads((store / ".meta.json").read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return None
+
+
+def _model_store_write_meta(store: Path, meta: dict):
+    tmp = store / f".meta-{uuid.uuid4().hex}.json"
+    tmp.write_text(json.dumps(meta), encoding="utf-8")
+    os.replace(tmp, store / ".meta.json")
+
+
+def _model_store_add_name(store: Path, meta: dict, name: str) -> dict:
+    """Registra un nome logico in più per lo stesso contenuto (hardlink, niente copia)."""
+    with _MODEL_STORE_LOCK:
+        meta = _model_store_load(store) or meta
+        names = meta.setdefault("names", [])
+        if name in names:
+            return meta
+        link = store / name
+        if not link.exists():
+            try:
+                os.link(store / meta["source"], link)
+            except OSError:
+                shutil.copy2(store / meta["source"], link)
+        names.append(name)
+        _model_store_write_meta(store, meta)
+        return meta
+
+
+def _model_store_commit(staging: Path, sha: str, meta: dict):
+    """Sposta la directory preparata nell'archivio; se un upload identico
+    concorrente è arrivato prima si tiene la sua e si scarta la nostra."""
+    store = _model_store_dir(sha)
+    _model_store_write_meta(staging, meta)
+    MODEL_STORE_ROOT.mkdir(parents=True, exist_ok=True)
+    try:
+        staging.rename(store)
+    except OSError:
+        shutil.rmtree(staging, ignore_errors=True)
+        existing = _model_store_load(store)
+        if existing is None:
+            raise HTTPException(status_code=500, detail="Archivio modelli non scrivibile")
+        return store, existing
+    return store, meta
+
+
+def _model_store_response(store: Path, meta: dict, filename: str, deduplicated: bool):
+    rel = (store / meta["viewer"]).relative_to(UPLOAD_ROOT).as_posix()
+    return _no_cache({
+        "viewer_url": f"/files/{rel}",
+        "filename": filename,
+        "size": meta.get("size"),
+        "sha256": meta.get("sha256"),
+        "deduplicated": deduplicated,
+        "conversion": meta.get("conversion"),
+        "preview_url": _preview_url(store / meta["viewer"]),
+    })
+
 
 @app.post("/upload_model")
 async def upload_model(file: UploadFile = File(...)):
-    name = file.filename or "model"
+    name = Path(file.filename or "model").name or "model"
     ext = Path(name).suffix.lower()
     if ext not in ALLOWED_EXT:
         raise HTTPException(status_code=400, detail=f"Estensione non supportata: {ext}")
-    uid = uuid.uuid4().hex
-    work = UPLOAD_ROOT / uid
+    work = _MODEL_STAGING_ROOT / uuid.uuid4().hex
     work.mkdir(parents=True, exist_ok=True)
     target = work / name
-    data = await file.read()
-    target.write_bytes(data)
-    model_path = target
-    if ext == ".zip":
-        # decompress zip and locate first supported model
-        with zipfile.ZipFile(io.BytesIO(data)) as z:
-            z.extractall(work)
-        m = _find_model_in_dir(work)
-        if not m:
-            raise HTTPException(status_code=400, detail="ZIP senza STL/OBJ/3MF/STEP")
-        model_path = m
-
-    # Convert STEP/STP/3MF to STL for preview using assimp_disabled, if available.  This
-    # ensures that even unsupported formats can be rendered in the browser.  The
-    # converted file is stored alongside the original and used as the viewer
-    # source; slicing will operate on this STL as well.
-    viewer_model_path = model_path
     try:
-        suffix = model_path.suffix.lower()
-        if suffix in {".step", ".stp", ".3mf", ".amf", ".obj"}:
-            export_dir = model_path.parent / "ps_export"
-            viewer_model_path = prusa_export_stl(model_path, export_dir)
-    except Exception:
-        # ignore conversion errors; preview will use the original path
-        viewer_model_path = model_path
+        size, sha = await _save_upload(file, target)
+    except BaseException:
+        shutil.rmtree(work, ignore_errors=True)
+        raise
+
+    store = _model_store_dir(sha)
+    meta = _model_store_load(store)
+    if meta is not None:
+        # stesso contenuto già caricato: niente estrazione né conversione
+        shutil.rmtree(work, ignore_errors=True)
+        meta = _model_store_add_name(store, meta, name)
+        _touch_upload(store)
+        meta = _ensure_conversion(store, meta)
+        filename = meta.get("model_name") if ext == ".zip" else name
+        return _model_store_response(store, meta, filename or name, True)
+
+    try:
+        model_path = target
+        if ext == ".zip":
+            # estrae dallo zip solo il modello scelto (letto dal file su disco)
+            m = await asyncio.to_thread(_extract_model_from_zip, target, work)
+            if not m:
+                raise HTTPException(status_code=400, detail="ZIP senza STL/OBJ/3MF/STEP")
+            model_path = m
+    except BaseException:
+        shutil.rmtree(work, ignore_errors=True)
+        raise
+
+    return _model_store_finalize(work, name, sha, size, model_path)
+
+
+def _model_store_finalize(work: Path, name: str, sha: str, size: int, model_path: Path, extra=None):
+    # La conversione in STL per l'anteprima (STEP/3MF/OBJ/AMF) non blocca più la
+    # risposta: si restituisce subito il file originale e un job di conversione;
+    # a job finito viewer_url passa allo STL convertito.
+    if model_path.suffix.lower() == ".stl" and not is_valid_stl(model_path):
+        shutil.rmtree(work, ignore_errors=True)
+        raise HTTPException(status_code=400, detail="STL non valido (troncato o senza triangoli)")
+    model_rel = model_path.relative_to(work).as_posix()
+    meta = {
+        "sha256": sha,
+        "size": size,
+        "source": name,
+        "names": [name],
+        "model_name": model_path.name,
+        "model": model_rel,
+        "viewer": model_rel,
+    }
+    meta.update(extra or {})
+    store, meta = _model_store_commit(work, sha, meta)
+    meta = _ensure_conversion(store, meta)
+    _CONVERT_POOL.submit(_warm_model_preview, store / meta["viewer"])
+    return _model_store_response(store, meta, model_path.name, False)
+
+
+# ---- Conversione modelli in background ----
+CONVERT_EXTS = {".step", ".stp", ".3mf", ".amf", ".obj"}
+CONVERT_WORKERS = max(1, int(os.getenv("CONVERT_WORKERS", "2")))
+CONVERT_TIMEOUT_S = float(os.getenv("CONVERT_TIMEOUT_S", "300"))
+CONVERT_JOBS_MAX = 500
+_CONVERT_POOL = ThreadPoolExecutor(max_workers=CONVERT_WORKERS, thread_name_prefix="convert")
+_CONVERT_JOBS = {}
+_CONVERT_LOCK = threading.Lock()
+
+
+def _convert_job_public(job):
+    out = {k: v for k, v in job.items() if not k.startswith("_")}
+    out["status_url"] = f"/convert/jobs/{job['job_id']}"
+    return out
+
+
+def _set_conversion_meta(store: Path, **changes):
+    with _MODEL_STORE_LOCK:
+        meta = _model_store_load(store)
+        if meta is None:
+            return None
+        meta.update(changes)
+        _model_store_write_meta(store, meta)
+        return meta
+
+
+def _convert_model_job(job_id: str, store: Path, model_rel: str):
+    with _CONVERT_LOCK:
+        job = _CONVERT_JOBS[job_id]
+        job.update(status="running", started_at=time.time())
+    _set_conversion_meta(store, conversion={"job_id": job_id, "status": "running"})
+    model_path = store / model_rel
+    try:
+        stl = prusa_export_stl(model_path, model_path.parent / "ps_export", timeout=CONVERT_TIMEOUT_S)
+        viewer_rel = stl.relative_to(store).as_posix()
+    except Exception as exc:
+        detail = getattr(exc, "detail", None) or f"{type(exc).__name__}: {exc}"
+        # l'anteprima resta sul file originale
+        _set_conversion_meta(store, conversion={"job_id": job_id, "status": "error", "error": detail})
+        with _CONVERT_LOCK:
+            job.update(status="error", error=detail, finished_at=time.time())
+        return
+    _set_conversion_meta(store, viewer=viewer_rel, conversion={"job_id": job_id, "status": "done"})
+    with _CONVERT_LOCK:
+        job.update(
+            status="done",
+            viewer_url=f"/files/{(store / viewer_rel).relative_to(UPLOAD_ROOT).as_posix()}",
+            finished_at=time.time(),
+        )
+    _warm_model_preview(store / viewer_rel)
+
+
+def _trim_convert_jobs():
+    finished = [j for j in _CONVERT_JOBS.values() if j["status"] in ("done", "error")]
+    excess = len(_CONVERT_JOBS) - CONVERT_JOBS_MAX
+    for job in sorted(finished, key=lambda j: j["created_at"])[:max(0, excess)]:
+        _CONVERT_JOBS.pop(job["job_id"], None)
+
+
+def _ensure_conversion(store: Path, meta: dict) -> dict:
+    """Accoda la conversione se serve; restituisce il meta con lo stato del job."""
+    model_rel = meta.get("model") or meta.get("viewer")
+    if not model_rel or Path(model_rel).suffix.lower() not in CONVERT_EXTS:
+        return meta
+    conv = meta.get("conversion") or {}
+    if conv.get("status") in ("done", "error"):
+        return meta
+    with _CONVERT_LOCK:
+        job = _CONVERT_JOBS.get(conv.get("job_id"))
+        if job is not None:
+            return dict(meta, conversion=_convert_job_public(job))
+        # nessun job vivo (primo upload o riavvio del servizio): se ne crea uno
+        job_id = uuid.uuid4().hex
+        job = {"job_id": job_id, "status": "queued", "sha256": meta.get("sha256"), "created_at": time.time()}
+        _CONVERT_JOBS[job_id] = job
+        _trim_convert_jobs()
+        public = _convert_job_public(job)
+    meta = _set_conversion_meta(store, conversion={"job_id": job_id, "status": "queued"}) or meta
+    _CONVERT_POOL.submit(_convert_model_job, job_id, store, model_rel)
+    return dict(meta, conversion=public)
+
+
+@app.get("/convert/jobs/{job_id}")
+def convert_job_status(job_id: str):
+    with _CONVERT_LOCK:
+        job = _CONVERT_JOBS.get(job_id)
+        if job is None:
+            raise HTTPException(status_code=404, detail="Job di conversione non trovato")
+        return _no_cache(_convert_job_public(job))
+
+# ---- Anteprima decimata (GLB quantizzato) ----
+# Il viewer non scarica più lo STL originale (una scansione da 150 MB blocca il
+# browser): riceve un GLB indicizzato con al massimo PREVIEW_MAX_TRIANGLES
+# triangoli, decimato per clustering dei vertici su griglia e con posizioni
+# quantizzate a 16 bit (KHR_mesh_quantization). Il GLB vive accanto al modello
+# e l'originale resta solo per lo slicing.
+PREVIEW_MAX_TRIANGLES = max(1000, int(os.getenv("PREVIEW_MAX_TRIANGLES", "200000")))
+_PREVIEW_QUANT_MAX = 65535
+_PREVIEW_CELL_BITS = 21
+# lock a strisce: numero fisso, scelto dall'hash del percorso (nessuna crescita)
+_DERIVED_LOCKS = [threading.Lock() for _ in range(64)]
+
+
+@contextmanager
+def _derived_file_lock(target: Path):
+    """Un solo thread alla volta genera lo stesso file derivato (anteprima, toolpath)."""
+    with _DERIVED_LOCKS[hash(str(target)) % len(_DERIVED_LOCKS)]:
+        yield
+
+
+def _preview_path(model_path: Path) -> Path:
+    return model_path.with_name(model_path.name + ".preview.glb")
+
+
+def _preview_url(model_path: Path):
+    if _np is None or model_path.suffix.lower() != ".stl":
+        return None
+    rel = model_path.relative_to(UPLOAD_ROOT).as_posix()
+    return f"/model/preview?viewer_url={quote('/files/' + rel, safe='/')}"
+
+
+def _iter_stl_triangle_blocks(model_path: Path):
+    """Triangoli dello STL a blocchi di array ``(n, 3, 3)``; il binario è letto dal mmap."""
+    records = _stl_records(model_path)
+    if records is not None:
+        vertices = records["v"]
+        for start in range(0, len(vertices), _MESH_READ_TRIANGLES):
+            yield vertices[start:start + _MESH_READ_TRIANGLES].reshape(-1, 3, 3).astype(_np.float64)
+        return
+    rest = _np.empty((0, 3))
+    for block in _iter_text_vertex_blocks(model_path, b"vertex"):
+        pts = _np.concatenate([rest, _np.asarray(block, dtype=_np.float64).reshape(-1, 3)])
+        usable = len(pts) - len(pts) % 3
+        rest = pts[usable:]
+        if usable:
+            yield pts[:usable].reshape(-1, 3, 3)
+
+
+def _preview_bounds(model_path: Path):
+    """Prima passata: AABB, area della superficie e numero di triangoli."""
+    lo = _np.full(3, _np.inf)
+    hi = _np.full(3, -_np.inf)
+    area = 0.0
+    count = 0
+    for tris in _iter_stl_triangle_blocks(model_path):
+        if not len(tris):
+            continue
+        lo = _np.minimum(lo, tris.min(axis=(0, 1)))
+        hi = _np.maximum(hi, tris.max(axis=(0, 1)))
+        cross = _np.cross(tris[:, 1] - tris[:, 0], tris[:, 2] - tris[:, 0])
+        area += 0.5 * float(_np.sqrt((cross * cross).sum(axis=1)).sum())
+        count += len(tris)
+    return lo, hi, area, count
+
+
+def _unique_rows(rows):
+    """Righe distinte di un array intero 2D (lexsort, più rapido di ``unique(axis=0)``)."""
+    if len(rows) < 2:
+        return rows
+    rows = rows[_np.lexsort(rows.T[::-1])]
+    keep = _np.ones(len(rows), dtype=bool)
+    keep[1:] = (rows[1:] != rows[:-1]).any(axis=1)
+    return rows[keep]
+
+
+def _preview_cluster(model_path: Path, lo, cell: float):
+    """Collassa i vertici per cella della griglia di lato ``cell``.
+
+    Restituisce le posizioni (media dei vertici di ogni cella) e i triangoli
+    indicizzati, senza degeneri né doppioni. Lavora a blocchi: in memoria
+    restano solo le celle e i triangoli sopravvissuti.
+    """
+    keys, sums, counts, faces = [], [], [], []
+    for tris in _iter_stl_triangle_blocks(model_path):
+        q = _np.floor((tris - lo) / cell).astype(_np.int64)
+        k = (q[..., 0] << (2 * _PREVIEW_CELL_BITS)) | (q[..., 1] << _PREVIEW_CELL_BITS) | q[..., 2]
+        keep = (k[:, 0] != k[:, 1]) & (k[:, 1] != k[:, 2]) & (k[:, 0] != k[:, 2])
+        k, pts = k[keep], tris[keep].reshape(-1, 3)
+        if not len(k):
+            continue
+        uk, inv = _np.unique(k.ravel(), return_inverse=True)
+        keys.append(uk)
+        sums.append(_np.stack([_np.bincount(inv, weights=pts[:, i], minlength=len(uk)) for i in range(3)], axis=1))
+        counts.append(_np.bincount(inv, minlength=len(uk)))
+        # rotazione canonica (chiave minima in testa, stesso verso) per riconoscere i doppioni
+        first = k.argmin(axis=1)
+        k = _np.take_along_axis(k, (first[:, None] + _np.arange(3)) % 3, axis=1)
+        faces.append(_unique_rows(k))
+    if not faces:
+        return _np.empty((0, 3)), _np.empty((0, 3), dtype=_np.int64)
+    uk, inv = _np.unique(_np.concatenate(keys), return_inverse=True)
+    all_sums = _np.concatenate(sums)
+    total = _np.bincount(inv, weights=_np.concatenate(counts), minlength=len(uk))
+    positions = _np.stack(
+        [_np.bincount(inv, weights=all_sums[:, i], minlength=len(uk)) for i in range(3)], axis=1
+    ) / total[:, None]
+    faces = _unique_rows(_np.concatenate(faces))
+    return positions, _np.searchsorted(uk, faces)
+
+
+def _write_preview_glb(target: Path, positions, faces, lo, scale) -> None:
+    """GLB con una sola mesh: posizioni uint16 (nodo con scale/translation) e indici."""
+    quant = _np.clip(_np.rint((positions - lo) / scale), 0, _PREVIEW_QUANT_MAX).astype(_np.uint16)
+    # gli attributi vanno allineati a 4 byte: VEC3 uint16 con stride 8
+    packed = _np.zeros((len(quant), 4), dtype=_np.uint16)
+    packed[:, :3] = quant
+    index_type, index_dtype = (5123, _np.uint16) if len(quant) <= 0xFFFF else (5125, _np.uint32)
+    pos_bytes = packed.tobytes()
+    idx_bytes = faces.astype(index_dtype).tobytes()
+    idx_pad = b"\0" * (-len(idx_bytes) % 4)
+    gltf = {
+        "asset": {"version": "2.0", "generator": "spoolsite-api preview"},
+        "extensionsUsed": ["KHR_mesh_quantization"],
+        "extensionsRequired": ["KHR_mesh_quantization"],
+        "scene": 0,
+        "scenes": [{"nodes": [0]}],
+        "nodes": [{"mesh": 0, "translation": [float(v) for v in lo], "scale": [float(v) for v in scale]}],
+        "meshes": [{"primitives": [{"attributes": {"POSITION": 0}, "indices": 1}]}],
+        "buffers": [{"byteLength": len(pos_bytes) + len(idx_bytes) + len(idx_pad)}],
+        "bufferViews": [
+            {"buffer": 0, "byteOffset": 0, "byteLength": len(pos_bytes), "byteStride": 8, "target": 34962},
+            {"buffer": 0, "byteOffset": len(pos_bytes), "byteLength": len(idx_bytes), "target": 34963},
+        ],
+        "accessors": [
+            {
+                "bufferView": 0, "componentType": 5123, "count": len(quant), "type": "VEC3",
+                "min": [int(v) for v in quant.min(axis=0)], "max": [int(v) for v in quant.max(axis=0)],
+            },
+            {"bufferView": 1, "componentType": index_type, "count": int(faces.size), "type": "SCALAR"},
+        ],
+    }
+    doc = json.dumps(gltf, separators=(",", ":")).encode("utf-8")
+    doc += b" " * (-len(doc) % 4)
+    binary = pos_bytes + idx_bytes + idx_pad
+    tmp = target.with_name(f".{target.name}.{uuid.uuid4().hex[:8]}")
+    with open(tmp, "wb") as f:
+        f.write(struct.pack("<4sII", b"glTF", 2, 12 + 8 + len(doc) + 8 + len(binary)))
+        f.write(struct.pack("<II", len(doc), 0x4E4F534A) + doc)
+        f.write(struct.pack("<II", len(binary), 0x004E4942) + binary)
+    os.replace(tmp, target)
+
+
+def _build_model_preview(model_path: Path, target: Path) -> None:
+    t0 = time.perf_counter()
+    lo, hi, area, count = _preview_bounds(model_path)
+    if not count:
+        raise HTTPException(status_code=400, detail="STL non valido (troncato o senza triangoli)")
+    extent = _np.maximum(hi - lo, 1e-6)
+    scale = extent / _PREVIEW_QUANT_MAX
+    # sotto il budget si uniscono solo i vertici indistinguibili dopo la quantizzazione
+    cell = float(scale.max())
+    if count > PREVIEW_MAX_TRIANGLES:
+        cell = max(cell, math.sqrt(2.0 * area / PREVIEW_MAX_TRIANGLES))
+    for _ in range(4):
+        positions, faces = _preview_cluster(model_path, lo, cell)
+        if len(faces) <= PREVIEW_MAX_TRIANGLES:
+            break
+        cell *= 1.05 * math.sqrt(len(faces) / PREVIEW_MAX_TRIANGLES)
+    _write_preview_glb(target, positions, faces, lo, scale)
+    print(f"[preview] {model_path.name}: {count} -> {len(faces)} triangoli in {time.perf_counter() - t0:.2f}s")
+
+
+def _ensure_model_preview(model_path: Path) -> Path:
+    target = _preview_path(model_path)
+    with _derived_file_lock(target):
+        try:
+            if target.stat().st_mtime >= model_path.stat().st_mtime:
+                return target
+        except OSError:
+            pass
+        _build_model_preview(model_path, target)
+        return target
+
+
+def _warm_model_preview(model_path: Path) -> None:
+    """Prepara l'anteprima in background, così il viewer la trova già pronta."""
+    if _preview_url(model_path) is None:
+        return
+    try:
+        _ensure_model_preview(model_path)
+    except Exception as exc:
+        detail = getattr(exc, "detail", None) or f"{type(exc).__name__}: {exc}"
+        print(f"[preview] {model_path.name}: anteprima non generata: {detail}")
+
+
+@app.get("/model/preview")
+@app.get("/api/model/preview")
+def model_preview(viewer_url: str):
+    """GLB decimato e quantizzato di un modello STL caricato (per il viewer)."""
+    model_path = _model_path_from_viewer_url(viewer_url)
+    if model_path.suffix.lower() != ".stl":
+        raise HTTPException(status_code=400, detail="Anteprima disponibile solo per modelli STL")
+    if _np is None:
+        raise HTTPException(status_code=503, detail="NumPy non installato: anteprima non disponibile")
+    return FileResponse(_ensure_model_preview(model_path), media_type="model/gltf-binary")
+
+
+# ---- Download modelli da URL ----
+# Motore asincrono per /fetch_model: i file vengono scritti su disco a blocchi
+# con limite di dimensione, le pagine HTML sono scandite man mano che arrivano
+# (senza salvarle) e i pacchetti con più file vengono scaricati in parallelo.
+# Dopo un errore di rete il download riprende con Range dal byte già scritto.
+FETCH_MAX_BYTES = int(os.getenv("FETCH_MAX_BYTES", str(UPLOAD_MAX_BYTES)))
+FETCH_MAX_FILES = max(1, int(os.getenv("FETCH_MAX_FILES", "10")))
+FETCH_CONCURRENCY = max(1, int(os.getenv("FETCH_CONCURRENCY", "4")))
+FETCH_HTML_MAX_BYTES = int(os.getenv("FETCH_HTML_MAX_BYTES", str(8 << 20)))
+FETCH_TIMEOUT_S = float(os.getenv("FETCH_TIMEOUT_S", "20"))
+FETCH_RETRIES = int(os.getenv("FETCH_RETRIES", "3"))
+_MODEL_LINK_RE = re.compile(rb'https?://[^"\'\s<>]+?\.(?:3mf|stl|obj|zip)(?=["\'\s<>?#]|$)', re.I)
+_FETCH_HEADERS = {"User-Agent": "Mozilla/5.0"}
+
+
+async def _scan_model_links(response) -> list[str]:
+    """Cerca link a modelli nell'HTML in streaming, con una finestra a cavallo dei blocchi."""
+    links: list[str] = []
+    seen = set()
+    tail = b""
+    read = 0
+    async for chunk in response.aiter_bytes(1 << 16):
+        read += len(chunk)
+        buf = tail + chunk
+        for m in _MODEL_LINK_RE.finditer(buf):
+            # un match che tocca la fine del buffer potrebbe continuare nel blocco dopo
+            if m.end() == len(buf):
+                continue
+            link = m.group(0).decode("utf-8", errors="ignore")
+            if link not in seen:
+                seen.add(link)
+                links.append(link)
+        tail = buf[-2048:]
+        if len(links) >= FETCH_MAX_FILES or read >= FETCH_HTML_MAX_BYTES:
+            break
+    for m in _MODEL_LINK_RE.finditer(tail):
+        link = m.group(0).decode("utf-8", errors="ignore")
+        if link not in seen:
+            seen.add(link)
+            links.append(link)
+    return links[:FETCH_MAX_FILES]
+
+
+def _fetch_too_large():
+    return HTTPException(status_code=413, detail=f"Download troppo grande (max {FETCH_MAX_BYTES} byte)")
+
+
+async def _fetch_url(client, url: str, dst: Path, *, allow_html: bool):
+    """Scarica ``url`` in ``dst``; se è una pagina HTML restituisce i link trovati.
+
+    Ritorna ``{"kind": "file", "size", "sha256", "name"}`` oppure
+    ``{"kind": "html", "links": [...]}``.
+    """
+    digest = hashlib.sha256()
+    size = 0
+    validator = None
+    resumable = False
+    name = None
+    attempts = 0
+    with open(dst, "wb") as out:
+        while True:
+            headers = dict(_FETCH_HEADERS)
+            if size and resumable:
+                headers["Range"] = f"bytes={size}-"
+                if validator:
+                    headers["If-Range"] = validator
+            try:
+                async with client.stream("GET", url, headers=headers, timeout=FETCH_TIMEOUT_S) as r:
+                    if size and r.status_code != 206:
+                        # niente ripresa (o file cambiato nel frattempo): si ricomincia da capo
+                        out.seek(0)
+                        out.truncate()
+                        digest = hashlib.sha256()
+                        size = 0
+                    r.raise_for_status()
+                    if name is None:
+                        ctype = r.headers.get("content-type", "").lower()
+                        if allow_html and "text/html" in ctype:
+                            return {"kind": "html", "links": await _scan_model_links(r)}
+                        declared = r.headers.get("content-length")
+                        if declared and declared.isdigit() and int(declared) > FETCH_MAX_BYTES:
+                            raise _fetch_too_large()
+                        name = Path(r.url.path).name
+                        validator = r.headers.get("etag") or r.headers.get("last-modified")
+                        # l'offset per Range è sui byte trasmessi: con content-encoding non vale
+                        resumable = "content-encoding" not in r.headers
+                    # blocchi così come arrivano dalla rete, così un errore a metà non
+                    # butta via la parte già ricevuta ma non ancora "piena"
+                    async for chunk in r.aiter_bytes():
+                        size += len(chunk)
+                        if size > FETCH_MAX_BYTES:
+                            raise _fetch_too_large()
+                        digest.update(chunk)
+                        out.write(chunk)
+                return {"kind": "file", "size": size, "sha256": digest.hexdigest(), "name": name}
+            except httpx.TransportError:
+                attempts += 1
+                if attempts > FETCH_RETRIES:
+                    raise
+                await asyncio.sleep(0.5 * attempts)
+
+
+def _fetched_file_name(work: Path, url_name: str | None, fallback: str, path: Path) -> Path:
+    name = slugify_filename(url_name or fallback)
+    if Path(name).suffix.lower() not in ALLOWED_EXT:
+        with open(path, "rb") as f:
+            if f.read(4) == b"PK\x03\x04":
+                name += ".zip"
+    target = work / name
+    n = 1
+    while target.exists():
+        target = work / f"{Path(name).stem}_{n}{Path(name).suffix}"
+        n += 1
+    return target
+
+
+async def _fetch_into(client, url: str, work: Path, sem: asyncio.Semaphore, *, allow_html: bool):
+    async with sem:
+        part = work / f".part-{uuid.uuid4().hex}"
+        try:
+            res = await _fetch_url(client, url, part, allow_html=allow_html)
+        except BaseException:
+            part.unlink(missing_ok=True)
+            raise
+        if res["kind"] == "html":
+            part.unlink(missing_ok=True)
+            return res
+        target = _fetched_file_name(work, res["name"], f"remote{Path(url).suffix.lower()}", part)
+        part.rename(target)
+        return dict(res, path=target, url=url)
 
-    rel = viewer_model_path.relative_to(UPLOAD_ROOT).as_posix()
-    return _no_cache({"viewer_url": f"/files/{rel}", "filename": model_path.name})
 
 @app.post("/fetch_model")
-def fetch_model(payload: dict = Body(...)):
+async def fetch_model(payload: dict = Body(...)):
     url = str(payload.get("url") or "").strip()
     if not url:
         raise HTTPException(status_code=400, detail="URL mancante")
-    uid = uuid.uuid4().hex
-    work = UPLOAD_ROOT / uid
+    work = _MODEL_STAGING_ROOT / uuid.uuid4().hex
     work.mkdir(parents=True, exist_ok=True)
-
-    def _download(u, out_path):
-        r = requests.get(u, timeout=20, stream=True, headers={"User-Agent": "Mozilla/5.0"})
-        r.raise_for_status()
-        with open(out_path, "wb") as f:
-            for chunk in r.iter_content(1024 * 64):
-                if chunk: f.write(chunk)
-        return r.headers.get("Content-Type","" ).lower()
+    client = _http_async_client()
+    sem = asyncio.Semaphore(FETCH_CONCURRENCY)
 
     try:
-        ext = Path(url).suffix.lower()
-        dst = work / f"remote{ext if ext in ALLOWED_EXT else ''}"
-        ctype = _download(url, dst)
-        if "text/html" in ctype or dst.suffix.lower() not in ALLOWED_EXT:
-            html = dst.read_text(errors="ignore")
-            m = re.search(r'https?://[^"\']+\.(?:3mf|stl|obj|zip)', html, re.I)
-            if not m:
+        first = await _fetch_into(client, url, work, sem, allow_html=True)
+        if first["kind"] == "html":
+            if not first["links"]:
                 raise HTTPException(status_code=400, detail="Nessun link a STL/OBJ/3MF/ZIP trovato nella pagina")
-            ext2 = Path(m.group(0)).suffix.lower()
-            dst = work / f"remote{ext2}"
-            _download(m.group(0), dst)
-
-        model_path = dst
-        if dst.suffix.lower() == ".zip":
-            with zipfile.ZipFile(dst) as z:
-                z.extractall(work)
-            m = _find_model_in_dir(work)
-            if not m:
+            # pacchetti multi-file (es. Thingiverse): tutti i link in parallelo
+            tasks = [
+                asyncio.create_task(_fetch_into(client, link, work, sem, allow_html=False))
+                for link in first["links"]
+            ]
+            try:
+                files = await asyncio.gather(*tasks)
+            except BaseException:
+                for t in tasks:
+                    t.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+                raise
+        else:
+            files = [first]
+        files = [f for f in files if f["path"].suffix.lower() in ALLOWED_EXT]
+        if not files:
+            raise HTTPException(status_code=400, detail="Il link non punta a un file STL/OBJ/3MF/ZIP")
+
+        primary = files[0]
+        sha, size = primary["sha256"], primary["size"]
+        if len(files) > 1:
+            # pacchetto: l'identità è l'insieme dei file, non solo il primo
+            sha = hashlib.sha256("\n".join(sorted(f["sha256"] for f in files)).encode()).hexdigest()
+            size = sum(f["size"] for f in files)
+        store = _model_store_dir(sha)
+        meta = _model_store_load(store)
+        if meta is not None:
+            shutil.rmtree(work, ignore_errors=True)
+            _touch_upload(store)
+            meta = _ensure_conversion(store, meta)
+            return _model_store_response(store, meta, meta.get("model_name") or primary["path"].name, True)
+
+        model_path = primary["path"]
+        if model_path.suffix.lower() == ".zip":
+            model_path = await asyncio.to_thread(_extract_model_from_zip, model_path, work)
+            if not model_path:
                 raise HTTPException(status_code=400, detail="ZIP remoto senza STL/OBJ/3MF")
-            model_path = m
+        extra = {"origin_url": url, "files": [f["path"].name for f in files]}
+        return _model_store_finalize(work, primary["path"].name, sha, size, model_path, extra)
+    except httpx.HTTPError as e:
+        shutil.rmtree(work, ignore_errors=True)
+        raise HTTPException(status_code=502, detail=f"Download fallito: {e}")
+    except BaseException:
+        shutil.rmtree(work, ignore_errors=True)
+        raise
+
+
+# ---- Pulizia upload (retention) ----
+# Un janitor in background rimuove da UPLOAD_ROOT le voci non usate da più di
+# UPLOAD_TTL_S e, se la quota UPLOAD_QUOTA_BYTES è superata, le meno usate di
+# recente (LRU). Una "voce" è una directory intera: modello + zip estratto +
+# ps_export + G-code. Le voci toccate negli ultimi UPLOAD_GC_MIN_AGE_S non
+# vengono mai rimosse. La cache degli slicing ha già la sua eviction.
+UPLOAD_TTL_S = float(os.getenv("UPLOAD_TTL_S", str(30 * 24 * 3600)))
+UPLOAD_QUOTA_BYTES = int(os.getenv("UPLOAD_QUOTA_BYTES", "0"))
+UPLOAD_GC_INTERVAL_S = float(os.getenv("UPLOAD_GC_INTERVAL_S", "3600"))
+UPLOAD_GC_MIN_AGE_S = float(os.getenv("UPLOAD_GC_MIN_AGE_S", "3600"))
+UPLOAD_GC_DRY_RUN = _env_truthy("UPLOAD_GC_DRY_RUN")
+_UPLOAD_GC_LOCK = threading.Lock()
+_UPLOAD_GC_STOP = threading.Event()
+_UPLOAD_GC_STATS = {
+    "runs": 0,
+    "entries_removed": 0,
+    "bytes_reclaimed": 0,
+    "last_run": None,
+    "last_report": None,
+}
+
+
+def _touch_upload(path: Path):
+    """Segna la voce dell'archivio come usata (per TTL e LRU)."""
+    try:
+        rel = path.resolve().relative_to(MODEL_STORE_ROOT.resolve())
+        entry = MODEL_STORE_ROOT / rel.parts[0]
+    except (ValueError, IndexError, OSError):
+        return
+    marker = entry / ".meta.json"
+    try:
+        os.utime(marker if marker.exists() else entry)
+    except OSError:
+        pass
+
 
-        # If the downloaded model is STEP/STP/3MF, attempt to convert to STL for preview
-        viewer_model_path = model_path
+def _dir_usage(root: Path):
+    size = 0
+    newest = root.stat().st_mtime
+    for dirpath, _, files in os.walk(root):
+        for fn in files:
+            try:
+                st = os.stat(os.path.join(dirpath, fn))
+            except OSError:
+                continue
+            size += st.st_size
+            newest = max(newest, st.st_mtime)
+    return size, newest
+
+
+def _upload_gc_entries():
+    entries = []
+    candidates = []
+    if MODEL_STORE_ROOT.is_dir():
+        for p in MODEL_STORE_ROOT.iterdir():
+            if p.is_dir():
+                candidates.append(("model", p))
+    if _MODEL_STAGING_ROOT.is_dir():
+        candidates.extend(("staging", p) for p in _MODEL_STAGING_ROOT.iterdir())
+    # directory uuid di upload precedenti all'archivio e di /fetch_model
+    for p in UPLOAD_ROOT.iterdir():
+        if p.is_dir() and not p.name.startswith("_"):
+            candidates.append(("legacy", p))
+    for kind, p in candidates:
         try:
-            suffix = model_path.suffix.lower()
-            if suffix in {".step", ".stp", ".3mf"}:
-                conv_path = model_path.with_suffix(".stl")
-                subprocess.run([
-                    "assimp_disabled", "export", str(model_path), str(conv_path), "-f", "stl"
-                ], check=True, timeout=60)
-                if conv_path.exists():
-                    viewer_model_path = conv_path
-        except Exception:
-            viewer_model_path = model_path
+            if p.is_dir():
+                size, newest = _dir_usage(p)
+                marker = p / ".meta.json"
+                last_used = marker.stat().st_mtime if marker.exists() else newest
+            else:
+                st = p.stat()
+                size, last_used = st.st_size, st.st_mtime
+        except OSError:
+            continue
+        entries.append({"kind": kind, "path": p, "size": size, "last_used": last_used})
+    return entries
+
+
+def _run_upload_gc(dry_run=None):
+    dry_run = UPLOAD_GC_DRY_RUN if dry_run is None else dry_run
+    started = time.time()
+    with _UPLOAD_GC_LOCK:
+        entries = _upload_gc_entries()
+        total = sum(e["size"] for e in entries)
+        victims = []
+        keep = []
+        for e in entries:
+            age = started - e["last_used"]
+            # staging rimasto da upload interrotti: basta la soglia minima
+            ttl = UPLOAD_GC_MIN_AGE_S if e["kind"] == "staging" else UPLOAD_TTL_S
+            if ttl > 0 and age > max(ttl, UPLOAD_GC_MIN_AGE_S):
+                victims.append(dict(e, reason="ttl"))
+            else:
+                keep.append(e)
+        remaining = total - sum(v["size"] for v in victims)
+        if UPLOAD_QUOTA_BYTES and remaining > UPLOAD_QUOTA_BYTES:
+            for e in sorted(keep, key=lambda x: x["last_used"]):
+                if remaining <= UPLOAD_QUOTA_BYTES:
+                    break
+                if started - e["last_used"] <= UPLOAD_GC_MIN_AGE_S:
+                    continue
+                victims.append(dict(e, reason="quota"))
+                remaining -= e["size"]
+
+        reclaimed = 0
+        removed = []
+        for v in victims:
+            if not dry_run:
+                try:
+                    if v["path"].is_dir():
+                        shutil.rmtree(v["path"])
+                    else:
+                        v["path"].unlink()
+                except OSError as exc:
+                    print(f"[upload-gc] rimozione fallita {v['path']}: {exc}")
+                    continue
+            reclaimed += v["size"]
+            removed.append({
+                "path": v["path"].relative_to(UPLOAD_ROOT).as_posix(),
+                "kind": v["kind"],
+                "bytes": v["size"],
+                "reason": v["reason"],
+            })
+
+        report = {
+            "dry_run": dry_run,
+            "scanned": len(entries),
+            "total_bytes": total,
+            "removed": removed,
+            "bytes_reclaimed": reclaimed,
+            "duration_s": round(time.time() - started, 3),
+        }
+        _UPLOAD_GC_STATS["runs"] += 1
+        _UPLOAD_GC_STATS["last_run"] = started
+        _UPLOAD_GC_STATS["last_report"] = dict(report, removed=removed[:50])
+        if not dry_run:
+            _UPLOAD_GC_STATS["entries_removed"] += len(removed)
+            _UPLOAD_GC_STATS["bytes_reclaimed"] += reclaimed
+    return report
+
+
+def _upload_janitor_loop():
+    while not _UPLOAD_GC_STOP.wait(UPLOAD_GC_INTERVAL_S):
+        try:
+            _run_upload_gc()
+        except Exception as exc:
+            print(f"[upload-gc] errore: {type(exc).__name__}: {exc}")
+
+
+def _start_upload_janitor():
+    if UPLOAD_GC_INTERVAL_S <= 0:
+        return
+    _UPLOAD_GC_STOP.clear()
+    threading.Thread(target=_upload_janitor_loop, name="upload-janitor", daemon=True).start()
+
+
+@app.get("/uploads/gc")
+def upload_gc_stats():
+    return _no_cache({
+        **_UPLOAD_GC_STATS,
+        "config": {
+            "ttl_s": UPLOAD_TTL_S,
+            "quota_bytes": UPLOAD_QUOTA_BYTES,
+            "interval_s": UPLOAD_GC_INTERVAL_S,
+            "min_age_s": UPLOAD_GC_MIN_AGE_S,
+            "dry_run": UPLOAD_GC_DRY_RUN,
+        },
+    })
 
-        rel = viewer_model_path.relative_to(UPLOAD_ROOT).as_posix()
-        return _no_cache({"viewer_url": f"/files/{rel}", "filename": model_path.name})
-    except requests.RequestException as e:
-        raise HTTPException(status_code=502, detail=f"Download fallito: {e}")
+
+@app.post("/uploads/gc")
+def upload_gc_run(dry_run: bool = True):
+    """Esegue subito la pulizia; di default in dry-run (elenca senza cancellare)."""
+    return _no_cache(_run_upload_gc(dry_run=dry_run))
 
 # =========================
 #      SLICER (CuraEngine)
@@ -636,255 +1811,379 @@ def _grams_from_length_mm(length_mm: float, diameter_mm: float, density_g_cm3: f
 def _grams_from_volume_mm3(vol_mm3: float, density_g_cm3: float):
     return (vol_mm3 / 1000.0) * density_g_cm3
 
-# ---- Build volume check ----
-def _is_within_build_volume(gcode_path: Path, max_dim: float = 255.0) -> bool:
+# ---- Tokenizer G-code ----
+#
+# Le righe vengono lette come bytes e spezzate in parole (``G1``, ``X10.5``, …)
+# senza regex né dizionari per riga: l'output degli slicer è separato da spazi,
+# quindi basta ``bytes.split``; le parole "impacchettate" (``G1X10E.4``) vengono
+# espanse solo quando il comando non è nella forma lettera+numero.
+_GCODE_MOVE_CMDS = frozenset({b"G0", b"G1", b"G00", b"G01", b"g0", b"g1", b"g00", b"g01"})
+_GCODE_E_RESET_CMDS = frozenset({b"G92", b"g92"})
+_GCODE_ABSOLUTE_E_CMDS = frozenset({b"M82", b"m82"})
+_GCODE_RELATIVE_E_CMDS = frozenset({b"M83", b"m83"})
+
+
+def _split_packed_word(word: bytes) -> list[bytes]:
+    out: list[bytes] = []
+    start = 0
+    for i in range(1, len(word)):
+        # lettera ASCII (maiuscola o minuscola) = inizio di una nuova parola
+        if 0x61 <= (word[i] | 0x20) <= 0x7A:
+            out.append(word[start:i])
+            start = i
+    out.append(word[start:])
+    return out
+
+
+def _gcode_words(raw: bytes) -> list[bytes]:
     """
-    Parse a G‑code file and check if the printed object's bounding box fits
-    within a cubic build volume of size `max_dim` mm on each axis.  The
-    function scans all G0/G1 moves, tracking the min/max X, Y and Z positions.
-    It ignores moves without coordinates.  Returns True if the object fits
-    within the volume, False otherwise.  Errors in parsing are treated as
-    failing the check, causing the caller to raise an error.
+    Split a raw G‑code line (bytes) into its words, dropping any trailing
+    ``;`` comment.  Returns an empty list for blank and comment-only lines.
     """
-    try:
-        min_pos = {"X": 0.0, "Y": 0.0, "Z": 0.0}
-        max_pos = {"X": 0.0, "Y": 0.0, "Z": 0.0}
-        with open(gcode_path, "r", encoding="utf-8", errors="ignore") as f:
-            for raw in f:
-                if not raw:
-                    continue
-                if raw.lstrip().startswith(";"):
-                    continue
-                line = raw.lstrip()
-                if not (line.startswith("G0") or line.startswith("G1")):
-                    continue
-                coords = re.findall(r"([XYZ])([-+]?\d*\.?\d+)", line)
-                if not coords:
-                    continue
-                for axis, val in coords:
-                    try:
-                        pos = float(val)
-                    except ValueError:
-                        continue
-                    if pos < min_pos[axis]:
-                        min_pos[axis] = pos
-                    if pos > max_pos[axis]:
-                        max_pos[axis] = pos
-        # Compute bounding box dimensions
-        dx = max_pos["X"] - min_pos["X"]
-        dy = max_pos["Y"] - min_pos["Y"]
-        dz = max_pos["Z"] - min_pos["Z"]
-        return dx <= max_dim and dy <= max_dim and dz <= max_dim
-    except Exception:
-        return False
+    cut = raw.find(b";")
+    words = (raw if cut < 0 else raw[:cut]).split()
+    if words:
+        cmd = words[0]
+        if len(cmd) > 2 and not cmd[1:].isdigit():
+            packed: list[bytes] = []
+            for word in words:
+                packed.extend(_split_packed_word(word))
+            return packed
+    return words
+
+
+def _gcode_tool(cmd: bytes) -> int | None:
+    if len(cmd) > 1 and (cmd[0] | 0x20) == 0x74 and cmd[1:].isdigit():
+        return int(cmd[1:])
+    return None
 
-def _analyze_gcode_motion(
-    gcode_path: Path,
-    print_speed: float,
-    travel_speed: float,
-) -> dict | None:
-    try:
-        total_print_dist = 0.0
-        total_travel_dist = 0.0
-        total_print_time = 0.0
-        total_travel_time = 0.0
-        print_moves = 0
-        travel_moves = 0
-        last_pos = {"X": 0.0, "Y": 0.0, "Z": 0.0}
-        last_e = 0.0
-        last_e_valid = False
-        extrusion_relative = False
-        current_feed_mm_s: float | None = None
-        current_feed_from_gcode = False
-        last_print_feed_mm_s = max(1e-3, float(print_speed))
-        last_print_feed_from_gcode = False
-        last_travel_feed_mm_s = max(1e-3, float(travel_speed))
-        last_travel_feed_from_gcode = False
-        print_feed_samples: list[float] = []
-        travel_feed_samples: list[float] = []
-        print_feed_sum = 0.0
-        travel_feed_sum = 0.0
-        print_feed_min = float("inf")
-        print_feed_max = 0.0
-        travel_feed_min = float("inf")
-        travel_feed_max = 0.0
-        used_fallback_print = False
-        used_fallback_travel = False
-        with open(gcode_path, "r", encoding="utf-8", errors="ignore") as f:
-            for raw in f:
-                if not raw:
-                    continue
-                stripped = raw.strip()
-                if not stripped:
-                    continue
-                if stripped.startswith(";"):
-                    continue
-                upper = stripped.upper()
-                if upper.startswith("M82"):
-                    extrusion_relative = False
-                    last_e_valid = False
-                    last_e = 0.0
-                    continue
-                if upper.startswith("M83"):
-                    extrusion_relative = True
-                    last_e_valid = False
-                    last_e = 0.0
-                    continue
-                if upper.startswith("G92"):
-                    m = re.search(r"\bE([-+]?\d*\.?\d+)", stripped, re.IGNORECASE)
-                    if m:
-                        try:
-                            last_e = float(m.group(1))
-                            last_e_valid = True
-                        except ValueError:
-                            pass
-                    continue
-                if not (upper.startswith("G0") or upper.startswith("G1")):
-                    continue
-                coords = re.findall(r"([XYZEF])([-+]?\d*\.?\d+)", stripped, re.IGNORECASE)
-                if not coords:
-                    continue
-                new_pos = dict(last_pos)
-                extruding = False
-                e_value = None
-                e_delta = None
-                feed_value_mm_s = None
-                for axis, val in coords:
-                    axis = axis.upper()
-                    try:
-                        num = float(val)
-                    except ValueError:
-                        continue
-                    if axis in ("X", "Y", "Z"):
-                        new_pos[axis] = num
-                    elif axis == "E":
-                        if extrusion_relative:
-                            e_delta = num
-                        else:
-                            e_value = num
-                    elif axis == "F":
-                        if num > 0:
-                            feed_value_mm_s = num / 60.0
-                if extrusion_relative:
-                    if e_delta is not None:
-                        if e_delta > 1e-6:
-                            extruding = True
-                        elif e_delta < -1e-6:
-                            extruding = False
-                        last_e = (last_e if last_e_valid else 0.0) + e_delta
-                        last_e_valid = True
-                else:
-                    if e_value is not None:
-                        if not last_e_valid:
-                            if e_value > 1e-6:
-                                extruding = True
-                            last_e_valid = True
-                        else:
-                            delta = e_value - last_e
-                            if delta > 1e-6:
-                                extruding = True
-                        last_e = e_value
-                if feed_value_mm_s is not None:
-                    current_feed_mm_s = max(1e-3, feed_value_mm_s)
-                    current_feed_from_gcode = True
-                dx = new_pos["X"] - last_pos["X"]
-                dy = new_pos["Y"] - last_pos["Y"]
-                dz = new_pos["Z"] - last_pos["Z"]
-                dist = math.sqrt(dx * dx + dy * dy + dz * dz)
-                if dist > 0:
-                    if extruding:
-                        if current_feed_mm_s is not None:
-                            feed = max(1e-3, current_feed_mm_s)
-                            from_gcode = current_feed_from_gcode
-                        else:
-                            feed = max(1e-3, last_print_feed_mm_s)
-                            from_gcode = last_print_feed_from_gcode
-                            if not from_gcode:
-                                used_fallback_print = True
-                        total_print_dist += dist
-                        total_print_time += dist / feed
-                        print_moves += 1
-                        if from_gcode:
-                            print_feed_samples.append(feed)
-                            print_feed_sum += feed
-                            if feed < print_feed_min:
-                                print_feed_min = feed
-                            if feed > print_feed_max:
-                                print_feed_max = feed
-                        last_print_feed_mm_s = feed
-                        last_print_feed_from_gcode = from_gcode
-                    else:
-                        if current_feed_mm_s is not None:
-                            feed = max(1e-3, current_feed_mm_s)
-                            from_gcode = current_feed_from_gcode
-                        else:
-                            feed = max(1e-3, last_travel_feed_mm_s)
-                            from_gcode = last_travel_feed_from_gcode
-                            if not from_gcode:
-                                used_fallback_travel = True
-                        total_travel_dist += dist
-                        total_travel_time += dist / feed
-                        travel_moves += 1
-                        if from_gcode:
-                            travel_feed_samples.append(feed)
-                            travel_feed_sum += feed
-                            if feed < travel_feed_min:
-                                travel_feed_min = feed
-                            if feed > travel_feed_max:
-                                travel_feed_max = feed
-                        last_travel_feed_mm_s = feed
-                        last_travel_feed_from_gcode = from_gcode
-                last_pos = new_pos
-                current_feed_mm_s = None
-                current_feed_from_gcode = False
-        if total_print_dist == 0 and total_travel_dist == 0:
-            return {
-                "time_s_estimate": 0.0,
-                "time_s_without_fudge": 0.0,
-                "fudge_factor": 1.2,
-                "print": {
-                    "distance_mm": 0.0,
-                    "moves": 0,
-                    "used_fallback": True,
-                    "fallback_feed_mm_s": max(1e-3, float(print_speed)),
-                },
-                "travel": {
-                    "distance_mm": 0.0,
-                    "moves": 0,
-                    "used_fallback": True,
-                    "fallback_feed_mm_s": max(1e-3, float(travel_speed)),
-                },
-            }
-        time_print = total_print_time if total_print_time > 0 else (total_print_dist / max(1e-3, float(print_speed)))
-        time_travel = total_travel_time if total_travel_time > 0 else (total_travel_dist / max(1e-3, float(travel_speed)))
-        base_time = time_print + time_travel
-        fudge_factor = 1.2
 
-        def _summarize_feed(samples: list[float], feed_sum: float, feed_min: float, feed_max: float):
-            if not samples:
+def _gcode_word_value(words: list[bytes], letter: int) -> float | None:
+    for i in range(1, len(words)):
+        word = words[i]
+        if (word[0] | 0x20) == letter:
+            try:
+                return float(word[1:])
+            except ValueError:
                 return None
-            count = len(samples)
-            avg = feed_sum / count if count else None
-            uniq: list[float] = []
-            seen: set[int] = set()
-            for value in samples:
-                key = int(round(value * 1000))
-                if key in seen:
-                    continue
-                seen.add(key)
-                uniq.append(round(value, 3))
-                if len(uniq) >= 12:
-                    break
-            return {
-                "count": count,
-                "avg": avg,
-                "min": feed_min if feed_min != float("inf") else None,
-                "max": feed_max if feed_max > 0 else None,
-                "samples": uniq,
-            }
+    return None
 
-        return {
-            "time_s_estimate": base_time * fudge_factor,
+
+# Parsing dei movimenti condiviso da _scan_gcode e dal toolpath binario, così
+# le due letture non possono divergere su assi, modalità E e G92.
+def _gcode_move_axes(words: list[bytes]):
+    """Valori X, Y, Z, E, F di un G0/G1 (``None`` per le parole assenti o illeggibili)."""
+    x = y = z = e = f = None
+    for i in range(1, len(words)):
+        word = words[i]
+        axis = word[0] | 0x20
+        if axis < 0x65 or axis > 0x7A or (axis > 0x66 and axis < 0x78):
+            continue
+        try:
+            num = float(word[1:])
+        except ValueError:
+            continue
+        if axis == 0x78:  # x
+            x = num
+        elif axis == 0x79:  # y
+            y = num
+        elif axis == 0x7A:  # z
+            z = num
+        elif axis == 0x65:  # e
+            e = num
+        else:  # f
+            f = num
+    return x, y, z, e, f
+
+
+def _gcode_e_mode(cmd: bytes, words: list[bytes], relative: bool, last_e: float | None):
+    """M82/M83/G92 applicati alla E del moto: ``(relative, last_e)`` aggiornati.
+
+    ``last_e`` è ``None`` quando la posizione E non è nota (inizio file, dopo
+    un cambio di modalità).
+    """
+    if cmd in _GCODE_ABSOLUTE_E_CMDS or cmd in _GCODE_RELATIVE_E_CMDS:
+        return cmd in _GCODE_RELATIVE_E_CMDS, None
+    if cmd in _GCODE_E_RESET_CMDS:
+        value = _gcode_word_value(words, 0x65)
+        if value is not None:
+            return relative, value
+    return relative, last_e
+
+
+def _gcode_extrusion_step(e_num: float, relative: bool, last_e: float | None):
+    """E di un movimento: ``(estrude?, nuova last_e)``; in assoluto con E non
+    nota conta come estrusione qualunque E positiva."""
+    if relative:
+        return e_num > 1e-6, (last_e or 0.0) + e_num
+    return e_num - (last_e or 0.0) > 1e-6, e_num
+
+
+# ---- Analisi G-code (passata singola) ----
+#
+# Il G-code prodotto dallo slicer può pesare centinaia di MB (piatti X1C pieni),
+# quindi tutte le informazioni che servono alla stima (tempo di moto, E per
+# utensile, bounding box, commenti di header/footer e statistiche di feed)
+# vengono raccolte in un'unica lettura bufferizzata a memoria limitata.
+_GCODE_READ_BUFFER = 1 << 20
+_GCODE_HEADER_MAX_LINES = 2000
+_GCODE_FOOTER_MAX_LINES = 1000
+_GCODE_FEED_SAMPLES = 12
+_GCODE_E_JUMP_MAX_MM = 1000.0
+
+
+def _new_feed_stats() -> dict:
+    return {"count": 0, "sum": 0.0, "min": float("inf"), "max": 0.0, "samples": [], "seen": set()}
+
+
+def _record_feed(stats: dict, feed: float) -> None:
+    stats["count"] += 1
+    stats["sum"] += feed
+    if feed < stats["min"]:
+        stats["min"] = feed
+    if feed > stats["max"]:
+        stats["max"] = feed
+    if len(stats["samples"]) < _GCODE_FEED_SAMPLES:
+        key = int(round(feed * 1000))
+        if key not in stats["seen"]:
+            stats["seen"].add(key)
+            stats["samples"].append(round(feed, 3))
+
+
+def _summarize_feed(stats: dict):
+    count = stats["count"]
+    if not count:
+        return None
+    return {
+        "count": count,
+        "avg": stats["sum"] / count,
+        "min": stats["min"] if stats["min"] != float("inf") else None,
+        "max": stats["max"] if stats["max"] > 0 else None,
+        "samples": list(stats["samples"]),
+    }
+
+
+def _scan_gcode(gcode_path: Path, print_speed: float, travel_speed: float) -> dict:
+    """
+    Single buffered pass over a G‑code file.  Collects everything the estimate
+    needs so that the file is never read more than once:
+
+    - ``motion``: print/travel distances and times (same payload previously
+      returned by ``_analyze_gcode_motion``), with bounded feed statistics;
+    - ``extrusion``: E totals per tool (T0, T1, …), honouring M82/M83 and G92;
+    - ``bbox``: min/max of the X/Y/Z coordinates of G0/G1 moves;
+    - ``comments``: header comments (before the first move) and the last
+      footer comments, where the slicers write time and filament usage;
+    - ``layers`` / ``features``: per-layer rows (from ``;LAYER:`` /
+      ``;LAYER_CHANGE`` markers) and per-``;TYPE:`` totals, see
+      ``_gcode_index_from_scan``.
+
+    Lines are tokenized as bytes by ``_gcode_words``; memory stays constant
+    regardless of file size.
+    """
+    print_speed = max(1e-3, float(print_speed))
+    travel_speed = max(1e-3, float(travel_speed))
+
+    total_print_dist = 0.0
+    total_travel_dist = 0.0
+    total_print_time = 0.0
+    total_travel_time = 0.0
+    print_moves = 0
+    travel_moves = 0
+    last_x = last_y = last_z = 0.0
+    last_e = None
+    extrusion_relative = False
+    last_print_feed_mm_s = print_speed
+    last_print_feed_from_gcode = False
+    last_travel_feed_mm_s = travel_speed
+    last_travel_feed_from_gcode = False
+    print_feed = _new_feed_stats()
+    travel_feed = _new_feed_stats()
+    used_fallback_print = False
+    used_fallback_travel = False
+
+    current_tool = 0
+    tool_totals: dict[int, float] = {0: 0.0}
+    tool_last_e: dict[int, float | None] = {0: None}
+
+    inf = float("inf")
+    min_x = min_y = min_z = inf
+    max_x = max_y = max_z = -inf
+
+    header: list[bytes] = []
+    footer: deque[bytes] = deque(maxlen=_GCODE_FOOTER_MAX_LINES)
+    in_header = True
+    line_count = 0
+
+    # layer e feature: al marker si fotografano i totali cumulativi, le righe
+    # sono differenze tra fotografie (nessun costo in più per movimento)
+    layer_rows: list[tuple] = []
+    layer_start = None
+    layer_z = None
+    last_extrude_z = 0.0
+    features: dict[str, list[float]] = {}
+    feature = None
+    feature_start = None
+
+    with open(gcode_path, "rb", buffering=_GCODE_READ_BUFFER) as f:
+        for raw in f:
+            line_count += 1
+            words = _gcode_words(raw)
+            if not words:
+                cut = raw.find(b";")
+                if cut >= 0:
+                    comment = raw[cut:].strip()
+                    if in_header and len(header) < _GCODE_HEADER_MAX_LINES:
+                        header.append(comment)
+                    else:
+                        footer.append(comment)
+                    if comment.startswith(_GCODE_INDEX_MARKERS):
+                        snap = (total_print_time + total_travel_time, sum(tool_totals.values()),
+                                total_travel_dist, total_print_dist)
+                        if comment.startswith(b";TYPE:"):
+                            if feature is not None:
+                                _accumulate_feature(features, feature, feature_start, snap)
+                            feature = comment[6:].strip().decode("utf-8", errors="ignore")
+                            feature_start = snap
+                        elif comment.startswith(b";Z:"):
+                            try:
+                                layer_z = float(comment[3:])
+                            except ValueError:
+                                pass
+                        else:
+                            if layer_start is not None:
+                                layer_rows.append(_layer_row(layer_z, last_extrude_z, layer_start, snap))
+                            layer_start = snap
+                            layer_z = None
+                continue
+            cmd = words[0]
+            if cmd not in _GCODE_MOVE_CMDS:
+                tool = _gcode_tool(cmd)
+                if tool is not None:
+                    current_tool = tool
+                    tool_totals.setdefault(current_tool, 0.0)
+                    tool_last_e.setdefault(current_tool, None)
+                elif cmd in _GCODE_ABSOLUTE_E_CMDS or cmd in _GCODE_RELATIVE_E_CMDS:
+                    extrusion_relative, last_e = _gcode_e_mode(cmd, words, extrusion_relative, last_e)
+                    tool_last_e[current_tool] = None
+                elif cmd in _GCODE_E_RESET_CMDS:
+                    extrusion_relative, last_e = _gcode_e_mode(cmd, words, extrusion_relative, last_e)
+                    value = _gcode_word_value(words, 0x65)
+                    if value is not None:
+                        tool_last_e[current_tool] = None if extrusion_relative else value
+                continue
+
+            x, y, z, e_num, f_num = _gcode_move_axes(words)
+            if x is None and y is None and z is None and e_num is None and f_num is None:
+                continue
+            new_x, new_y, new_z = last_x, last_y, last_z
+            if x is not None:
+                new_x = x
+                if x < min_x:
+                    min_x = x
+                if x > max_x:
+                    max_x = x
+            if y is not None:
+                new_y = y
+                if y < min_y:
+                    min_y = y
+                if y > max_y:
+                    max_y = y
+            if z is not None:
+                new_z = z
+                if z < min_z:
+                    min_z = z
+                if z > max_z:
+                    max_z = z
+            feed_value_mm_s = f_num / 60.0 if f_num is not None and f_num > 0 else None
+            in_header = False
+            extruding = False
+
+            # E totals per tool (retractions and implausible jumps are ignored)
+            if e_num is not None:
+                if extrusion_relative:
+                    if 0 < e_num <= _GCODE_E_JUMP_MAX_MM:
+                        tool_totals[current_tool] = tool_totals.get(current_tool, 0.0) + e_num
+                else:
+                    prev = tool_last_e.get(current_tool)
+                    tool_last_e[current_tool] = e_num
+                    if prev is not None:
+                        diff = e_num - prev
+                        if 0 < diff <= _GCODE_E_JUMP_MAX_MM:
+                            tool_totals[current_tool] = tool_totals.get(current_tool, 0.0) + diff
+                extruding, last_e = _gcode_extrusion_step(e_num, extrusion_relative, last_e)
+            current_feed_mm_s = max(1e-3, feed_value_mm_s) if feed_value_mm_s is not None else None
+            dx = new_x - last_x
+            dy = new_y - last_y
+            dz = new_z - last_z
+            dist = math.sqrt(dx * dx + dy * dy + dz * dz)
+            if dist > 0:
+                if extruding:
+                    if current_feed_mm_s is not None:
+                        feed = current_feed_mm_s
+                        from_gcode = True
+                    else:
+                        feed = max(1e-3, last_print_feed_mm_s)
+                        from_gcode = last_print_feed_from_gcode
+                        if not from_gcode:
+                            used_fallback_print = True
+                    total_print_dist += dist
+                    total_print_time += dist / feed
+                    print_moves += 1
+                    last_extrude_z = new_z
+                    if from_gcode:
+                        _record_feed(print_feed, feed)
+                    last_print_feed_mm_s = feed
+                    last_print_feed_from_gcode = from_gcode
+                else:
+                    if current_feed_mm_s is not None:
+                        feed = current_feed_mm_s
+                        from_gcode = True
+                    else:
+                        feed = max(1e-3, last_travel_feed_mm_s)
+                        from_gcode = last_travel_feed_from_gcode
+                        if not from_gcode:
+                            used_fallback_travel = True
+                    total_travel_dist += dist
+                    total_travel_time += dist / feed
+                    travel_moves += 1
+                    if from_gcode:
+                        _record_feed(travel_feed, feed)
+                    last_travel_feed_mm_s = feed
+                    last_travel_feed_from_gcode = from_gcode
+            last_x, last_y, last_z = new_x, new_y, new_z
+
+    snap = (total_print_time + total_travel_time, sum(tool_totals.values()), total_travel_dist, total_print_dist)
+    if layer_start is not None:
+        layer_rows.append(_layer_row(layer_z, last_extrude_z, layer_start, snap))
+    if feature is not None:
+        _accumulate_feature(features, feature, feature_start, snap)
+
+    if total_print_dist == 0 and total_travel_dist == 0:
+        motion = {
+            "time_s_estimate": 0.0,
+            "time_s_without_fudge": 0.0,
+            "fudge_factor": 1.2,
+            "print": {
+                "distance_mm": 0.0,
+                "moves": 0,
+                "used_fallback": True,
+                "fallback_feed_mm_s": print_speed,
+            },
+            "travel": {
+                "distance_mm": 0.0,
+                "moves": 0,
+                "used_fallback": True,
+                "fallback_feed_mm_s": travel_speed,
+            },
+        }
+    else:
+        time_print = total_print_time if total_print_time > 0 else (total_print_dist / print_speed)
+        time_travel = total_travel_time if total_travel_time > 0 else (total_travel_dist / travel_speed)
+        base_time = time_print + time_travel
+        fudge_factor = 1.2
+        motion = {
+            "time_s_estimate": base_time * fudge_factor,
             "time_s_without_fudge": base_time,
             "fudge_factor": fudge_factor,
             "print": {
@@ -893,8 +2192,8 @@ def _analyze_gcode_motion(
                 "time_s_raw": total_print_time,
                 "time_s_effective": time_print,
                 "used_fallback": used_fallback_print or total_print_time <= 0,
-                "fallback_feed_mm_s": max(1e-3, float(print_speed)),
-                "gcode_feed": _summarize_feed(print_feed_samples, print_feed_sum, print_feed_min, print_feed_max),
+                "fallback_feed_mm_s": print_speed,
+                "gcode_feed": _summarize_feed(print_feed),
                 "effective_feed_mm_s": (total_print_dist / time_print) if time_print > 0 else None,
             },
             "travel": {
@@ -903,11 +2202,297 @@ def _analyze_gcode_motion(
                 "time_s_raw": total_travel_time,
                 "time_s_effective": time_travel,
                 "used_fallback": used_fallback_travel or total_travel_time <= 0,
-                "fallback_feed_mm_s": max(1e-3, float(travel_speed)),
-                "gcode_feed": _summarize_feed(travel_feed_samples, travel_feed_sum, travel_feed_min, travel_feed_max),
+                "fallback_feed_mm_s": travel_speed,
+                "gcode_feed": _summarize_feed(travel_feed),
                 "effective_feed_mm_s": (total_travel_dist / time_travel) if time_travel > 0 else None,
             },
         }
+
+    return {
+        "motion": motion,
+        "extrusion": {
+            "per_tool_mm": {tool: total for tool, total in sorted(tool_totals.items()) if total > 0},
+            "total_mm": sum(tool_totals.values()),
+        },
+        "bbox": _bbox_from_extremes(min_x, min_y, min_z, max_x, max_y, max_z),
+        "layers": layer_rows,
+        "features": features,
+        "comments": {
+            "header": [c.decode("utf-8", errors="ignore") for c in header],
+            "footer": [c.decode("utf-8", errors="ignore") for c in footer],
+        },
+        "lines": line_count,
+    }
+
+
+_GCODE_INDEX_MARKERS = (b";LAYER:", b";LAYER_CHANGE", b";TYPE:", b";Z:")
+
+
+def _layer_row(marker_z, extrude_z, start: tuple, end: tuple) -> tuple:
+    """(z, tempo, mm estrusi, mm di travel) di un layer dai totali cumulativi."""
+    z = marker_z if marker_z is not None else extrude_z
+    return (z, end[0] - start[0], end[1] - start[1], end[2] - start[2])
+
+
+def _accumulate_feature(features: dict, name: str, start: tuple, end: tuple) -> None:
+    acc = features.get(name)
+    if acc is None:
+        acc = features[name] = [0.0, 0.0, 0.0, 0.0]
+    for i in range(4):
+        acc[i] += end[i] - start[i]
+
+
+def _bbox_from_extremes(min_x, min_y, min_z, max_x, max_y, max_z) -> dict | None:
+    bbox_min: dict[str, float] = {}
+    bbox_max: dict[str, float] = {}
+    for axis, lo, hi in (("X", min_x, max_x), ("Y", min_y, max_y), ("Z", min_z, max_z)):
+        if lo <= hi:
+            bbox_min[axis] = lo
+            bbox_max[axis] = hi
+    return {"min": bbox_min, "max": bbox_max} if bbox_min else None
+
+
+def _gcode_comment_text(scan: dict) -> str:
+    comments = scan.get("comments") or {}
+    return "\n".join(list(comments.get("header") or []) + list(comments.get("footer") or []))
+
+
+# ---- Build volume check ----
+# Prima dello slicing: le dimensioni della mesh ruotata (AABB dai vertici di
+# STL/OBJ/3MF con la matrice di _parse_rotation_from_settings) vengono
+# confrontate con il volume di stampa della definizione Cura della macchina,
+# così un modello troppo grande fallisce in millisecondi senza occupare
+# CuraEngine. Dopo lo slicing resta il controllo sul bounding box del G-code,
+# con le stesse dimensioni macchina.
+BUILD_VOLUME_DEFAULT_MM = (255.0, 255.0, 255.0)
+_BUILD_VOLUME_KEYS = ("machine_width", "machine_depth", "machine_height")
+_BUILD_VOLUME_TOLERANCE_MM = 0.01
+_MESH_READ_TRIANGLES = 1 << 16
+
+
+def _machine_definitions(machine: str) -> tuple[Path, Path]:
+    # Choose machine definitions based on the selected machine. Fall back to the generic
+    # FDM definitions if the requested machine definition is missing. The available
+    # machines include "generic" (default) and "bambu_x1c". Additional machines can
+    # be added by placing matching `<machine>.def.json` and `<machine>_extruder_0.def.json`
+    # files under /api/cura_defs.
+    if machine == "bambu_x1c":
+        return Path("/api/cura_defs/bambu_x1c.def.json"), Path("/api/cura_defs/bambu_x1c_extruder_0.def.json")
+    return Path("/api/cura_defs/fdmprinter.def.json"), Path("/api/cura_defs/fdmextruder.def.json")
+
+
+def _find_setting_default(tree: dict, key: str):
+    """Cerca ``key`` nell'albero "settings" di una definizione Cura."""
+    for name, node in tree.items():
+        if not isinstance(node, dict):
+            continue
+        if name == key:
+            return node.get("default_value")
+        found = _find_setting_default(node.get("children") or {}, key)
+        if found is not None:
+            return found
+    return None
+
+
+def _definition_value(def_path: Path, key: str, depth: int = 0):
+    try:
+        data = json.loads(def_path.read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return None
+    override = (data.get("overrides") or {}).get(key) or {}
+    for field in ("default_value", "value"):
+        value = override.get(field)
+        if isinstance(value, (int, float)):
+            return float(value)
+    value = _find_setting_default(data.get("settings") or {}, key)
+    if isinstance(value, (int, float)):
+        return float(value)
+    parent = data.get("inherits")
+    if parent and depth < 8:
+        return _definition_value(def_path.with_name(f"{parent}.def.json"), key, depth + 1)
+    return None
+
+
+@lru_cache(maxsize=16)
+def _load_build_volume(def_path: str, mtime_ns: int) -> tuple[float, float, float]:
+    dims = []
+    for key, default in zip(_BUILD_VOLUME_KEYS, BUILD_VOLUME_DEFAULT_MM):
+        value = _definition_value(Path(def_path), key)
+        dims.append(value if value and value > 0 else default)
+    return tuple(dims)
+
+
+def _machine_build_volume(machine: str) -> tuple[float, float, float]:
+    printer_def, _ = _machine_definitions(machine)
+    try:
+        return _load_build_volume(str(printer_def), printer_def.stat().st_mtime_ns)
+    except OSError:
+        return BUILD_VOLUME_DEFAULT_MM
+
+
+def _iter_mesh_vertex_blocks(model_path: Path):
+    """Vertici del modello a blocchi di tuple ``(x, y, z)`` (o array Nx3 con NumPy).
+
+    Restituisce ``None`` per i formati di cui non si leggono i vertici (STEP).
+    """
+    ext = model_path.suffix.lower()
+    if ext == ".stl":
+        return _iter_stl_vertex_blocks(model_path)
+    if ext == ".obj":
+        return _iter_text_vertex_blocks(model_path, b"v ")
+    if ext == ".3mf":
+        return _iter_3mf_vertex_blocks(model_path)
+    return None
+
+
+def _iter_stl_vertex_blocks(model_path: Path):
+    layout = _stl_layout(model_path)
+    if layout is None:
+        return
+    if layout[0] == "ascii":
+        yield from _iter_text_vertex_blocks(model_path, b"vertex")
+        return
+    records = _stl_records(model_path)
+    if records is not None:
+        # blocchi della vista su mmap: memoria limitata anche per file enormi
+        vertices = records["v"]
+        for start in range(0, len(vertices), _MESH_READ_TRIANGLES):
+            yield vertices[start:start + _MESH_READ_TRIANGLES].reshape(-1, 3)
+        return
+    count = layout[1]
+    with open(model_path, "rb") as f:
+        f.seek(84)
+        while count > 0:
+            n = min(count, _MESH_READ_TRIANGLES)
+            data = f.read(n * 50)
+            count -= n
+            block = []
+            for rec in struct.iter_unpack("<12fH", data):
+                block.extend((rec[3:6], rec[6:9], rec[9:12]))
+            yield block
+
+
+def _iter_text_vertex_blocks(model_path: Path, prefix: bytes):
+    block = []
+    with open(model_path, "rb") as f:
+        for line in f:
+            line = line.lstrip()
+            if line.startswith(prefix):
+                parts = line.split()
+                block.append((float(parts[1]), float(parts[2]), float(parts[3])))
+                if len(block) >= _MESH_READ_TRIANGLES:
+                    yield block
+                    block = []
+    if block:
+        yield block
+
+
+def _iter_3mf_vertex_blocks(model_path: Path):
+    block = []
+    with zipfile.ZipFile(model_path) as z:
+        for name in z.namelist():
+            if not name.lower().endswith(".model"):
+                continue
+            with z.open(name) as src:
+                for _, el in ET.iterparse(src):
+                    if el.tag.endswith("}vertex"):
+                        block.append((float(el.get("x")), float(el.get("y")), float(el.get("z"))))
+                        if len(block) >= _MESH_READ_TRIANGLES:
+                            yield block
+                            block = []
+                    el.clear()
+    if block:
+        yield block
+
+
+def _rotated_mesh_size(model_path: Path, rot_matrix) -> tuple[float, float, float] | None:
+    """Dimensioni X/Y/Z dell'AABB della mesh ruotata, ``None`` se non calcolabili."""
+    blocks = _iter_mesh_vertex_blocks(model_path)
+    if blocks is None:
+        return None
+    R = rot_matrix or _identity3()
+    lo = [math.inf] * 3
+    hi = [-math.inf] * 3
+    try:
+        for block in blocks:
+            if _np is not None:
+                pts = _np.asarray(block, dtype=_np.float64)
+                if not len(pts):
+                    continue
+                rotated = pts @ _np.asarray(R, dtype=_np.float64).T
+                bmin, bmax = rotated.min(axis=0), rotated.max(axis=0)
+                for i in range(3):
+                    lo[i] = min(lo[i], float(bmin[i]))
+                    hi[i] = max(hi[i], float(bmax[i]))
+                continue
+            r0, r1, r2 = R
+            for x, y, z in block:
+                for i, row in enumerate((r0, r1, r2)):
+                    v = row[0] * x + row[1] * y + row[2] * z
+                    if v < lo[i]:
+                        lo[i] = v
+                    if v > hi[i]:
+                        hi[i] = v
+    except (OSError, ValueError, IndexError, struct.error, zipfile.BadZipFile, ET.ParseError):
+        return None
+    if lo[0] > hi[0]:
+        return None
+    return (hi[0] - lo[0], hi[1] - lo[1], hi[2] - lo[2])
+
+
+def _fmt_dims(dims) -> str:
+    return "×".join(f"{d:.0f}" for d in dims)
+
+
+def _check_mesh_fits_build_volume(model_path: Path, rot_matrix, volume) -> dict | None:
+    """Solleva 400 se la mesh ruotata non entra nel volume di stampa."""
+    size = _rotated_mesh_size(model_path, rot_matrix)
+    if size is None:
+        return None
+    if any(d > v + _BUILD_VOLUME_TOLERANCE_MM for d, v in zip(size, volume)):
+        raise HTTPException(
+            status_code=400,
+            detail=f"Il modello ({_fmt_dims(size)} mm) non entra nel piano di stampa ({_fmt_dims(volume)} mm).",
+        )
+    return {"size_mm": [round(d, 2) for d in size], "build_volume_mm": list(volume)}
+
+
+def _bbox_within_build_volume(bbox: dict | None, max_dim=255.0) -> bool:
+    """
+    Check whether the bounding box collected by ``_scan_gcode`` fits within the
+    build volume: ``max_dim`` is either a cube edge or a ``(x, y, z)`` tuple in
+    mm.  Only the extent of the box is compared, wherever the slicer placed it.
+    """
+    if not bbox:
+        return True
+    dims = max_dim if isinstance(max_dim, (tuple, list)) else (max_dim,) * 3
+    for axis, limit in zip(("X", "Y", "Z"), dims):
+        lo = bbox["min"].get(axis)
+        hi = bbox["max"].get(axis)
+        if lo is not None and hi is not None and hi - lo > limit + _BUILD_VOLUME_TOLERANCE_MM:
+            return False
+    return True
+
+
+def _is_within_build_volume(gcode_path: Path, max_dim=255.0) -> bool:
+    """
+    Parse a G‑code file and check if the printed object's bounding box fits
+    within the build volume (see ``_bbox_within_build_volume``).  Errors in
+    parsing are treated as failing the check, causing the caller to raise an
+    error.
+    """
+    try:
+        return _bbox_within_build_volume(_scan_gcode(gcode_path, 60, 150)["bbox"], max_dim)
+    except Exception:
+        return False
+
+def _analyze_gcode_motion(
+    gcode_path: Path,
+    print_speed: float,
+    travel_speed: float,
+) -> dict | None:
+    try:
+        return _scan_gcode(gcode_path, print_speed, travel_speed)["motion"]
     except Exception as exc:
         return {"error": f"{type(exc).__name__}: {exc}"}
 
@@ -997,69 +2582,150 @@ def _parse_cura_filament_usage(text: str, diameter_mm: float, density_g_cm3: flo
 def _estimate_filament_length_from_gcode(gcode_path: Path) -> float:
     """
     Estimate the total extruded filament length (in millimetres) by summing E‑axis moves
-    in the G‑code.  This parser handles multi‑extruder and multi‑colour prints by
-    tracking extrusion separately per active tool (T0, T1, …).  For each tool it
-    assumes absolute extrusion mode and resets the E position on explicit resets
-    (G92 or M92 with E0).  Negative movements (retractions) and very large jumps
-    are ignored to avoid overcounting.  Returns the sum of all extruded lengths.
+    in the G‑code.  Extrusion is tracked separately per active tool (T0, T1, …) by
+    ``_scan_gcode``; retractions and very large jumps are ignored to avoid overcounting.
+    Returns the sum of all extruded lengths.
     """
     try:
-        text = gcode_path.read_text(errors="ignore")
+        return float(_scan_gcode(gcode_path, 60, 150)["extrusion"]["total_mm"])
     except Exception:
         return 0.0
-    # track total extrusion per tool
-    totals: dict[int, float] = {}
-    # remember last E coordinate per tool
-    last_e: dict[int, float] = {}
-    current_tool = 0
-    for raw in text.splitlines():
-        line = raw.strip()
-        if not line:
-            continue
-        # Skip full comment lines
-        if line.startswith(";"):
-            continue
-        # Detect tool change commands (e.g. T0, T1, T2)
-        # Only consider tool change if the line starts with 'T' followed by digits
-        if line.startswith("T") and len(line) > 1 and line[1].isdigit():
-            try:
-                current_tool = int(re.match(r"T(\d+)", line).group(1))
-            except Exception:
-                current_tool = 0
-            # Ensure structures exist for the new tool
-            totals.setdefault(current_tool, 0.0)
-            last_e.setdefault(current_tool, None)
-            continue
-        # Reset extruder position for current tool
-        # G92 E0 or M92 E0 resets the E axis
-        if ("G92" in line or "M92" in line) and (" E0" in line or " E0.0" in line):
-            last_e[current_tool] = 0.0
+
+# ---- Cache slicing (content-addressed) ----
+#
+# Il G-code dipende solo dal modello e dai parametri di slicing, non dal colore o dal
+# prezzo della bobina: l'output di CuraEngine e le metriche lette dal G-code vengono
+# salvati in UPLOAD_ROOT/_slice_cache/<sha256> e riusati.  Eviction LRU (mtime di
+# meta.json aggiornato a ogni hit) con limiti su byte totali e numero di voci.
+SLICE_CACHE_ROOT = UPLOAD_ROOT / "_slice_cache"
+SLICE_CACHE_MAX_BYTES = int(os.getenv("SLICE_CACHE_MAX_BYTES", str(5 * 1024 ** 3)))
+SLICE_CACHE_MAX_ENTRIES = int(os.getenv("SLICE_CACHE_MAX_ENTRIES", "500"))
+_SLICE_CACHE_VERSION = 1
+_SLICE_CACHE_LOCK = threading.Lock()
+_FILE_HASHES: dict[tuple[str, int, int], str] = {}
+
+
+def _sha256_file(path: Path) -> str:
+    st = path.stat()
+    memo_key = (str(path.resolve()), st.st_size, st.st_mtime_ns)
+    cached = _FILE_HASHES.get(memo_key)
+    if cached:
+        return cached
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    if len(_FILE_HASHES) >= 1024:
+        _FILE_HASHES.clear()
+    _FILE_HASHES[memo_key] = digest.hexdigest()
+    return _FILE_HASHES[memo_key]
+
+
+def _remember_file_hash(path: Path, value: str):
+    # hash già calcolato durante l'upload: lo slicing non rilegge il file
+    st = path.stat()
+    if len(_FILE_HASHES) >= 1024:
+        _FILE_HASHES.clear()
+    _FILE_HASHES[(str(path.resolve()), st.st_size, st.st_mtime_ns)] = value
+
+
+def _slice_cache_key(model_path: Path, cura_args: list[str]) -> str:
+    digest = hashlib.sha256()
+    digest.update(f"v{_SLICE_CACHE_VERSION} cura {_cura_version()}\n".encode())
+    digest.update(b"model:" + _sha256_file(model_path).encode())
+    skip_next = False
+    for arg in cura_args:
+        if skip_next:
+            skip_next = False
             continue
-        # Find E axis value
-        m = re.search(r"E([+-]?\d*\.\d+|[+-]?\d+)", line)
-        if not m:
+        if arg in ("-l", "-o"):
+            # percorsi di input/output: il contenuto del modello è già nella chiave
+            skip_next = True
             continue
+        digest.update(b"\n" + str(arg).encode("utf-8"))
+        if arg.endswith(".def.json") and Path(arg).exists():
+            digest.update(b":" + _sha256_file(Path(arg)).encode())
+    return digest.hexdigest()
+
+
+def _slice_cache_load(key: str) -> dict | None:
+    if SLICE_CACHE_MAX_ENTRIES <= 0:
+        return None
+    entry = SLICE_CACHE_ROOT / key
+    meta_path = entry / "meta.json"
+    try:
+        meta = json.loads(meta_path.read_text(encoding="utf-8"))
+        if not (UPLOAD_ROOT / meta["gcode_rel"]).is_file():
+            return None
+        os.utime(meta_path)
+    except Exception:
+        return None
+    return meta
+
+
+def _slice_cache_store(key: str, gcode_path: Path, result: dict) -> dict:
+    """
+    Move the freshly sliced G‑code into the cache entry and persist the parsed
+    result next to it.  Returns the result with ``gcode_rel`` pointing at the
+    cached copy (or unchanged if the cache is disabled/unwritable).
+    """
+    if SLICE_CACHE_MAX_ENTRIES <= 0:
+        return result
+    entry = SLICE_CACHE_ROOT / key
+    try:
+        SLICE_CACHE_ROOT.mkdir(parents=True, exist_ok=True)
+        tmp = SLICE_CACHE_ROOT / f".{key[:16]}-{uuid.uuid4().hex[:8]}"
+        tmp.mkdir()
+        cached = dict(result)
+        cached["gcode_rel"] = (entry / gcode_path.name).relative_to(UPLOAD_ROOT).as_posix()
+        shutil.move(str(gcode_path), str(tmp / gcode_path.name))
+        (tmp / "meta.json").write_text(json.dumps(cached), encoding="utf-8")
         try:
-            e_val = float(m.group(1))
-        except ValueError:
-            continue
-        # Initialise last_e for this tool if not seen before
-        if current_tool not in last_e or last_e[current_tool] is None:
-            last_e[current_tool] = e_val
-            continue
-        diff = e_val - last_e[current_tool]
-        # treat retracts or unusual jumps as zero to avoid overcounting
-        if diff < 0 or diff > 1000:
-            diff = 0.0
-        totals[current_tool] = totals.get(current_tool, 0.0) + diff
-        last_e[current_tool] = e_val
-    # Sum across all tools
-    return sum(totals.values())
+            tmp.rename(entry)
+        except OSError:
+            # stessa chiave già salvata da un'altra richiesta: si usa la sua
+            # voce (il nostro G-code ha un nome diverso e viene scartato)
+            existing = _slice_cache_load(key)
+            if existing is None:
+                shutil.move(str(tmp / gcode_path.name), str(gcode_path))
+            shutil.rmtree(tmp, ignore_errors=True)
+            return existing or result
+    except Exception as exc:
+        print(f"[slice-cache] scrittura fallita: {type(exc).__name__}: {exc}")
+        return result
+    _slice_cache_evict()
+    return cached
+
+
+def _slice_cache_evict() -> None:
+    with _SLICE_CACHE_LOCK:
+        if not SLICE_CACHE_ROOT.is_dir():
+            return
+        entries = []
+        total = 0
+        for entry in SLICE_CACHE_ROOT.iterdir():
+            meta_path = entry / "meta.json"
+            if entry.name.startswith(".") or not meta_path.is_file():
+                continue
+            try:
+                size = sum(p.stat().st_size for p in entry.iterdir())
+                entries.append((meta_path.stat().st_mtime, size, entry))
+            except OSError:
+                continue
+            total += size
+        entries.sort()
+        while entries and (total > SLICE_CACHE_MAX_BYTES or len(entries) > SLICE_CACHE_MAX_ENTRIES):
+            _, size, entry = entries.pop(0)
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+
 
 def _run_cura_slice(model_path: Path, layer_h=0.2, infill=15, nozzle=0.4,
                     filament_diam=1.75, travel_speed=150, print_speed=60,
                     rot_matrix=None, machine: str = "generic"):
-    out_gcode = model_path.with_suffix(".gcode")
+    # nome unico per slicing: le parti di un batch (o due richieste sullo stesso
+    # modello) non si sovrascrivono né si spostano a vicenda il G-code
+    out_gcode = model_path.with_name(f"{model_path.stem}-{uuid.uuid4().hex[:8]}.gcode")
 
     # ---------------------------------------------------------------------
     # Pre‑process input models that CuraEngine cannot slice directly.
@@ -1096,17 +2762,7 @@ def _run_cura_slice(model_path: Path, layer_h=0.2, infill=15, nozzle=0.4,
     if rot_matrix is None:
         rot_matrix = _identity3()
 
-    # Choose machine definitions based on the selected machine. Fall back to the generic
-    # FDM definitions if the requested machine definition is missing. The available
-    # machines include "generic" (default) and "bambu_x1c". Additional machines can
-    # be added by placing matching `<machine>.def.json` and `<machine>_extruder_0.def.json`
-    # files under /api/cura_defs.
-    if machine == "bambu_x1c":
-        printer_def = Path("/api/cura_defs/bambu_x1c.def.json")
-        extruder_def = Path("/api/cura_defs/bambu_x1c_extruder_0.def.json")
-    else:
-        printer_def = Path("/api/cura_defs/fdmprinter.def.json")
-        extruder_def = Path("/api/cura_defs/fdmextruder.def.json")
+    printer_def, extruder_def = _machine_definitions(machine)
 
     cura_args = ["CuraEngine", "slice"]
 
@@ -1132,11 +2788,20 @@ def _run_cura_slice(model_path: Path, layer_h=0.2, infill=15, nozzle=0.4,
     if _cura_supports_mesh_rotation():
         cura_args += ["-s", f"mesh_rotation_matrix={json.dumps(rot_matrix)}"]
 
+    cache_key = _slice_cache_key(model_to_slice, cura_args)
+    cached = _slice_cache_load(cache_key)
+    if cached is not None:
+        cached.setdefault("debug", {})["cache"] = {"key": cache_key, "hit": True}
+        return cached
+
     cp = subprocess.run(cura_args, capture_output=True, text=True, timeout=180)
     if cp.returncode != 0:
         raise HTTPException(status_code=500, detail=f"CuraEngine error:\n{cp.stderr or cp.stdout}")
 
-    text = out_gcode.read_text(errors="ignore")
+    # unica passata sul G-code: moto, E per utensile, bounding box, commenti e layer
+    scan = _scan_gcode(out_gcode, print_speed, travel_speed)
+    index = _gcode_index_from_scan(scan)
+    text = _gcode_comment_text(scan)
 
     # parse tempo
     m_time = re.search(r";TIME:(\d+)", text)
@@ -1173,13 +2838,17 @@ def _run_cura_slice(model_path: Path, layer_h=0.2, infill=15, nozzle=0.4,
         }
     }
 
-    return {
+    result = _slice_cache_store(cache_key, out_gcode, {
         "time_s": time_s,
         "filament_mm": filament_mm,
         "filament_g": filament_g,
         "gcode_rel": out_gcode.relative_to(UPLOAD_ROOT).as_posix(),
+        "scan": scan,
         "debug": debug_payload,
-    }
+    })
+    _write_gcode_index(UPLOAD_ROOT / result["gcode_rel"], index)
+    result["debug"]["cache"] = {"key": cache_key, "hit": False}
+    return result
 
 def _slice_estimate(payload: dict) -> JSONResponse:
     """
@@ -1196,25 +2865,35 @@ def _slice_estimate(payload: dict) -> JSONResponse:
       }
     }
     """
-    viewer_url = payload.get("viewer_url")
-    inv_key = payload.get("inventory_key")
     settings = payload.get("settings") or {}
+    model_path = _model_path_from_viewer_url(payload.get("viewer_url"))
+    bucket = _inventory_bucket(payload.get("inventory_key"))
+    return _no_cache(_estimate_model(model_path, bucket, settings, payload.get("machine")))
 
+
+def _model_path_from_viewer_url(viewer_url) -> Path:
     if not viewer_url or not viewer_url.startswith("/files/"):
         raise HTTPException(status_code=400, detail="viewer_url non valido")
     rel = viewer_url[len("/files/"):]
     model_path = UPLOAD_ROOT / rel
     if not model_path.exists():
         raise HTTPException(status_code=404, detail="Modello non trovato")
+    _touch_upload(model_path)
+    return model_path
 
-    items = _build_inventory_items()
-    bucket = next((x for x in items if x["key"] == inv_key), None)
+
+def _inventory_bucket(inv_key) -> dict:
+    bucket = _find_inventory_item(inv_key)
     if not bucket:
         raise HTTPException(status_code=400, detail="inventory_key non valido")
-    price_per_kg = bucket.get("price_per_kg")
-    if price_per_kg is None:
+    if bucket.get("price_per_kg") is None:
         raise HTTPException(status_code=400, detail="Prezzo €/kg non disponibile per il materiale scelto")
+    return bucket
+
 
+def _estimate_model(model_path: Path, bucket: dict, settings: dict, machine=None) -> dict:
+    """Slicing + costi di un singolo modello; restituisce il dict della risposta."""
+    price_per_kg = bucket.get("price_per_kg")
     mat = bucket.get("material") or "PLA"
     diam = bucket.get("diameter_mm") or 1.75
 
@@ -1225,12 +2904,18 @@ def _slice_estimate(payload: dict) -> JSONResponse:
     travel_speed = float(settings.get("travel_speed", 150)) # mm/s
 
     # Select machine type: if provided in settings or top level payload, use it.
-    machine = (settings.get("machine") or payload.get("machine") or "generic").strip().lower()
+    machine = (settings.get("machine") or machine or "generic").strip().lower()
+    rot_matrix = _parse_rotation_from_settings(settings)
+    build_volume = _machine_build_volume(machine)
+    # controllo sul piano prima di occupare CuraEngine (la rotazione conta solo se Cura la applica)
+    fit = _check_mesh_fits_build_volume(
+        model_path, rot_matrix if _cura_supports_mesh_rotation() else None, build_volume
+    )
     r = _run_cura_slice(
         model_path=model_path,
         layer_h=layer_h, infill=infill, nozzle=nozzle,
         filament_diam=diam, travel_speed=travel_speed, print_speed=print_speed,
-        rot_matrix=_parse_rotation_from_settings(settings),
+        rot_matrix=rot_matrix,
         machine=machine
     )
 
@@ -1251,25 +2936,18 @@ def _slice_estimate(payload: dict) -> JSONResponse:
         debug_payload.update(base_debug)
 
     gcode_rel = r["gcode_rel"]
-    gcode_path = UPLOAD_ROOT / gcode_rel
+    scan = r.get("scan") or {}
     time_s = None
-    motion_analysis = None
-    motion_debug = None
-    try:
-        motion_analysis = _analyze_gcode_motion(gcode_path, print_speed, travel_speed)
-        if motion_analysis and isinstance(motion_analysis, dict):
-            motion_debug = motion_analysis
-            est = motion_analysis.get("time_s_estimate")
-            if est is not None:
-                try:
-                    est_val = float(est)
-                except Exception:
-                    est_val = 0.0
-                if est_val > 0:
-                    time_s = int(est_val)
-    except Exception as exc:
-        motion_debug = {"error": f"{type(exc).__name__}: {exc}"}
-        motion_analysis = None
+    motion_debug = scan.get("motion")
+    if isinstance(motion_debug, dict):
+        est = motion_debug.get("time_s_estimate")
+        if est is not None:
+            try:
+                est_val = float(est)
+            except Exception:
+                est_val = 0.0
+            if est_val > 0:
+                time_s = int(est_val)
     if time_s is None or time_s == 0:
         # Use CuraEngine's time if available and non‑zero, otherwise zero
         ce_time = r.get("time_s")
@@ -1282,26 +2960,13 @@ def _slice_estimate(payload: dict) -> JSONResponse:
     filament_g = r["filament_g"]
     filament_mm = r["filament_mm"]
 
-    if filament_g is None and filament_mm is None:
-        # tentativo extra: cerca solo volume nel testo (alcune build lo mettono tardi)
-        g2, mm2 = _parse_cura_filament_usage(
-            text=(UPLOAD_ROOT / r["gcode_rel"]).read_text(errors="ignore"),
-            diameter_mm=diam, density_g_cm3=density
-        )
-        filament_g = g2 if g2 is not None else filament_g
-        filament_mm = mm2 if mm2 is not None else filament_mm
-
     if filament_g is None and filament_mm is not None:
         filament_g = _grams_from_length_mm(filament_mm, diam, density)
 
     if filament_g is None:
-        # Attempt a more expensive fallback by summing E‑axis moves in the generated G‑code.
-        # This covers cases where CuraEngine omits the "Filament used" comments entirely.
-        try:
-            gcode_path = UPLOAD_ROOT / r["gcode_rel"]
-            est_len_mm = _estimate_filament_length_from_gcode(gcode_path)
-        except Exception:
-            est_len_mm = 0.0
+        # Fallback: somma dei movimenti E per utensile raccolti durante la stessa passata.
+        # Copre i casi in cui CuraEngine omette del tutto i commenti "Filament used".
+        est_len_mm = float((scan.get("extrusion") or {}).get("total_mm") or 0.0)
         if est_len_mm > 0:
             filament_g = _grams_from_length_mm(est_len_mm, diam, density)
         if filament_g is None:
@@ -1310,21 +2975,20 @@ def _slice_estimate(payload: dict) -> JSONResponse:
     cost_filament = (filament_g/1000.0) * float(price_per_kg)
     cost_machine  = (time_s/3600.0) * HOURLY_RATE
     total = cost_filament + cost_machine
-    # Check whether the sliced model fits within the build volume (255 mm on each axis)
-    try:
-        gcode_path = UPLOAD_ROOT / r["gcode_rel"]
-        if not _is_within_build_volume(gcode_path, 255.0):
-            raise HTTPException(status_code=400, detail="Il modello non entra nel piano di stampa (255×255×255 mm).")
-    except HTTPException:
-        raise
-    except Exception:
-        # If the check fails unexpectedly, let it continue; slicing may still succeed
-        pass
+    # Check whether the sliced model fits within the machine's build volume
+    if not _bbox_within_build_volume(scan.get("bbox"), build_volume):
+        raise HTTPException(
+            status_code=400,
+            detail=f"Il modello non entra nel piano di stampa ({_fmt_dims(build_volume)} mm).",
+        )
+    if fit:
+        debug_payload["build_volume"] = fit
 
     if motion_debug:
         debug_payload.setdefault("motion", motion_debug)
 
     response = {
+        "estimate_id": _remember_estimate(filament_g, time_s, mat, price_per_kg),
         "time_s": round(time_s),
         "filament_g": round(filament_g, 1),
         "price_per_kg": round(float(price_per_kg), 2),
@@ -1333,11 +2997,13 @@ def _slice_estimate(payload: dict) -> JSONResponse:
         "cost_filament": round(cost_filament, 2),
         "cost_machine": round(cost_machine, 2),
         "total": round(total, 2),
-        "gcode_url": f"/files/{gcode_rel}"
+        "gcode_url": f"/files/{gcode_rel}",
+        "layers_url": f"/gcode/layers?gcode_url={quote('/files/' + gcode_rel)}",
+        "toolpath_url": f"/gcode/toolpath?gcode_url={quote('/files/' + gcode_rel)}",
     }
     if debug_payload:
         response["debug"] = debug_payload
-    return _no_cache(response)
+    return response
 
 
 @app.post("/slice/estimate")
@@ -1368,3 +3034,515 @@ def slice_estimate_info():
             },
         },
     })
+
+
+# ---- Indice per layer / feature del G-code ----
+# La stessa passata di _scan_gcode produce un indice colonnare (una riga per
+# layer: Z, tempo, mm estrusi, mm di travel) e i totali per tipo di feature
+# (commenti ;TYPE: di Cura e PrusaSlicer). L'indice viene salvato accanto al
+# G-code (anche nella cache degli slicing) e servito paginato da
+# /gcode/layers, così la UI può disegnare l'istogramma dei tempi per layer
+# senza scaricare il G-code e le richieste successive non lo rileggono.
+_GCODE_INDEX_VERSION = 1
+GCODE_LAYERS_PAGE_MAX = 5000
+
+
+def _gcode_index_path(gcode_path: Path) -> Path:
+    return gcode_path.with_suffix(".layers.json")
+
+
+def _gcode_index_from_scan(scan: dict) -> dict:
+    """Toglie layer e feature dal risultato di ``_scan_gcode`` e li rende colonnari.
+
+    I tempi sono scalati con lo stesso fattore della stima, così la somma dei
+    layer coincide con ``time_s_estimate``.
+    """
+    fudge = float((scan.get("motion") or {}).get("fudge_factor") or 1.0)
+    rows = scan.pop("layers", None) or []
+    features = scan.pop("features", None) or {}
+    return {
+        "version": _GCODE_INDEX_VERSION,
+        "layers": {
+            "z": [round(r[0], 3) for r in rows],
+            "time_s": [round(r[1] * fudge, 2) for r in rows],
+            "extruded_mm": [round(r[2], 2) for r in rows],
+            "travel_mm": [round(r[3], 2) for r in rows],
+        },
+        "features": {
+            name: {
+                "time_s": round(acc[0] * fudge, 2),
+                "extruded_mm": round(acc[1], 2),
+                "travel_mm": round(acc[2], 2),
+                "print_mm": round(acc[3], 2),
+            }
+            for name, acc in features.items()
+        },
+    }
+
+
+def _write_gcode_index(gcode_path: Path, index: dict) -> None:
+    target = _gcode_index_path(gcode_path)
+    try:
+        tmp = target.with_name(f".{target.name}.{uuid.uuid4().hex[:8]}")
+        tmp.write_text(json.dumps(index, separators=(",", ":")), encoding="utf-8")
+        os.replace(tmp, target)
+    except OSError as exc:
+        print(f"[gcode-index] scrittura fallita: {type(exc).__name__}: {exc}")
+
+
+def _load_gcode_index(gcode_path: Path) -> dict:
+    try:
+        index = json.loads(_gcode_index_path(gcode_path).read_text(encoding="utf-8"))
+        if index.get("version") == _GCODE_INDEX_VERSION:
+            return index
+    except (OSError, ValueError):
+        pass
+    # G-code precedente all'indice (o indice illeggibile): si ricostruisce una volta
+    index = _gcode_index_from_scan(_scan_gcode(gcode_path, 60, 150))
+    _write_gcode_index(gcode_path, index)
+    return index
+
+
+def _gcode_path_from_url(gcode_url: str) -> Path:
+    if not gcode_url.startswith("/files/") or not gcode_url.endswith(".gcode"):
+        raise HTTPException(status_code=400, detail="gcode_url non valido")
+    gcode_path = (UPLOAD_ROOT / gcode_url[len("/files/"):]).resolve()
+    if UPLOAD_ROOT.resolve() not in gcode_path.parents or not gcode_path.is_file():
+        raise HTTPException(status_code=404, detail="G-code non trovato")
+    return gcode_path
+
+
+@app.get("/gcode/layers")
+@app.get("/api/gcode/layers")
+def gcode_layers(gcode_url: str, offset: int = 0, limit: int = 500):
+    """Statistiche per layer (paginate) e per feature di un G-code prodotto da /slice/estimate."""
+    gcode_path = _gcode_path_from_url(gcode_url)
+    offset = max(0, offset)
+    limit = max(1, min(limit, GCODE_LAYERS_PAGE_MAX))
+
+    index = _load_gcode_index(gcode_path)
+    layers = index["layers"]
+    total = len(layers["z"])
+    page = {col: values[offset:offset + limit] for col, values in layers.items()}
+    return _no_cache({
+        "gcode_url": gcode_url,
+        "total": total,
+        "offset": offset,
+        "limit": limit,
+        "next_offset": offset + limit if offset + limit < total else None,
+        "layers": page,
+        "features": index["features"],
+        "totals": {
+            "layers": total,
+            "time_s": round(sum(layers["time_s"]), 2),
+            "extruded_mm": round(sum(layers["extruded_mm"]), 2),
+            "travel_mm": round(sum(layers["travel_mm"]), 2),
+        },
+    })
+
+
+# ---- Toolpath binario per layer ----
+# Per disegnare il percorso utensile senza scaricare il G-code (anche 400 MB)
+# il file viene convertito una volta in segmenti binari raggruppati per layer
+# (stessi marker e stessa numerazione di /gcode/layers) e salvato accanto al
+# G-code. Ogni layer è un blocco little-endian allineato a 4 byte:
+#   uint32 segmenti n, float32 z,
+#   float32[6n] (x0 y0 z0 x1 y1 z1 per segmento),
+#   uint8[n] feature del segmento, padding a 4 byte.
+# La feature 0 è il travel, 1 l'estrusione prima di qualunque ;TYPE:, le
+# altre sono i ;TYPE: in ordine di apparizione. /gcode/toolpath/data
+# restituisce i blocchi di un intervallo di layer, pagina per pagina.
+_TOOLPATH_VERSION = 1
+TOOLPATH_PAGE_MAX_BYTES = max(1 << 16, int(os.getenv("TOOLPATH_PAGE_MAX_BYTES", str(8 << 20))))
+_TOOLPATH_LAYER_HEADER = struct.Struct("<If")
+_TOOLPATH_FEATURE_MAX = 255
+# senza marker di layer il G-code viene spezzato in blocchi di questa misura
+_TOOLPATH_CHUNK_SEGMENTS = 1 << 18
+
+
+def _toolpath_paths(gcode_path: Path) -> tuple[Path, Path]:
+    return gcode_path.with_suffix(".toolpath.bin"), gcode_path.with_suffix(".toolpath.json")
+
+
+def _build_gcode_toolpath(gcode_path: Path, data_path: Path) -> dict:
+    """Scrive i segmenti per layer in ``data_path`` e restituisce l'indice dei blocchi."""
+    offsets = [0]
+    layer_z_values: list[float] = []
+    layer_segments: list[int] = []
+    names = ["travel", "extrude"]
+    feature_ids: dict[str, int] = {}
+    coords = array("f")
+    kinds = bytearray()
+    feature = 1
+    markers = False
+    layer_z = None
+    last_extrude_z = 0.0
+    last_x = last_y = last_z = 0.0
+    last_e = None
+    extrusion_relative = False
+
+    tmp = data_path.with_name(f".{data_path.name}.{uuid.uuid4().hex[:8]}")
+    with open(gcode_path, "rb", buffering=_GCODE_READ_BUFFER) as f, open(tmp, "wb") as out:
+
+        def flush():
+            n = len(kinds)
+            z = layer_z if layer_z is not None else last_extrude_z
+            pad = b"\0" * (-n % 4)
+            out.write(_TOOLPATH_LAYER_HEADER.pack(n, z))
+            out.write(coords.tobytes())
+            out.write(kinds + pad)
+            offsets.append(offsets[-1] + _TOOLPATH_LAYER_HEADER.size + 25 * n + len(pad))
+            layer_z_values.append(round(z, 3))
+            layer_segments.append(n)
+            del coords[:]
+            kinds.clear()
+
+        for raw in f:
+            words = _gcode_words(raw)
+            if not words:
+                cut = raw.find(b";")
+                if cut < 0:
+                    continue
+                comment = raw[cut:].strip()
+                if comment.startswith(b";TYPE:"):
+                    name = comment[6:].strip().decode("utf-8", errors="ignore")
+                    feature = feature_ids.get(name)
+                    if feature is None:
+                        feature = min(len(names), _TOOLPATH_FEATURE_MAX)
+                        if len(names) <= _TOOLPATH_FEATURE_MAX:
+                            names.append(name)
+                        feature_ids[name] = feature
+                elif comment.startswith(b";Z:"):
+                    try:
+                        layer_z = float(comment[3:])
+                    except ValueError:
+                        pass
+                elif comment.startswith((b";LAYER:", b";LAYER_CHANGE")):
+                    if markers:
+                        flush()
+                    else:
+                        # primo marker: lo start G-code (e i blocchi provvisori) si scarta
+                        out.seek(0)
+                        out.truncate()
+                        del offsets[1:], layer_z_values[:], layer_segments[:], coords[:]
+                        kinds.clear()
+                        markers = True
+                    layer_z = None
+                continue
+            cmd = words[0]
+            if cmd not in _GCODE_MOVE_CMDS:
+                extrusion_relative, last_e = _gcode_e_mode(cmd, words, extrusion_relative, last_e)
+                continue
+
+            x, y, z, e_num, _ = _gcode_move_axes(words)
+            x = last_x if x is None else x
+            y = last_y if y is None else y
+            z = last_z if z is None else z
+            extruding = False
+            if e_num is not None:
+                extruding, last_e = _gcode_extrusion_step(e_num, extrusion_relative, last_e)
+            if x != last_x or y != last_y or z != last_z:
+                coords.extend((last_x, last_y, last_z, x, y, z))
+                kinds.append(feature if extruding else 0)
+                if extruding:
+                    last_extrude_z = z
+                if not markers and len(kinds) >= _TOOLPATH_CHUNK_SEGMENTS:
+                    flush()
+            last_x, last_y, last_z = x, y, z
+
+        if markers or kinds:
+            flush()
+    os.replace(tmp, data_path)
+    return {
+        "version": _TOOLPATH_VERSION,
+        "features": names,
+        "layers": {"z": layer_z_values, "segments": layer_segments, "offset": offsets},
+    }
+
+
+def _load_gcode_toolpath(gcode_path: Path) -> dict:
+    data_path, index_path = _toolpath_paths(gcode_path)
+    with _derived_file_lock(index_path):
+        try:
+            index = json.loads(index_path.read_text(encoding="utf-8"))
+            if index.get("version") == _TOOLPATH_VERSION and data_path.is_file():
+                return index
+        except (OSError, ValueError):
+            pass
+        t0 = time.perf_counter()
+        index = _build_gcode_toolpath(gcode_path, data_path)
+        try:
+            tmp = index_path.with_name(f".{index_path.name}.{uuid.uuid4().hex[:8]}")
+            tmp.write_text(json.dumps(index, separators=(",", ":")), encoding="utf-8")
+            os.replace(tmp, index_path)
+        except OSError as exc:
+            print(f"[toolpath] scrittura indice fallita: {type(exc).__name__}: {exc}")
+        print(f"[toolpath] {gcode_path.name}: {len(index['layers']['z'])} layer, "
+              f"{sum(index['layers']['segments'])} segmenti in {time.perf_counter() - t0:.2f}s")
+        return index
+
+
+@app.get("/gcode/toolpath")
+@app.get("/api/gcode/toolpath")
+def gcode_toolpath(gcode_url: str):
+    """Indice del toolpath binario: Z e segmenti per layer, nomi delle feature, URL dei dati."""
+    gcode_path = _gcode_path_from_url(gcode_url)
+    index = _load_gcode_toolpath(gcode_path)
+    layers = index["layers"]
+    return _no_cache({
+        "gcode_url": gcode_url,
+        "total": len(layers["z"]),
+        "bytes": layers["offset"][-1],
+        "features": index["features"],
+        "layers": {"z": layers["z"], "segments": layers["segments"]},
+        "format": {
+            "byte_order": "little",
+            "layer_header": "uint32 segments, float32 z",
+            "segments": "float32[6*segments] x0 y0 z0 x1 y1 z1",
+            "features": "uint8[segments], padding a 4 byte",
+        },
+        "data_url": f"/gcode/toolpath/data?gcode_url={quote(gcode_url)}",
+        "page_max_bytes": TOOLPATH_PAGE_MAX_BYTES,
+    })
+
+
+@app.get("/gcode/toolpath/data")
+@app.get("/api/gcode/toolpath/data")
+def gcode_toolpath_data(gcode_url: str, offset: int = 0, limit: int = 50):
+    """Blocchi binari dei layer ``[offset, offset + limit)``, al massimo TOOLPATH_PAGE_MAX_BYTES
+    (almeno un layer); ``X-Toolpath-Next-Offset`` indica da dove riprendere."""
+    gcode_path = _gcode_path_from_url(gcode_url)
+    index = _load_gcode_toolpath(gcode_path)
+    starts = index["layers"]["offset"]
+    total = len(starts) - 1
+    offset = max(0, min(offset, total))
+    end = min(total, offset + max(1, limit))
+    # si taglia la pagina al limite di byte, tenendo sempre almeno un layer
+    fits = bisect.bisect_right(starts, starts[offset] + TOOLPATH_PAGE_MAX_BYTES) - 1
+    end = max(min(end, fits), min(total, offset + 1))
+    data_path, _ = _toolpath_paths(gcode_path)
+    with open(data_path, "rb") as f:
+        f.seek(starts[offset])
+        data = f.read(starts[end] - starts[offset])
+    return Response(content=data, media_type="application/octet-stream", headers={
+        "Cache-Control": "no-store",
+        "X-Toolpath-Offset": str(offset),
+        "X-Toolpath-Count": str(end - offset),
+        "X-Toolpath-Next-Offset": str(end) if end < total else "",
+    })
+
+
+# ---- Stima multi-modello (batch) ----
+# Un kit (ZIP con N parti, o più upload) si quota con una sola richiesta: le
+# parti vengono slicate in parallelo su un pool dedicato e si restituiscono le
+# stime per parte più i totali. Ogni parte passa dalla cache degli slicing,
+# quindi ripetere la quota di un kit con gli stessi parametri è immediato.
+SLICE_BATCH_WORKERS = max(1, int(os.getenv("SLICE_BATCH_WORKERS", str(min(4, os.cpu_count() or 1)))))
+SLICE_BATCH_MAX_MODELS = max(1, int(os.getenv("SLICE_BATCH_MAX_MODELS", "24")))
+_SLICE_BATCH_POOL = ThreadPoolExecutor(max_workers=SLICE_BATCH_WORKERS, thread_name_prefix="slice-batch")
+
+
+def _model_store_all_models(model_path: Path) -> list[Path]:
+    """Tutti i modelli dell'upload che contiene ``model_path``.
+
+    Per uno ZIP estrae (una volta sola, nella directory dell'archivio) anche
+    le parti che l'upload aveva lasciato compresse.
+    """
+    try:
+        rel = model_path.resolve().relative_to(MODEL_STORE_ROOT.resolve())
+    except ValueError:
+        raise HTTPException(status_code=400, detail="all_models richiede un modello caricato nell'archivio")
+    store = MODEL_STORE_ROOT / rel.parts[0]
+    meta = _model_store_load(store)
+    if meta is None:
+        raise HTTPException(status_code=404, detail="Modello non trovato")
+    # una parte per percorso senza estensione: part.stl e part.3mf nella stessa
+    # cartella sono lo stesso pezzo (vince il formato preferito da
+    # MODEL_EXT_ORDER), left/bracket.stl e right/bracket.stl no
+    parts = {}
+
+    def part_key(path: Path) -> str:
+        return path.relative_to(store).with_suffix("").as_posix().lower()
+
+    def better(path: Path) -> bool:
+        best = parts.get(part_key(path))
+        return best is None or _model_ext_rank(path) < _model_ext_rank(best)
+
+    model = store / meta["model"]
+    parts[part_key(model)] = model
+    names = [meta.get("source")] + [n for n in meta.get("files") or [] if n != meta.get("source")]
+    with _MODEL_STORE_LOCK:
+        for name in names:
+            path = store / name if name else None
+            if path is None or not path.is_file():
+                continue
+            if path.suffix.lower() in MODEL_EXT_ORDER:
+                if better(path):
+                    parts[part_key(path)] = path
+            elif path.suffix.lower() == ".zip":
+                try:
+                    with zipfile.ZipFile(path) as z:
+                        for info in _zip_rank_models(z):
+                            target = store.joinpath(*_zip_member_parts(info.filename))
+                            if not better(target):
+                                continue
+                            # il tetto conta le parti distinte: si smette di estrarre quando è pieno
+                            if part_key(target) not in parts and len(parts) >= SLICE_BATCH_MAX_MODELS:
+                                continue
+                            if not target.exists():
+                                target = _zip_extract_member(z, info, store)
+                            parts[part_key(target)] = target
+                except (zipfile.BadZipFile, zipfile.LargeZipFile, NotImplementedError) as e:
+                    raise HTTPException(status_code=400, detail=f"ZIP non valido: {e}")
+    return list(parts.values())[:SLICE_BATCH_MAX_MODELS]
+
+
+def _estimate_part(model_path: Path, bucket: dict, settings: dict, machine):
+    rel = model_path.relative_to(UPLOAD_ROOT).as_posix()
+    part = {"viewer_url": f"/files/{rel}", "name": model_path.name}
+    try:
+        part.update(_estimate_model(model_path, bucket, settings, machine))
+        part["ok"] = True
+    except HTTPException as e:
+        part.update(ok=False, status_code=e.status_code, error=e.detail)
+    except Exception as e:
+        part.update(ok=False, status_code=500, error=f"{type(e).__name__}: {e}")
+    return part
+
+
+def _slice_estimate_batch(payload: dict) -> JSONResponse:
+    """
+    Richiede:
+    {
+      "viewer_urls": ["/files/<modello1>", "/files/<modello2>", ...],
+      # oppure tutti i modelli dell'upload che contiene viewer_url:
+      "viewer_url": "/files/<modello>", "all_models": true,
+      "inventory_key": "<chiave di /inventory>",
+      "settings": { ... come /slice/estimate ... }
+    }
+    """
+    settings = payload.get("settings") or {}
+    urls = payload.get("viewer_urls")
+    if payload.get("all_models"):
+        paths = _model_store_all_models(_model_path_from_viewer_url(payload.get("viewer_url")))
+    else:
+        if not isinstance(urls, list) or not urls:
+            raise HTTPException(status_code=400, detail="viewer_urls mancante")
+        if len(urls) > SLICE_BATCH_MAX_MODELS:
+            raise HTTPException(status_code=400, detail=f"Troppi modelli (max {SLICE_BATCH_MAX_MODELS})")
+        # stesso modello ripetuto: uno slicing solo, altrimenti verrebbe quotato due volte
+        paths = list(dict.fromkeys(_model_path_from_viewer_url(u) for u in urls))
+    bucket = _inventory_bucket(payload.get("inventory_key"))
+    machine = payload.get("machine")
+
+    futures = [_SLICE_BATCH_POOL.submit(_estimate_part, p, bucket, settings, machine) for p in paths]
+    parts = [f.result() for f in futures]
+    done = [p for p in parts if p["ok"]]
+    if not done:
+        first = parts[0]
+        raise HTTPException(status_code=first["status_code"], detail=first["error"])
+
+    cost_filament = sum(p["cost_filament"] for p in done)
+    cost_machine = sum(p["cost_machine"] for p in done)
+    return _no_cache({
+        "parts": parts,
+        "total": {
+            "parts": len(done),
+            "failed": len(parts) - len(done),
+            "time_s": sum(p["time_s"] for p in done),
+            "filament_g": round(sum(p["filament_g"] for p in done), 1),
+            "price_per_kg": round(float(bucket["price_per_kg"]), 2),
+            "hourly_rate": HOURLY_RATE,
+            "currency": CURRENCY,
+            "cost_filament": round(cost_filament, 2),
+            "cost_machine": round(cost_machine, 2),
+            "total": round(cost_filament + cost_machine, 2),
+        },
+    })
+
+
+@app.post("/slice/estimate/batch")
+def slice_estimate_batch(payload: dict = Body(...)):
+    return _slice_estimate_batch(payload)
+
+
+@app.post("/api/slice/estimate/batch")
+def slice_estimate_batch_prefixed(payload: dict = Body(...)):
+    return _slice_estimate_batch(payload)
+
+
+# ---- Ricalcolo costi senza re-slicing ----
+# Cambiare solo bobina o tariffa oraria non richiede un nuovo slicing: ogni
+# stima registra grammi, tempo e materiale sotto un estimate_id e
+# POST /slice/recost ricalcola i costi da quelli. Tra materiali diversi il
+# volume estruso non cambia, quindi i grammi si scalano con le densità.
+ESTIMATE_STORE_MAX = max(1, int(os.getenv("ESTIMATE_STORE_MAX", "2000")))
+_ESTIMATES = OrderedDict()
+_ESTIMATES_LOCK = threading.Lock()
+
+
+def _remember_estimate(filament_g, time_s, material, price_per_kg) -> str:
+    estimate_id = uuid.uuid4().hex
+    with _ESTIMATES_LOCK:
+        _ESTIMATES[estimate_id] = {
+            "filament_g": filament_g,
+            "time_s": time_s,
+            "material": material,
+            "price_per_kg": price_per_kg,
+        }
+        while len(_ESTIMATES) > ESTIMATE_STORE_MAX:
+            _ESTIMATES.popitem(last=False)
+    return estimate_id
+
+
+def _slice_recost(payload: dict) -> JSONResponse:
+    """
+    Richiede:
+    {
+      "estimate_id": "<id restituito da /slice/estimate>",
+      "inventory_key": "<nuova chiave di /inventory>",   # opzionale
+      "hourly_rate": 1.5                                  # opzionale
+    }
+    """
+    estimate_id = str(payload.get("estimate_id") or "")
+    with _ESTIMATES_LOCK:
+        entry = _ESTIMATES.get(estimate_id)
+        if entry is not None:
+            _ESTIMATES.move_to_end(estimate_id)
+    if entry is None:
+        raise HTTPException(status_code=404, detail="estimate_id sconosciuto o scaduto: ripeti la stima")
+
+    mat = entry["material"]
+    price_per_kg = entry["price_per_kg"]
+    filament_g = entry["filament_g"]
+    if payload.get("inventory_key"):
+        bucket = _inventory_bucket(payload.get("inventory_key"))
+        price_per_kg = bucket["price_per_kg"]
+        mat = bucket.get("material") or "PLA"
+        filament_g = filament_g * _density_for(mat) / _density_for(entry["material"])
+    hourly_rate = float(payload["hourly_rate"]) if payload.get("hourly_rate") is not None else HOURLY_RATE
+
+    cost_filament = (filament_g/1000.0) * float(price_per_kg)
+    cost_machine = (entry["time_s"]/3600.0) * hourly_rate
+    return _no_cache({
+        "estimate_id": estimate_id,
+        "material": mat,
+        "time_s": round(entry["time_s"]),
+        "filament_g": round(filament_g, 1),
+        "price_per_kg": round(float(price_per_kg), 2),
+        "hourly_rate": hourly_rate,
+        "currency": CURRENCY,
+        "cost_filament": round(cost_filament, 2),
+        "cost_machine": round(cost_machine, 2),
+        "total": round(cost_filament + cost_machine, 2),
+    })
+
+
+@app.post("/slice/recost")
+def slice_recost(payload: dict = Body(...)):
+    return _slice_recost(payload)
+
+
+@app.post("/api/slice/recost")
+def slice_recost_prefixed(payload: dict = Body(...)):
+    return _slice_recost(payload)
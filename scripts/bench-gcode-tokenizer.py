@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+"""Benchmark dell'analisi G-code: codice di partenza vs codice attuale.
+
+Confronta, sullo stesso file:
+- ``api/main.py``: ``_analyze_gcode_motion`` (+ ``_estimate_filament_length_from_gcode``,
+  seconda passata) del commit di partenza con ``_scan_gcode`` di oggi;
+- ``services/slicer-api/slice_api.py``: ``_estimate_filament_length_from_gcode_text``
+  del commit di partenza con quella di oggi.
+
+Le funzioni "prima" vengono lette con ``git show <baseline>:<file>``, quelle
+"dopo" dai file del working tree. Dei moduli si eseguono solo le funzioni
+richieste e le costanti/import da cui dipendono: le app FastAPI non vengono
+importate (niente directory create né mount), quindi basta la libreria standard.
+
+Uso (dalla root del repository, serve la history git):
+    python scripts/bench-gcode-tokenizer.py                # file sintetico da 3M righe
+    python scripts/bench-gcode-tokenizer.py --lines 5000000
+    python scripts/bench-gcode-tokenizer.py --gcode piatto.gcode
+    python scripts/bench-gcode-tokenizer.py --baseline <commit>
+"""
+import argparse
+import ast
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+MAIN_PY = "api/main.py"
+SLICE_API_PY = "services/slicer-api/slice_api.py"
+# ultimo commit prima della riscrittura del parser (passata singola + tokenizer bytes)
+DEFAULT_BASELINE = "087c7c1"
+
+
+def _read_source(rel_path: str, rev: str | None) -> str:
+    if rev is None:
+        return (REPO_ROOT / rel_path).read_text(encoding="utf-8")
+    return subprocess.run(
+        ["git", "show", f"{rev}:{rel_path}"],
+        cwd=REPO_ROOT,
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout
+
+
+def _bound_names(node: ast.stmt) -> set[str]:
+    if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+        return {node.name}
+    if isinstance(node, (ast.Import, ast.ImportFrom)):
+        return {(alias.asname or alias.name).split(".")[0] for alias in node.names}
+    targets = node.targets if isinstance(node, ast.Assign) else [node.target]
+    return {n.id for t in targets for n in ast.walk(t) if isinstance(n, ast.Name)}
+
+
+def _load_functions(source: str, filename: str, names: list[str]) -> dict:
+    """Esegue solo ``names`` (e le definizioni top-level che usano) da ``source``."""
+    tree = ast.parse(source, filename)
+    providers: dict[str, ast.stmt] = {}
+    for node in tree.body:
+        if isinstance(
+            node,
+            (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef, ast.Import, ast.ImportFrom, ast.Assign, ast.AnnAssign),
+        ):
+            for name in _bound_names(node):
+                providers[name] = node
+
+    selected: list[ast.stmt] = []
+    pending = list(names)
+    while pending:
+        node = providers.get(pending.pop())
+        if node is None or any(node is seen for seen in selected):
+            continue
+        selected.append(node)
+        pending.extend(n.id for n in ast.walk(node) if isinstance(n, ast.Name))
+
+    order = {id(node): i for i, node in enumerate(tree.body)}
+    module = ast.Module(body=sorted(selected, key=lambda node: order[id(node)]), type_ignores=[])
+    namespace: dict = {"__name__": f"bench:{filename}"}
+    exec(compile(module, filename, "exec"), namespace)
+    missing = [name for name in names if name not in namespace]
+    if missing:
+        raise SystemExit(f"{filename}: funzioni non trovate: {', '.join(missing)}")
+    return namespace
+
+
+def _write_synthetic_gcode(path: str, lines: int) -> None:
+    rnd = random.Random(42)
+    e = 0.0
+    with open(path, "w", encoding="utf-8") as out:
+        out.write("; generated by bench-gcode-tokenizer\nM82\nG92 E0\n")
+        written = 3
+        layer = 0
+        while written < lines:
+            layer += 1
+            out.write(f";LAYER_CHANGE\n;Z:{layer * 0.2:.2f}\nG1 Z{layer * 0.2:.2f} F720\n;TYPE:Perimeter\n")
+            written += 4
+            for i in range(min(2000, lines - written)):
+                x, y = rnd.uniform(0, 250), rnd.uniform(0, 250)
+                if i % 10 == 9:
+                    out.write(f"G0 F9000 X{x:.3f} Y{y:.3f}\n")
+                else:
+                    e += rnd.uniform(0.01, 0.2)
+                    out.write(f"G1 F1800 X{x:.3f} Y{y:.3f} E{e:.5f}\n")
+                written += 1
+
+
+def _run(label: str, fn, repeat: int) -> float:
+    best = float("inf")
+    value = None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        value = fn()
+        best = min(best, time.perf_counter() - t0)
+    print(f"{label:<46} {best:8.3f} s   {value}")
+    return best
+
+
+def _motion_summary(motion: dict | None) -> str:
+    if not motion:
+        return "-"
+    return f"stampa {motion['print']['distance_mm']:.1f} mm, spostamenti {motion['travel']['distance_mm']:.1f} mm"
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--gcode", help="file G-code da usare (default: sintetico)")
+    parser.add_argument("--lines", type=int, default=3_000_000, help="righe del file sintetico")
+    parser.add_argument("--repeat", type=int, default=3, help="ripetizioni (si tiene la migliore)")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE, help="commit con il codice di partenza")
+    args = parser.parse_args()
+
+    before_main = _load_functions(
+        _read_source(MAIN_PY, args.baseline),
+        MAIN_PY,
+        ["_analyze_gcode_motion", "_estimate_filament_length_from_gcode"],
+    )
+    after_main = _load_functions(_read_source(MAIN_PY, None), MAIN_PY, ["_scan_gcode"])
+    before_sa = _load_functions(
+        _read_source(SLICE_API_PY, args.baseline), SLICE_API_PY, ["_estimate_filament_length_from_gcode_text"]
+    )
+    after_sa = _load_functions(
+        _read_source(SLICE_API_PY, None), SLICE_API_PY, ["_estimate_filament_length_from_gcode_text"]
+    )
+
+    tmp = None
+    path = args.gcode
+    if not path:
+        fd, tmp = tempfile.mkstemp(suffix=".gcode")
+        os.close(fd)
+        _write_synthetic_gcode(tmp, args.lines)
+        path = tmp
+    try:
+        gcode_path = Path(path)
+        text = gcode_path.read_text(encoding="utf-8", errors="ignore")
+        print(f"{path}: {text.count(chr(10))} righe, baseline {args.baseline}\n")
+
+        motion_before = _run(
+            "main moto: _analyze_gcode_motion (prima)",
+            lambda: _motion_summary(before_main["_analyze_gcode_motion"](gcode_path, 60, 150)),
+            args.repeat,
+        )
+        both_before = _run(
+            "main moto + E: due passate (prima)",
+            lambda: (
+                _motion_summary(before_main["_analyze_gcode_motion"](gcode_path, 60, 150)),
+                round(before_main["_estimate_filament_length_from_gcode"](gcode_path), 1),
+            ),
+            args.repeat,
+        )
+        scan_after = _run(
+            "main moto + E: _scan_gcode (dopo)",
+            lambda: (
+                _motion_summary((scan := after_main["_scan_gcode"](gcode_path, 60, 150))["motion"]),
+                round(scan["extrusion"]["total_mm"], 1),
+            ),
+            args.repeat,
+        )
+        print(f"speedup solo moto: {motion_before / scan_after:.2f}x, moto + E: {both_before / scan_after:.2f}x\n")
+
+        e_before = _run(
+            "slicer-api E: regex per riga (prima)",
+            lambda: round(before_sa["_estimate_filament_length_from_gcode_text"](text), 1),
+            args.repeat,
+        )
+        e_after = _run(
+            "slicer-api E: tokenizer bytes (dopo)",
+            lambda: round(after_sa["_estimate_filament_length_from_gcode_text"](text), 1),
+            args.repeat,
+        )
+        print(f"speedup E: {e_before / e_after:.2f}x")
+    finally:
+        if tmp:
+            os.unlink(tmp)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
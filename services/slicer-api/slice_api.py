@@ -1,11 +1,27 @@
-from fastapi import FastAPI, File, UploadFile, Form, HTTPException, Body
-from fastapi.responses import PlainTextResponse, RedirectResponse, JSONResponse
+from fastapi import FastAPI, File, UploadFile, Form, HTTPException, Body, Request
+from fastapi.responses import PlainTextResponse, RedirectResponse, JSONResponse, StreamingResponse, FileResponse
+from starlette.background import BackgroundTask
 from fastapi.staticfiles import StaticFiles
-import os, tempfile, subprocess, re, colorsys, json, threading, uuid, math, shutil, shlex, logging
+import os, io, tempfile, subprocess, re, colorsys, json, threading, uuid, math, shutil, shlex, logging, hashlib, asyncio, time, zlib, zipfile
+import xml.etree.ElementTree as ET
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
 from pathlib import Path
 import httpx
 
-app = FastAPI(title="slicer-api", version="0.9.0")
+@asynccontextmanager
+async def _lifespan(app):
+    # sonda Spoolman una volta all'avvio, così la prima richiesta trova già l'endpoint
+    warmup = asyncio.create_task(_warm_spoolman_discovery())
+    janitor = asyncio.create_task(_upload_janitor_loop()) if UPLOAD_GC_INTERVAL_S > 0 else None
+    yield
+    warmup.cancel()
+    if janitor is not None:
+        janitor.cancel()
+    await _close_http_clients()
+
+
+app = FastAPI(title="slicer-api", version="0.9.0", lifespan=_lifespan)
 
 # ---------- UI ----------
 app.mount("/ui", StaticFiles(directory="web", html=True), name="ui")
@@ -566,39 +582,152 @@ def _price_per_kg_from_spool(spool: dict, filament: dict) -> float | None:
     except Exception:
         return None
 
+# ---------- Client HTTP condiviso ----------
+# Pool di connessioni per tutta la vita dell'app (aperti/chiusi nel lifespan),
+# uno per impostazione di verifica TLS: keep-alive e HTTP/2 se c'è il pacchetto h2.
+HTTP_MAX_CONNECTIONS = _env_int("HTTP_MAX_CONNECTIONS", 20)
+HTTP_MAX_KEEPALIVE = _env_int("HTTP_MAX_KEEPALIVE", 10)
+HTTP_KEEPALIVE_EXPIRY_S = _env_float("HTTP_KEEPALIVE_EXPIRY_S", 30.0)
+
+try:
+    import h2  # noqa: F401
+    _HTTP2 = True
+except ImportError:
+    _HTTP2 = False
+
+_HTTP_CLIENTS: dict[bool, httpx.AsyncClient] = {}
+
+
+def _http_client(*, verify: bool = True) -> httpx.AsyncClient:
+    client = _HTTP_CLIENTS.get(verify)
+    if client is None or client.is_closed:
+        client = httpx.AsyncClient(
+            timeout=30.0,
+            follow_redirects=True,
+            verify=verify,
+            http2=_HTTP2,
+            limits=httpx.Limits(
+                max_connections=HTTP_MAX_CONNECTIONS,
+                max_keepalive_connections=HTTP_MAX_KEEPALIVE,
+                keepalive_expiry=HTTP_KEEPALIVE_EXPIRY_S,
+            ),
+        )
+        _HTTP_CLIENTS[verify] = client
+    return client
+
+
+async def _close_http_clients() -> None:
+    clients = list(_HTTP_CLIENTS.values())
+    _HTTP_CLIENTS.clear()
+    for client in clients:
+        await client.aclose()
+
+
 # ---------- Inventory ----------
-async def _fetch_inventory_items() -> list[dict]:
+# L'URL base x path che ha risposto viene memorizzato: si torna a sondare solo
+# quando smette di funzionare. Le basi sono sondate in parallelo (vince la
+# prima che risponde) e una base che fallisce SPOOLMAN_BREAKER_FAILURES volte
+# di fila viene saltata per SPOOLMAN_BREAKER_COOLDOWN_S.
+SPOOLMAN_TIMEOUT_S = _env_float("SPOOLMAN_TIMEOUT_S", 12.0)
+SPOOLMAN_PROBE_TIMEOUT_S = _env_float("SPOOLMAN_PROBE_TIMEOUT_S", 3.0)
+SPOOLMAN_BREAKER_FAILURES = _env_int("SPOOLMAN_BREAKER_FAILURES", 3)
+SPOOLMAN_BREAKER_COOLDOWN_S = _env_float("SPOOLMAN_BREAKER_COOLDOWN_S", 60.0)
+_SPOOLMAN_ROUTE: tuple[str, str] | None = None  # (base, url) che ha risposto
+_SPOOLMAN_BREAKERS: dict[str, dict] = {}
+
+
+def _spoolman_client() -> httpx.AsyncClient:
     verify = not (os.getenv("SPOOLMAN_SKIP_TLS_VERIFY", "").lower() in ("1", "true", "yes"))
+    return _http_client(verify=verify)
+
+
+def _spoolman_headers() -> dict[str, str]:
     token = os.getenv("SPOOLMAN_TOKEN")
-    headers = {"Authorization": f"Bearer {token}"} if token else {}
+    return {"Authorization": f"Bearer {token}"} if token else {}
+
+
+def _breaker_is_open(base: str) -> bool:
+    state = _SPOOLMAN_BREAKERS.get(base)
+    return bool(state and state["open_until"] > time.monotonic())
+
+
+def _breaker_record(base: str, ok: bool) -> None:
+    if ok:
+        _SPOOLMAN_BREAKERS.pop(base, None)
+        return
+    state = _SPOOLMAN_BREAKERS.setdefault(base, {"failures": 0, "open_until": 0.0})
+    state["failures"] += 1
+    if state["failures"] >= SPOOLMAN_BREAKER_FAILURES:
+        state["open_until"] = time.monotonic() + SPOOLMAN_BREAKER_COOLDOWN_S
+
 
-    attempted: list[str] = []
-    data = None
+async def _probe_spoolman_base(client: httpx.AsyncClient, base: str, timeout: float):
     last_err: str | None = None
+    for p in _paths_from_env():
+        url = f"{base}{p}"
+        try:
+            r = await client.get(url, timeout=timeout, headers=_spoolman_headers())
+            if r.status_code == 200:
+                data = r.json()
+                _breaker_record(base, True)
+                return base, url, data, None
+            last_err = f"{r.status_code} {r.text[:200]}"
+        except (httpx.ConnectError, httpx.TimeoutException) as e:
+            # host giù: inutile provare gli altri path sulla stessa base
+            _breaker_record(base, False)
+            return base, None, None, f"{type(e).__name__}: {e}"
+        except Exception as e:
+            last_err = f"{type(e).__name__}: {e}"
+    return base, None, None, last_err
+
+
+async def _discover_spoolman(client: httpx.AsyncClient, timeout: float):
+    global _SPOOLMAN_ROUTE
+    bases = [b for b in _bases_from_env() if not _breaker_is_open(b)] or _bases_from_env()
+    tasks = [asyncio.create_task(_probe_spoolman_base(client, b, timeout)) for b in bases]
+    errors: list[str] = []
+    try:
+        for fut in asyncio.as_completed(tasks):
+            base, url, data, err = await fut
+            if url is not None:
+                _SPOOLMAN_ROUTE = (base, url)
+                return data
+            errors.append(f"{base}: {err}")
+    finally:
+        for task in tasks:
+            task.cancel()
+    detail = f"Spoolman non raggiungibile. Tentativi: {bases} x {_paths_from_env()}"
+    if errors:
+        detail += f"  Errore: {'; '.join(errors)}"
+    raise HTTPException(502, detail)
+
+
+async def _spoolman_get_spools(client: httpx.AsyncClient):
+    global _SPOOLMAN_ROUTE
+    if _SPOOLMAN_ROUTE is not None:
+        base, url = _SPOOLMAN_ROUTE
+        try:
+            r = await client.get(url, timeout=SPOOLMAN_TIMEOUT_S, headers=_spoolman_headers())
+            if r.status_code == 200:
+                return r.json()
+        except (httpx.ConnectError, httpx.TimeoutException):
+            _breaker_record(base, False)
+        except Exception:
+            pass
+        # l'URL memorizzato non risponde più: si torna a sondare
+        _SPOOLMAN_ROUTE = None
+    return await _discover_spoolman(client, SPOOLMAN_TIMEOUT_S)
+
+
+async def _warm_spoolman_discovery() -> None:
+    try:
+        await _discover_spoolman(_spoolman_client(), SPOOLMAN_PROBE_TIMEOUT_S)
+    except HTTPException as e:
+        _LOG.warning("Nessun endpoint Spoolman raggiungibile all'avvio: %s", e.detail)
 
-    async with httpx.AsyncClient(timeout=12.0, headers=headers, follow_redirects=True, verify=verify) as client:
-        for b in _bases_from_env():
-            for p in _paths_from_env():
-                if not p:
-                    continue
-                url = f"{b}{p}"
-                attempted.append(url)
-                try:
-                    r = await client.get(url)
-                    if r.status_code == 200:
-                        data = r.json()
-                        break
-                    last_err = f"{r.status_code} {r.text[:200]}"
-                except Exception as e:
-                    last_err = f"{type(e).__name__}: {e}"
-            if data is not None:
-                break
 
-    if data is None:
-        detail = f"Spoolman non raggiungibile. Tentativi: {attempted}"
-        if last_err:
-            detail += f"  Errore: {last_err}"
-        raise HTTPException(502, detail)
+async def _load_inventory_items() -> list[dict]:
+    data = await _spoolman_get_spools(_spoolman_client())
 
     if isinstance(data, dict):
         spools = data.get("results") or data.get("spools") or []
@@ -684,19 +813,78 @@ def _inventory_key_for_index(item: dict, index: int) -> str:
     return f"{material}_{color}_{index}"
 
 
+# Snapshot in memoria (stale-while-revalidate): entro INVENTORY_TTL_S si usa la
+# cache, fino a INVENTORY_MAX_STALE_S si risponde con la copia vecchia e si
+# aggiorna in background; solo a freddo (o oltre) si aspetta Spoolman.
+INVENTORY_TTL_S = _env_float("INVENTORY_TTL_S", 30.0)
+INVENTORY_MAX_STALE_S = _env_float("INVENTORY_MAX_STALE_S", 3600.0)
+_INVENTORY_SNAPSHOT: dict | None = None
+_INVENTORY_REFRESH: asyncio.Task | None = None
+
+
+async def _refresh_inventory_snapshot() -> dict:
+    global _INVENTORY_SNAPSHOT
+    items = await _load_inventory_items()
+    _INVENTORY_SNAPSHOT = {
+        "items": items,
+        "index": {_inventory_key_for_index(item, idx): item for idx, item in enumerate(items)},
+        "fetched_at": time.monotonic(),
+    }
+    return _INVENTORY_SNAPSHOT
+
+
+def _log_inventory_refresh_error(task: asyncio.Task) -> None:
+    if task.cancelled():
+        return
+    exc = task.exception()
+    if exc is not None:
+        _LOG.warning("Refresh inventario fallito: %s", getattr(exc, "detail", None) or exc)
+
+
+def _inventory_refresh_task() -> asyncio.Task:
+    # una sola richiesta a Spoolman in volo, condivisa da tutti i chiamanti
+    global _INVENTORY_REFRESH
+    if _INVENTORY_REFRESH is None or _INVENTORY_REFRESH.done():
+        _INVENTORY_REFRESH = asyncio.create_task(_refresh_inventory_snapshot())
+        _INVENTORY_REFRESH.add_done_callback(_log_inventory_refresh_error)
+    return _INVENTORY_REFRESH
+
+
+async def _inventory_snapshot() -> dict:
+    snap = _INVENTORY_SNAPSHOT
+    if snap is not None:
+        age = time.monotonic() - snap["fetched_at"]
+        if age < INVENTORY_TTL_S:
+            return snap
+        if age < INVENTORY_MAX_STALE_S:
+            _inventory_refresh_task()
+            return snap
+    # shield: se il client si disconnette il refresh condiviso prosegue
+    return await asyncio.shield(_inventory_refresh_task())
+
+
+async def _fetch_inventory_items() -> list[dict]:
+    return (await _inventory_snapshot())["items"]
+
+
+def _invalidate_inventory_cache() -> None:
+    global _INVENTORY_SNAPSHOT
+    if _INVENTORY_SNAPSHOT is not None:
+        # solo "scaduto": si continua a servire lo snapshot precedente
+        # finché il refresh in background non lo sostituisce
+        _INVENTORY_SNAPSHOT = dict(_INVENTORY_SNAPSHOT, fetched_at=time.monotonic() - INVENTORY_TTL_S)
+
+
 async def _resolve_inventory_context(key: str | None) -> dict:
     if not key:
         return {}
     try:
-        items = await _fetch_inventory_items()
+        snap = await _inventory_snapshot()
     except HTTPException:
         raise
     except Exception:
         return {}
-    for idx, item in enumerate(items):
-        if _inventory_key_for_index(item, idx) == key:
-            return item
-    return {}
+    return snap["index"].get(key) or {}
 
 
 def _normalize_viewer_url(url: str | None) -> str | None:
@@ -732,6 +920,17 @@ async def inventory():
 async def inventory_legacy():
     return await inventory()
 
+@app.post("/inventory/invalidate")
+@app.post("/api/inventory/invalidate")
+async def inventory_invalidate(wait: bool = False):
+    # ?wait=true aspetta il nuovo snapshot, altrimenti il refresh va in background
+    _invalidate_inventory_cache()
+    if wait:
+        snap = await asyncio.shield(_inventory_refresh_task())
+        return _no_cache({"ok": True, "refreshed": True, "items": len(snap["items"])})
+    _inventory_refresh_task()
+    return _no_cache({"ok": True, "refreshed": False})
+
 # ---------- Upload modello (viewer) ----------
 ALLOWED_EXTS = {".stl", ".obj", ".3mf"}
 
@@ -741,11 +940,63 @@ def _safe_filename(name: str) -> str:
         base = "model"
     return base
 
+UPLOAD_MAX_BYTES = _env_int("UPLOAD_MAX_BYTES", 1 << 30)
+UPLOAD_CHUNK = 1 << 20
+
+
+async def _save_upload(file: UploadFile, out_path: str) -> tuple[int, str]:
+    """Copia l'upload su disco a blocchi: dimensione e SHA-256 calcolati al volo."""
+    if UPLOAD_MAX_BYTES and file.size and file.size > UPLOAD_MAX_BYTES:
+        raise HTTPException(413, f"File troppo grande (max {UPLOAD_MAX_BYTES} byte).")
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        with open(out_path, "wb") as f:
+            while True:
+                chunk = await file.read(UPLOAD_CHUNK)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if UPLOAD_MAX_BYTES and size > UPLOAD_MAX_BYTES:
+                    raise HTTPException(413, f"File troppo grande (max {UPLOAD_MAX_BYTES} byte).")
+                digest.update(chunk)
+                f.write(chunk)
+    except BaseException:
+        try:
+            os.remove(out_path)
+        except OSError:
+            pass
+        raise
+    sha = digest.hexdigest()
+    _remember_file_hash(out_path, sha)
+    return size, sha
+
+
 def _guess_uploads_dir() -> str:
     uploads = os.path.join(WEB_DIR, "uploads")
     os.makedirs(uploads, exist_ok=True)
     return uploads
 
+# Archivio content-addressed: il contenuto vive una sola volta in
+# uploads/_blobs/<sha256>, i nomi pubblici (<nome>_<sha[:12]><ext>) sono
+# hardlink. Stesso file ricaricato = stesso viewer_url, quindi cache di slicing
+# e anteprime (tutte per hash) vengono condivise.
+def _model_blob_path(uploads: str, sha: str) -> str:
+    blobs = os.path.join(uploads, "_blobs")
+    os.makedirs(blobs, exist_ok=True)
+    return os.path.join(blobs, sha)
+
+
+def _link_model(blob: str, out_path: str) -> None:
+    try:
+        os.link(blob, out_path)
+    except FileExistsError:
+        pass
+    except OSError:
+        # filesystem senza hardlink: copia
+        shutil.copy2(blob, out_path)
+
+
 @app.post("/upload_model")
 async def upload_model(file: UploadFile = File(...)):
     orig = file.filename or "model"
@@ -754,18 +1005,484 @@ async def upload_model(file: UploadFile = File(...)):
         raise HTTPException(400, f"Estensione non supportata: {ext} (consentiti: {', '.join(sorted(ALLOWED_EXTS))})")
 
     uploads = _guess_uploads_dir()
-    safe = _safe_filename(os.path.splitext(orig)[0]) + "_" + uuid.uuid4().hex[:8] + ext
-    out_path = os.path.join(uploads, safe)
+    staging = os.path.join(uploads, f".upload-{uuid.uuid4().hex}{ext}")
 
     try:
-        with open(out_path, "wb") as f:
-            chunk = await file.read()
-            f.write(chunk)
+        size, sha = await _save_upload(file, staging)
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(500, f"Scrittura file fallita: {type(e).__name__}: {e}")
 
+    safe = _safe_filename(os.path.splitext(orig)[0]) + "_" + sha[:12] + ext
+    out_path = os.path.join(uploads, safe)
+    deduplicated = True
+    try:
+        if os.path.isfile(out_path):
+            _touch_upload(out_path)
+        else:
+            blob = _model_blob_path(uploads, sha)
+            if os.path.isfile(blob):
+                os.remove(staging)
+            else:
+                os.replace(staging, blob)
+                deduplicated = False
+            _link_model(blob, out_path)
+            _remember_file_hash(out_path, sha)
+    except OSError as e:
+        raise HTTPException(500, f"Scrittura file fallita: {type(e).__name__}: {e}")
+    finally:
+        if os.path.exists(staging):
+            os.remove(staging)
+
     viewer_url = f"/ui/uploads/{safe}"
-    return {"viewer_url": viewer_url, "filename": safe}
+    return {"viewer_url": viewer_url, "filename": safe, "size": size, "sha256": sha, "deduplicated": deduplicated}
+
+# ---------- Analisi mesh (preventivo rapido) ----------
+# Preventivo istantaneo senza slicer: il modello (STL/OBJ/3MF) diventa un array
+# di triangoli e volume, superficie, bounding box, area in sbalzo e tenuta
+# stagna si calcolano con operazioni vettoriali NumPy. Con layer_height,
+# infill_density, perimetri e strati pieni del profilo scelto si stima il
+# materiale e il tempo; lo slicing completo resta il raffinamento opzionale.
+try:  # NumPy è opzionale: senza, /slice/quick risponde 503
+    import numpy as _np
+except ImportError:
+    _np = None
+
+_MESH_STATS_MAX = 256
+_MESH_STATS: OrderedDict[str, dict] = OrderedDict()
+_MESH_STATS_LOCK = threading.Lock()
+_OVERHANG_COS = math.cos(math.radians(45.0))
+# a parità di volume lo slicer perde tempo in accelerazioni, travel e cambi layer
+_QUICK_QUOTE_TIME_FACTOR = 1.25
+_QUICK_QUOTE_LAYER_OVERHEAD_S = 1.5
+_STL_BINARY_DTYPE = None if _np is None else _np.dtype(
+    [("normal", "<f4", (3,)), ("vertices", "<f4", (3, 3)), ("attr", "<u2")]
+)
+_3MF_NS = "{http://schemas.microsoft.com/3dmanufacturing/core/2015/02}"
+
+
+def _load_stl_triangles(path: str):
+    size = os.path.getsize(path)
+    with open(path, "rb") as f:
+        head = f.read(84)
+        if len(head) == 84:
+            count = int.from_bytes(head[80:84], "little")
+            if 84 + count * 50 == size:
+                data = _np.fromfile(f, dtype=_STL_BINARY_DTYPE, count=count)
+                return data["vertices"].astype(_np.float64)
+        f.seek(0)
+        coords = [line.split()[1:4] for line in f if line.lstrip().startswith(b"vertex")]
+    if not coords:
+        raise HTTPException(400, "STL senza triangoli leggibili.")
+    return _np.array(coords, dtype=_np.float64).reshape(-1, 3, 3)
+
+
+def _load_obj_triangles(path: str):
+    vertices: list[list[bytes]] = []
+    faces: list[int] = []
+    with open(path, "rb") as f:
+        for line in f:
+            if line.startswith(b"v "):
+                vertices.append(line.split()[1:4])
+            elif line.startswith(b"f "):
+                idx = [int(tok.split(b"/")[0]) for tok in line.split()[1:]]
+                for i in range(1, len(idx) - 1):  # poligoni: ventaglio di triangoli
+                    faces.extend((idx[0], idx[i], idx[i + 1]))
+    if not vertices or not faces:
+        raise HTTPException(400, "OBJ senza facce leggibili.")
+    verts = _np.array(vertices, dtype=_np.float64)
+    index = _np.array(faces, dtype=_np.int64)
+    index = _np.where(index < 0, index + len(verts), index - 1)  # indici OBJ: 1-based o negativi
+    return verts[index].reshape(-1, 3, 3)
+
+
+def _load_3mf_triangles(path: str):
+    parts = []
+    with zipfile.ZipFile(path) as z:
+        for name in z.namelist():
+            if not name.lower().endswith(".model"):
+                continue
+            verts: list[tuple] = []
+            tris: list[tuple] = []
+            with z.open(name) as src:
+                for _, el in ET.iterparse(src):
+                    if el.tag == _3MF_NS + "vertex":
+                        verts.append((el.get("x"), el.get("y"), el.get("z")))
+                    elif el.tag == _3MF_NS + "triangle":
+                        tris.append((el.get("v1"), el.get("v2"), el.get("v3")))
+                    elif el.tag == _3MF_NS + "mesh":
+                        # gli indici sono locali a ogni mesh
+                        if verts and tris:
+                            v = _np.array(verts, dtype=_np.float64)
+                            parts.append(v[_np.array(tris, dtype=_np.int64)])
+                        verts, tris = [], []
+                    el.clear()
+    if not parts:
+        raise HTTPException(400, "3MF senza mesh leggibili.")
+    return _np.concatenate(parts)
+
+
+def _load_mesh_triangles(path: str):
+    """Triangoli del modello come array ``(N, 3, 3)`` in mm."""
+    ext = os.path.splitext(path)[1].lower()
+    try:
+        if ext == ".stl":
+            return _load_stl_triangles(path)
+        if ext == ".obj":
+            return _load_obj_triangles(path)
+        if ext == ".3mf":
+            return _load_3mf_triangles(path)
+    except HTTPException:
+        raise
+    except (ValueError, IndexError, zipfile.BadZipFile, ET.ParseError) as e:
+        raise HTTPException(400, f"Modello non leggibile: {type(e).__name__}: {e}")
+    raise HTTPException(400, f"Estensione non supportata per l'analisi: {ext}")
+
+
+def _row_keys(rows):
+    """Chiave int64 univoca per ogni riga di un array intero ``(N, k)``."""
+    rows = rows - rows.min(axis=0)
+    spans = rows.max(axis=0) + 1
+    if math.prod(int(x) for x in spans) >= 1 << 62:
+        return None
+    key = rows[:, 0].copy()
+    for col in range(1, rows.shape[1]):
+        key *= spans[col]
+        key += rows[:, col]
+    return key
+
+
+def _row_ids(rows):
+    key = _row_keys(rows)
+    if key is None:  # modello enorme: si ripiega sul confronto per righe
+        return _np.unique(rows, axis=0, return_inverse=True)[1].reshape(-1)
+    return _np.unique(key, return_inverse=True)[1].reshape(-1)
+
+
+def _analyze_mesh(tris) -> dict:
+    v0, v1, v2 = tris[:, 0], tris[:, 1], tris[:, 2]
+    cross = _np.cross(v1 - v0, v2 - v0)
+    double_area = _np.linalg.norm(cross, axis=1)
+    area = 0.5 * double_area
+    volume = float(abs(_np.einsum("ij,ij->i", v0, _np.cross(v1, v2)).sum()) / 6.0)
+    nz = _np.divide(cross[:, 2], double_area, out=_np.zeros_like(double_area), where=double_area > 0)
+
+    flat = tris.reshape(-1, 3)
+    bbox_min = flat.min(axis=0)
+    bbox_max = flat.max(axis=0)
+    # sbalzi: facce rivolte verso il basso oltre 45°, escluse quelle appoggiate al piatto
+    on_bed = tris[:, :, 2].max(axis=1) <= bbox_min[2] + 1e-3
+    overhang = (nz < -_OVERHANG_COS) & ~on_bed
+
+    # tenuta stagna: ogni spigolo condiviso da esattamente due triangoli
+    # (vertici saldati a 1 µm; righe ridotte a una chiave scalare, molto più veloce di unique(axis=0))
+    vid = _row_ids(_np.round(flat * 1000.0).astype(_np.int64)).reshape(-1, 3)
+    edges = _np.sort(_np.concatenate([vid[:, [0, 1]], vid[:, [1, 2]], vid[:, [2, 0]]]), axis=1)
+    edge_keys = _row_keys(edges)
+    if edge_keys is None:
+        _, edge_counts = _np.unique(edges, axis=0, return_counts=True)
+    else:
+        _, edge_counts = _np.unique(edge_keys, return_counts=True)
+
+    return {
+        "triangles": int(len(tris)),
+        "volume_mm3": volume,
+        "surface_mm2": float(area.sum()),
+        "bbox": {
+            "min": [float(x) for x in bbox_min],
+            "max": [float(x) for x in bbox_max],
+            "size": [float(x) for x in bbox_max - bbox_min],
+        },
+        "overhang_mm2": float(area[overhang].sum()),
+        "watertight": bool((edge_counts == 2).all()),
+        "open_edges": int((edge_counts == 1).sum()),
+        "nonmanifold_edges": int((edge_counts > 2).sum()),
+        # aree per orientamento, servono al preventivo (pareti vs. superfici piane)
+        "_side_mm2": float(area[_np.abs(nz) < _OVERHANG_COS].sum()),
+        "_top_mm2": float(area[nz >= _OVERHANG_COS].sum()),
+        "_bottom_mm2": float(area[nz <= -_OVERHANG_COS].sum()),
+    }
+
+
+def _mesh_stats(path: str) -> dict:
+    key = _sha256_file(path)
+    with _MESH_STATS_LOCK:
+        stats = _MESH_STATS.get(key)
+        if stats is not None:
+            _MESH_STATS.move_to_end(key)
+            return stats
+    stats = _analyze_mesh(_load_mesh_triangles(path))
+    with _MESH_STATS_LOCK:
+        _MESH_STATS[key] = stats
+        while len(_MESH_STATS) > _MESH_STATS_MAX:
+            _MESH_STATS.popitem(last=False)
+    return stats
+
+
+def _profile_values(path, keys: tuple[str, ...]) -> dict[str, float]:
+    values: dict[str, float] = {}
+    for key in keys:
+        raw = _extract_settings_id_from_profile(path, key)
+        # es. "15%" o "0.4,0.4" (multi-estrusore): primo valore numerico
+        number = _parse_decimal((raw or "").split(",")[0].rstrip("%")) if raw else None
+        if number is not None:
+            values[key] = number
+    return values
+
+
+def _quick_quote(stats: dict, profiles: dict[str, dict[str, object]]) -> dict:
+    """Materiale e tempo stimati dalla geometria e dai parametri del profilo."""
+    pr = _profile_values(
+        profiles["print"]["path"],
+        ("layer_height", "infill_density", "perimeters", "top_solid_layers", "bottom_solid_layers",
+         "perimeter_speed", "infill_speed", "solid_infill_speed"),
+    )
+    fil = _profile_values(profiles["filament"]["path"], ("filament_diameter", "filament_density"))
+    printer = _profile_values(profiles["printer"]["path"], ("nozzle_diameter",))
+
+    layer_h = pr.get("layer_height") or 0.2
+    infill = (pr.get("infill_density") if pr.get("infill_density") is not None else 15.0) / 100.0
+    width = 1.125 * (printer.get("nozzle_diameter") or 0.4)
+    volume = stats["volume_mm3"]
+    # guscio: perimetri sulle pareti, strati pieni sulle superfici sopra/sotto
+    shell = (
+        stats["_side_mm2"] * (pr.get("perimeters") or 2) * width
+        + stats["_top_mm2"] * (pr.get("top_solid_layers") or 4) * layer_h
+        + stats["_bottom_mm2"] * (pr.get("bottom_solid_layers") or 4) * layer_h
+    )
+    shell = min(shell, volume)
+    sparse = (volume - shell) * infill
+    extruded = shell + sparse
+
+    flow = width * layer_h  # mm^2 di sezione estrusa
+    time_s = (
+        shell / (flow * (pr.get("perimeter_speed") or pr.get("solid_infill_speed") or 50.0))
+        + sparse / (flow * (pr.get("infill_speed") or 80.0))
+    ) * _QUICK_QUOTE_TIME_FACTOR
+    layers = math.ceil(stats["bbox"]["size"][2] / layer_h) if layer_h > 0 else 0
+    time_s += layers * _QUICK_QUOTE_LAYER_OVERHEAD_S
+
+    diameter = fil.get("filament_diameter") or 1.75
+    density = fil.get("filament_density")
+    return {
+        "layer_height": layer_h,
+        "layers": layers,
+        "infill_density": infill * 100.0,
+        "extruded_mm3": extruded,
+        "shell_mm3": shell,
+        "infill_mm3": sparse,
+        "filament_mm": extruded / (math.pi * (diameter / 2.0) ** 2),
+        "filament_density": density,
+        "time_s": int(round(time_s)),
+    }
+
+
+@app.post("/slice/quick")
+@app.post("/api/slice/quick")
+async def quick_estimate(payload: dict = Body(...)):
+    """Preventivo rapido dalla sola geometria (stesso payload di /slice/estimate, preset opzionali)."""
+    if _np is None:
+        raise HTTPException(503, "Preventivo rapido non disponibile: installa numpy nel container.")
+    if not isinstance(payload, dict):
+        raise HTTPException(400, "Payload JSON non valido")
+    model_path = _resolve_model_path(_normalize_viewer_url(payload.get("viewer_url")))
+    if not model_path:
+        raise HTTPException(400, "viewer_url non valido o file inesistente")
+
+    started = time.perf_counter()
+    # preset opzionali: senza, si usano i profili di default del container
+    profiles = {
+        kind: {"path": _resolve_profile_path(kind, payload.get(f"preset_{kind}"))[0] if payload.get(f"preset_{kind}") else default}
+        for kind, default in (
+            ("print", DEFAULT_PRINT_PROFILE),
+            ("filament", DEFAULT_FILAMENT_PROFILE),
+            ("printer", DEFAULT_PRINTER_PROFILE),
+        )
+    }
+    inventory_key = payload.get("inventory_key")
+    inventory_context = await _resolve_inventory_context(str(inventory_key)) if inventory_key else {}
+    material = payload.get("material") or inventory_context.get("material")
+    price_per_kg = payload.get("price_per_kg")
+    if price_per_kg is None:
+        price_per_kg = inventory_context.get("price_per_kg")
+    price_per_kg = _to_float(price_per_kg, None)
+    hourly_rate = _to_float(payload.get("hourly_rate"), None)
+
+    stats = await asyncio.to_thread(_mesh_stats, model_path)
+    quote = _quick_quote(stats, profiles)
+    if quote["filament_density"] and not material:
+        filament_g = quote["extruded_mm3"] / 1000.0 * quote["filament_density"]
+    else:
+        filament_g = _grams_from_volume_mm3(quote["extruded_mm3"], material)
+    eff_rate, mat_cost, mach_cost, total_cost = _estimate_costs(filament_g, quote["time_s"], price_per_kg, hourly_rate)
+
+    return _no_cache(
+        {
+            "kind": "quick",
+            "mesh": {k: v for k, v in stats.items() if not k.startswith("_")},
+            "quote": quote,
+            "filament_g": filament_g,
+            "filament_mm": quote["filament_mm"],
+            "time_s": quote["time_s"],
+            "price_per_kg": price_per_kg,
+            "hourly_rate": eff_rate,
+            "cost_material": mat_cost,
+            "cost_machine": mach_cost,
+            "cost_total": total_cost,
+            "currency": CURRENCY,
+            "preset_print_used": Path(profiles["print"]["path"]).name,
+            "elapsed_ms": round((time.perf_counter() - started) * 1000.0, 1),
+        }
+    )
+
+# ---------- Pulizia upload (retention) ----------
+# Janitor in background su web/uploads: rimuove i modelli non usati da più di
+# UPLOAD_TTL_S e, oltre UPLOAD_QUOTA_BYTES, i meno usati di recente (LRU).
+# L'unità è il contenuto (inode): blob in _blobs più tutti i nomi hardlink.
+# L'atime dell'inode fa da "ultimo uso" (aggiornato a ogni stima/upload; l'mtime
+# resta fermo perché entra nella chiave della memo degli hash).
+UPLOAD_TTL_S = _env_float("UPLOAD_TTL_S", 30 * 24 * 3600.0)
+UPLOAD_QUOTA_BYTES = _env_int("UPLOAD_QUOTA_BYTES", 0)
+UPLOAD_GC_INTERVAL_S = _env_float("UPLOAD_GC_INTERVAL_S", 3600.0)
+UPLOAD_GC_MIN_AGE_S = _env_float("UPLOAD_GC_MIN_AGE_S", 3600.0)
+UPLOAD_GC_DRY_RUN = os.getenv("UPLOAD_GC_DRY_RUN", "").strip().lower() in ("1", "true", "yes", "on")
+_UPLOAD_GC_LOCK = threading.Lock()
+_UPLOAD_GC_STATS: dict[str, object] = {
+    "runs": 0,
+    "entries_removed": 0,
+    "bytes_reclaimed": 0,
+    "last_run": None,
+    "last_report": None,
+}
+
+
+def _touch_upload(path: str) -> None:
+    try:
+        st = os.stat(path)
+        os.utime(path, ns=(time.time_ns(), st.st_mtime_ns))
+    except OSError:
+        pass
+
+
+def _upload_gc_entries(uploads: str) -> list[dict]:
+    groups: dict[tuple[int, int], dict] = {}
+
+    def _add(path: str, kind: str) -> None:
+        try:
+            st = os.stat(path)
+        except OSError:
+            return
+        g = groups.setdefault(
+            (st.st_dev, st.st_ino),
+            {"kind": kind, "paths": [], "size": st.st_size, "last_used": max(st.st_atime, st.st_mtime)},
+        )
+        g["paths"].append(path)
+
+    for entry in os.scandir(uploads):
+        if entry.is_file(follow_symlinks=False):
+            _add(entry.path, "staging" if entry.name.startswith(".upload-") else "model")
+    blobs = os.path.join(uploads, "_blobs")
+    if os.path.isdir(blobs):
+        for entry in os.scandir(blobs):
+            if entry.is_file(follow_symlinks=False):
+                _add(entry.path, "model")
+    return list(groups.values())
+
+
+def _run_upload_gc(dry_run: bool | None = None) -> dict:
+    dry_run = UPLOAD_GC_DRY_RUN if dry_run is None else dry_run
+    uploads = _guess_uploads_dir()
+    started = time.time()
+    with _UPLOAD_GC_LOCK:
+        entries = _upload_gc_entries(uploads)
+        total = sum(e["size"] for e in entries)
+        victims: list[dict] = []
+        keep: list[dict] = []
+        for e in entries:
+            age = started - e["last_used"]
+            # staging rimasto da upload interrotti: basta la soglia minima
+            ttl = UPLOAD_GC_MIN_AGE_S if e["kind"] == "staging" else UPLOAD_TTL_S
+            if ttl > 0 and age > max(ttl, UPLOAD_GC_MIN_AGE_S):
+                victims.append(dict(e, reason="ttl"))
+            else:
+                keep.append(e)
+        remaining = total - sum(v["size"] for v in victims)
+        if UPLOAD_QUOTA_BYTES and remaining > UPLOAD_QUOTA_BYTES:
+            for e in sorted(keep, key=lambda x: x["last_used"]):
+                if remaining <= UPLOAD_QUOTA_BYTES:
+                    break
+                if started - e["last_used"] <= UPLOAD_GC_MIN_AGE_S:
+                    continue
+                victims.append(dict(e, reason="quota"))
+                remaining -= e["size"]
+
+        reclaimed = 0
+        removed: list[dict] = []
+        for v in victims:
+            if not dry_run:
+                try:
+                    for path in v["paths"]:
+                        os.remove(path)
+                except OSError as exc:
+                    _LOG.warning("Pulizia upload: rimozione fallita %s: %s", v["paths"], exc)
+                    continue
+            reclaimed += v["size"]
+            removed.append(
+                {
+                    "paths": [os.path.relpath(p, uploads) for p in v["paths"]],
+                    "kind": v["kind"],
+                    "bytes": v["size"],
+                    "reason": v["reason"],
+                }
+            )
+
+        report = {
+            "dry_run": dry_run,
+            "scanned": len(entries),
+            "total_bytes": total,
+            "removed": removed,
+            "bytes_reclaimed": reclaimed,
+            "duration_s": round(time.time() - started, 3),
+        }
+        _UPLOAD_GC_STATS["runs"] += 1
+        _UPLOAD_GC_STATS["last_run"] = started
+        _UPLOAD_GC_STATS["last_report"] = dict(report, removed=removed[:50])
+        if not dry_run:
+            _UPLOAD_GC_STATS["entries_removed"] += len(removed)
+            _UPLOAD_GC_STATS["bytes_reclaimed"] += reclaimed
+    return report
+
+
+async def _upload_janitor_loop() -> None:
+    while True:
+        await asyncio.sleep(UPLOAD_GC_INTERVAL_S)
+        try:
+            await asyncio.to_thread(_run_upload_gc)
+        except Exception as exc:
+            _LOG.warning("Pulizia upload fallita: %s: %s", type(exc).__name__, exc)
+
+
+@app.get("/uploads/gc")
+async def upload_gc_stats():
+    return _no_cache(
+        {
+            **_UPLOAD_GC_STATS,
+            "config": {
+                "ttl_s": UPLOAD_TTL_S,
+                "quota_bytes": UPLOAD_QUOTA_BYTES,
+                "interval_s": UPLOAD_GC_INTERVAL_S,
+                "min_age_s": UPLOAD_GC_MIN_AGE_S,
+                "dry_run": UPLOAD_GC_DRY_RUN,
+            },
+        }
+    )
+
+
+@app.post("/uploads/gc")
+async def upload_gc_run(dry_run: bool = True):
+    # di default dry-run: elenca cosa verrebbe rimosso senza cancellare
+    return _no_cache(await asyncio.to_thread(_run_upload_gc, dry_run))
 
 # ---------- Estimation ----------
 _TIME_PAT = re.compile(r"estimated printing time(?: \(.*?\))?\s*=\s*([^\n\r;]+)", re.I)
@@ -880,67 +1597,101 @@ def _parse_filament_usage_from_comments(gcode: str) -> tuple[float | None, float
     return grams, length, volume
 
 
-def _estimate_filament_length_from_gcode_text(gcode: str) -> float:
-    totals: dict[int, float] = {}
-    last_e: dict[int, float | None] = {}
-    current_tool = 0
-    relative_mode = False
+# ---------- Tokenizer G-code ----------
+# Parole G-code estratte da righe bytes senza regex per riga (vedi _gcode_words).
+_GCODE_E_RESET_CMDS = frozenset({b"G92", b"g92"})
+# solo i movimenti spostano l'estrusore (M92 E… imposta i passi/mm, non la posizione)
+_GCODE_EXTRUDE_CMDS = frozenset(
+    {b"G0", b"G1", b"G2", b"G3", b"G00", b"G01", b"G02", b"G03", b"g0", b"g1", b"g2", b"g3", b"g00", b"g01", b"g02", b"g03"}
+)
+_GCODE_ABSOLUTE_E_CMDS = frozenset({b"M82", b"m82"})
+_GCODE_RELATIVE_E_CMDS = frozenset({b"M83", b"m83"})
+_GCODE_E_JUMP_MAX_MM = 1000.0
+
+
+def _split_packed_word(word: bytes) -> list[bytes]:
+    out: list[bytes] = []
+    start = 0
+    for i in range(1, len(word)):
+        if 0x61 <= (word[i] | 0x20) <= 0x7A:
+            out.append(word[start:i])
+            start = i
+    out.append(word[start:])
+    return out
 
-    totals.setdefault(current_tool, 0.0)
-    last_e.setdefault(current_tool, None)
 
-    for raw_line in gcode.splitlines():
-        line = raw_line.strip()
-        if not line:
-            continue
-        if ";" in line:
-            line = line.split(";", 1)[0].strip()
-            if not line:
-                continue
+def _gcode_words(raw: bytes) -> list[bytes]:
+    cut = raw.find(b";")
+    words = (raw if cut < 0 else raw[:cut]).split()
+    if words:
+        cmd = words[0]
+        if len(cmd) > 2 and not cmd[1:].isdigit():
+            packed: list[bytes] = []
+            for word in words:
+                packed.extend(_split_packed_word(word))
+            return packed
+    return words
+
+
+def _gcode_tool(cmd: bytes) -> int | None:
+    if len(cmd) > 1 and (cmd[0] | 0x20) == 0x74 and cmd[1:].isdigit():
+        return int(cmd[1:])
+    return None
 
-        upper = line.upper()
 
-        if upper.startswith("T") and len(line) > 1 and line[1].isdigit():
+def _gcode_word_value(words: list[bytes], letter: int) -> float | None:
+    for i in range(1, len(words)):
+        word = words[i]
+        if (word[0] | 0x20) == letter:
             try:
-                current_tool = int(re.match(r"T(\d+)", line).group(1))
-            except Exception:
-                current_tool = 0
+                return float(word[1:])
+            except ValueError:
+                return None
+    return None
+
+
+def _estimate_filament_length_from_gcode_lines(lines) -> float:
+    totals: dict[int, float] = {0: 0.0}
+    last_e: dict[int, float | None] = {0: None}
+    current_tool = 0
+    relative_mode = False
+
+    for raw_line in lines:
+        words = _gcode_words(raw_line)
+        if not words:
+            continue
+        cmd = words[0]
+
+        tool = _gcode_tool(cmd)
+        if tool is not None:
+            current_tool = tool
             totals.setdefault(current_tool, 0.0)
             last_e.setdefault(current_tool, None)
             continue
 
-        if "M82" in upper:
-            relative_mode = False
-            last_e[current_tool] = None
-            continue
-        if "M83" in upper:
-            relative_mode = True
+        if cmd in _GCODE_ABSOLUTE_E_CMDS or cmd in _GCODE_RELATIVE_E_CMDS:
+            relative_mode = cmd in _GCODE_RELATIVE_E_CMDS
             last_e[current_tool] = None
             continue
 
-        if ("G92" in upper or "M92" in upper) and "E" in upper:
-            last_e[current_tool] = 0.0 if not relative_mode else None
-            continue
-
-        match = re.search(r"\bE([+-]?(?:\d+\.\d*|\d*\.\d+|\d+)(?:[eE][+-]?\d+)?)", line)
-        if not match:
+        value = _gcode_word_value(words, 0x65)  # 'e'
+        if cmd in _GCODE_E_RESET_CMDS:
+            if value is not None:
+                last_e[current_tool] = None if relative_mode else value
             continue
-
-        value = _parse_decimal(match.group(1))
-        if value is None:
+        if value is None or cmd not in _GCODE_EXTRUDE_CMDS:
             continue
 
         if relative_mode:
             diff = value
         else:
             prev = last_e.get(current_tool)
+            last_e[current_tool] = value
             if prev is None:
-                last_e[current_tool] = value
                 continue
             diff = value - prev
-            last_e[current_tool] = value
 
-        if diff <= 0 or diff > 1000:
+        if diff <= 0 or diff > _GCODE_E_JUMP_MAX_MM:
             continue
 
         totals[current_tool] = totals.get(current_tool, 0.0) + diff
@@ -948,6 +1699,11 @@ def _estimate_filament_length_from_gcode_text(gcode: str) -> float:
     return sum(totals.values())
 
 
+def _estimate_filament_length_from_gcode_text(gcode: str | bytes) -> float:
+    data = gcode.encode("utf-8", errors="ignore") if isinstance(gcode, str) else gcode
+    return _estimate_filament_length_from_gcode_lines(io.BytesIO(data))
+
+
 def _parse_preset_ids_from_gcode(gcode: str) -> dict[str, str | None]:
     def _match(pattern: re.Pattern[str]) -> str | None:
         m = pattern.search(gcode)
@@ -1161,29 +1917,13 @@ def _build_profile_bundle(profiles: dict[str, dict[str, object]], temp_dir: str)
     return str(bundle_path)
 
 
-def _build_prusaslicer_args(
-    base_cmd: list[str],
-    input_path: str,
-    output_path: str,
-    profiles: dict[str, dict[str, object]],
-    *,
-    override_settings: dict | None = None,
-    set_args: list[str] | None = None,
-    profile_bundle: str | None = None,
-) -> list[str]:
-    printer_profile = profiles["printer"]["path"]
-    filament_profile = profiles["filament"]["path"]
-    print_profile = profiles["print"]["path"]
-
+def _override_config_lines(profiles: dict[str, dict[str, object]], set_args: list[str]) -> list[str]:
     cli_names = {
-        "print": _profile_cli_name("print", print_profile),
-        "filament": _profile_cli_name("filament", filament_profile),
-        "printer": _profile_cli_name("printer", printer_profile),
+        "print": _profile_cli_name("print", profiles["print"]["path"]),
+        "filament": _profile_cli_name("filament", profiles["filament"]["path"]),
+        "printer": _profile_cli_name("printer", profiles["printer"]["path"]),
     }
 
-    if set_args is None:
-        set_args, _ = _build_override_set_args(override_settings)
-
     selection_set_args: list[str] = []
     for key, kind in (
         ("print_settings_id", "print"),
@@ -1193,15 +1933,7 @@ def _build_prusaslicer_args(
         if cli_names[kind]:
             selection_set_args.extend(["--set", f"{key}={cli_names[kind]}"])
 
-    args = list(base_cmd) + ["--export-gcode"]
-
-    load_targets = [profile_bundle] if profile_bundle else [printer_profile, filament_profile, print_profile]
-    for target in load_targets:
-        args.extend(["--load", str(target)])
-
-    # Persist preset selection + overrides to a temporary config file instead of
-    # passing unsupported CLI flags like --set (see PrusaSlicer CLI docs).
-    override_config_lines: list[str] = []
+    lines: list[str] = []
     for group in (selection_set_args, set_args):
         if not group:
             continue
@@ -1215,7 +1947,36 @@ def _build_prusaslicer_args(
             key = key.strip()
             value = value.strip()
             if key and value:
-                override_config_lines.append(f"{key} = {value}")
+                lines.append(f"{key} = {value}")
+    return lines
+
+
+def _build_prusaslicer_args(
+    base_cmd: list[str],
+    input_path: str,
+    output_path: str,
+    profiles: dict[str, dict[str, object]],
+    *,
+    override_settings: dict | None = None,
+    set_args: list[str] | None = None,
+    profile_bundle: str | None = None,
+) -> list[str]:
+    printer_profile = profiles["printer"]["path"]
+    filament_profile = profiles["filament"]["path"]
+    print_profile = profiles["print"]["path"]
+
+    if set_args is None:
+        set_args, _ = _build_override_set_args(override_settings)
+
+    args = list(base_cmd) + ["--export-gcode"]
+
+    load_targets = [profile_bundle] if profile_bundle else [printer_profile, filament_profile, print_profile]
+    for target in load_targets:
+        args.extend(["--load", str(target)])
+
+    # Persist preset selection + overrides to a temporary config file instead of
+    # passing unsupported CLI flags like --set (see PrusaSlicer CLI docs).
+    override_config_lines = _override_config_lines(profiles, set_args)
 
     if override_config_lines:
         overrides_path = Path(output_path).with_suffix(".override.ini")
@@ -1290,7 +2051,11 @@ def _build_override_set_args(settings: dict | None) -> tuple[list[str], dict[str
     return args, applied
 
 
-def _invoke_prusaslicer(
+PRUSASLICER_TIMEOUT = _env_int("PRUSASLICER_TIMEOUT", 1200)
+_PRUSASLICER_OUTPUT_TAIL_LINES = 200
+
+
+def _prepare_prusaslicer_invocation(
     input_path: str,
     output_path: str,
     profiles: dict[str, dict[str, object]],
@@ -1318,13 +2083,31 @@ def _invoke_prusaslicer(
     except Exception:
         rendered_cmd = " ".join(args)
     _LOG.info("PrusaSlicer cmd: %s", rendered_cmd)
+    return args, applied_overrides
+
+
+def _invoke_prusaslicer(
+    input_path: str,
+    output_path: str,
+    profiles: dict[str, dict[str, object]],
+    *,
+    override_settings: dict | None = None,
+    profile_bundle: str | None = None,
+) -> tuple[list[str], dict[str, float]]:
+    args, applied_overrides = _prepare_prusaslicer_invocation(
+        input_path,
+        output_path,
+        profiles,
+        override_settings=override_settings,
+        profile_bundle=profile_bundle,
+    )
 
     try:
         res = subprocess.run(
             args,
             capture_output=True,
             text=True,
-            timeout=1200,
+            timeout=PRUSASLICER_TIMEOUT,
             env=_praslicer_env(),
         )
     except FileNotFoundError:
@@ -1338,34 +2121,323 @@ def _invoke_prusaslicer(
 
     return args, applied_overrides
 
-def _run_prusaslicer(
-    model_path: str,
+
+async def _drain_process_stream(stream: asyncio.StreamReader, tail, label: str) -> None:
+    pending = b""
+    while True:
+        chunk = await stream.read(65536)
+        if not chunk:
+            break
+        pending += chunk
+        *lines, pending = pending.split(b"\n")
+        for raw in lines:
+            line = raw.decode("utf-8", errors="ignore").rstrip("\r")
+            if line:
+                tail.append(line)
+                _LOG.debug("PrusaSlicer %s: %s", label, line)
+    if pending.strip():
+        tail.append(pending.decode("utf-8", errors="ignore").strip())
+
+
+async def _invoke_prusaslicer_async(
+    input_path: str,
+    output_path: str,
     profiles: dict[str, dict[str, object]],
     *,
     override_settings: dict | None = None,
-) -> tuple[str, list[str], dict[str, float]]:
-    with tempfile.TemporaryDirectory() as td:
-        out_path = _build_gcode_output_path(
-            td,
-            model_path,
-            profiles["print"].get("requested"),
-            profiles["filament"].get("requested"),
-            profiles["printer"].get("requested"),
-        )
-        bundle_path = _build_profile_bundle(profiles, td)
+    profile_bundle: str | None = None,
+    request: Request | None = None,
+) -> tuple[list[str], dict[str, float]]:
+    """Come _invoke_prusaslicer, ma senza bloccare l'event loop.
+
+    stdout/stderr vengono letti man mano (ne resta solo la coda per i messaggi
+    d'errore) e il processo viene terminato se il client si disconnette.
+    """
+    args, applied_overrides = _prepare_prusaslicer_invocation(
+        input_path,
+        output_path,
+        profiles,
+        override_settings=override_settings,
+        profile_bundle=profile_bundle,
+    )
+    if request is not None and await request.is_disconnected():
+        raise HTTPException(499, "Richiesta annullata dal client.")
+
+    try:
+        proc = await asyncio.create_subprocess_exec(
+            *args,
+            stdin=asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            env=_praslicer_env(),
+        )
+    except FileNotFoundError:
+        raise HTTPException(500, "PrusaSlicer non trovato nel container.")
+
+    out_tail: deque[str] = deque(maxlen=_PRUSASLICER_OUTPUT_TAIL_LINES)
+    err_tail: deque[str] = deque(maxlen=_PRUSASLICER_OUTPUT_TAIL_LINES)
+    readers = [
+        asyncio.create_task(_drain_process_stream(proc.stdout, out_tail, "stdout")),
+        asyncio.create_task(_drain_process_stream(proc.stderr, err_tail, "stderr")),
+    ]
+    waiter = asyncio.create_task(proc.wait())
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + PRUSASLICER_TIMEOUT
+    try:
+        while True:
+            done, _ = await asyncio.wait({waiter}, timeout=1.0)
+            if done:
+                break
+            if request is not None and await request.is_disconnected():
+                _LOG.info("Client disconnesso: termino PrusaSlicer (pid %s)", proc.pid)
+                raise HTTPException(499, "Richiesta annullata dal client.")
+            if loop.time() > deadline:
+                raise HTTPException(504, "PrusaSlicer ha impiegato troppo tempo.")
+    finally:
+        if proc.returncode is None:
+            try:
+                proc.kill()
+            except ProcessLookupError:
+                pass
+            await proc.wait()
+        waiter.cancel()
+        await asyncio.gather(*readers, return_exceptions=True)
+
+    if proc.returncode != 0:
+        msg = "\n".join(err_tail) or "\n".join(out_tail) or "Errore sconosciuto"
+        raise HTTPException(500, f"Errore PrusaSlicer: {msg[:600]}")
+
+    return args, applied_overrides
+
+
+# ---------- Cache slicing (content-addressed) ----------
+# Cambiare solo colore/prezzo della bobina non cambia il G-code: l'output dello
+# slicer e le metriche lette dal G-code vengono salvati su disco con chiave
+# SHA-256(modello + bundle profili + righe di override) e riusati.
+SLICE_CACHE_DIR = os.getenv("SLICE_CACHE_DIR") or os.path.join(tempfile.gettempdir(), "slicer-api-cache")
+SLICE_CACHE_MAX_BYTES = _env_int("SLICE_CACHE_MAX_BYTES", 5 * 1024 ** 3)
+SLICE_CACHE_MAX_ENTRIES = _env_int("SLICE_CACHE_MAX_ENTRIES", 500)
+_SLICE_CACHE_VERSION = 1
+_SLICE_CACHE_LOCK = threading.Lock()
+_FILE_HASHES: dict[tuple[str, int, int], str] = {}
+_FILE_HASHES_MAX = 1024
+
+
+def _sha256_file(path: str) -> str:
+    st = os.stat(path)
+    memo_key = (os.path.abspath(path), st.st_size, st.st_mtime_ns)
+    cached = _FILE_HASHES.get(memo_key)
+    if cached:
+        return cached
+    digest = hashlib.sha256()
+    with open(path, "rb") as handle:
+        for chunk in iter(lambda: handle.read(1 << 20), b""):
+            digest.update(chunk)
+    value = digest.hexdigest()
+    if len(_FILE_HASHES) >= _FILE_HASHES_MAX:
+        _FILE_HASHES.clear()
+    _FILE_HASHES[memo_key] = value
+    return value
+
+
+def _remember_file_hash(path: str, value: str) -> None:
+    # hash già calcolato durante l'upload: lo slicing non rilegge il file
+    st = os.stat(path)
+    if len(_FILE_HASHES) >= _FILE_HASHES_MAX:
+        _FILE_HASHES.clear()
+    _FILE_HASHES[(os.path.abspath(path), st.st_size, st.st_mtime_ns)] = value
+
+
+def _slice_cache_key(model_path: str, bundle_path: str, override_lines: list[str]) -> str:
+    digest = hashlib.sha256()
+    digest.update(f"v{_SLICE_CACHE_VERSION}\n".encode())
+    try:
+        digest.update(" ".join(_resolve_prusaslicer_cmd()).encode())
+    except FileNotFoundError:
+        pass
+    digest.update(b"\nmodel:" + _sha256_file(model_path).encode())
+    digest.update(b"\nprofiles:" + _sha256_file(bundle_path).encode())
+    for line in sorted(" ".join(line.split()) for line in override_lines):
+        digest.update(b"\nset:" + line.encode("utf-8"))
+    return digest.hexdigest()
+
+
+def _slice_cache_entry_dir(key: str) -> str:
+    return os.path.join(SLICE_CACHE_DIR, key)
+
+
+def _slice_cache_load(key: str) -> dict | None:
+    if SLICE_CACHE_MAX_ENTRIES <= 0:
+        return None
+    entry_dir = _slice_cache_entry_dir(key)
+    meta_path = os.path.join(entry_dir, "meta.json")
+    gcode_path = os.path.join(entry_dir, "out.gcode")
+    try:
+        with open(meta_path, "r", encoding="utf-8") as handle:
+            meta = json.load(handle)
+        if not os.path.isfile(gcode_path):
+            return None
+        os.utime(meta_path)  # LRU: l'mtime di meta.json è l'ultimo accesso
+    except Exception:
+        return None
+    meta["gcode_path"] = gcode_path
+    return meta
+
+
+def _slice_cache_store(key: str, gcode_src: str, meta: dict) -> str:
+    entry_dir = _slice_cache_entry_dir(key)
+    gcode_path = os.path.join(entry_dir, "out.gcode")
+    if SLICE_CACHE_MAX_ENTRIES <= 0:
+        return gcode_src
+    try:
+        os.makedirs(SLICE_CACHE_DIR, exist_ok=True)
+        tmp_dir = tempfile.mkdtemp(prefix=f".{key[:16]}-", dir=SLICE_CACHE_DIR)
+        shutil.move(gcode_src, os.path.join(tmp_dir, "out.gcode"))
+        with open(os.path.join(tmp_dir, "meta.json"), "w", encoding="utf-8") as handle:
+            json.dump(meta, handle)
+        try:
+            os.rename(tmp_dir, entry_dir)
+        except OSError:
+            # un'altra richiesta ha già popolato la stessa chiave
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+    except Exception as exc:
+        _LOG.warning("Cache slicing non scrivibile (%s): %s", SLICE_CACHE_DIR, exc)
+        return gcode_src if os.path.exists(gcode_src) else gcode_path
+    _slice_cache_evict()
+    return gcode_path
+
+
+def _slice_cache_evict() -> None:
+    with _SLICE_CACHE_LOCK:
+        entries: list[tuple[float, int, str]] = []
+        total = 0
+        try:
+            names = os.listdir(SLICE_CACHE_DIR)
+        except FileNotFoundError:
+            return
+        for name in names:
+            entry_dir = os.path.join(SLICE_CACHE_DIR, name)
+            meta_path = os.path.join(entry_dir, "meta.json")
+            if name.startswith(".") or not os.path.isfile(meta_path):
+                continue
+            size = 0
+            try:
+                for child in os.scandir(entry_dir):
+                    size += child.stat().st_size
+                last_used = os.path.getmtime(meta_path)
+            except OSError:
+                continue
+            entries.append((last_used, size, entry_dir))
+            total += size
+        entries.sort()
+        while entries and (total > SLICE_CACHE_MAX_BYTES or len(entries) > SLICE_CACHE_MAX_ENTRIES):
+            _, size, entry_dir = entries.pop(0)
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            total -= size
+
+
+def _parse_slice_metrics(gcode: str) -> dict:
+    """Metriche del G-code indipendenti dal materiale (riusabili dalla cache)."""
+    grams_comment, mm_comment, vol_comment = _parse_filament_usage_from_comments(gcode)
+    time_s = None
+    mt = _TIME_PAT.search(gcode)
+    if mt:
+        time_s = _parse_time_to_seconds(mt.group(1))
+    fallback_mm = None
+    if mm_comment is None:
+        fallback_mm = _estimate_filament_length_from_gcode_text(gcode)
+    return {
+        "preset_ids": _parse_preset_ids_from_gcode(gcode),
+        "filament_g_comment": grams_comment,
+        "filament_mm_comment": mm_comment,
+        "filament_volume_mm3_comment": vol_comment,
+        "filament_mm_fallback": fallback_mm,
+        "time_s": time_s,
+    }
+
+
+def _begin_slice_run(
+    model_path: str,
+    profiles: dict[str, dict[str, object]],
+    override_settings: dict | None,
+    temp_dir: str,
+) -> dict:
+    set_args, _ = _build_override_set_args(override_settings)
+    bundle_path = _build_profile_bundle(profiles, temp_dir)
+    cache_key = _slice_cache_key(model_path, bundle_path, _override_config_lines(profiles, set_args))
+    cached = _slice_cache_load(cache_key)
+    if cached is not None:
+        cached["cache"] = {"key": cache_key, "hit": True}
+    out_path = _build_gcode_output_path(
+        temp_dir,
+        model_path,
+        profiles["print"].get("requested"),
+        profiles["filament"].get("requested"),
+        profiles["printer"].get("requested"),
+    )
+    return {"cache_key": cache_key, "cached": cached, "bundle_path": bundle_path, "out_path": out_path}
+
+
+def _finish_slice_run(run: dict, executed_cmd: list[str], applied_overrides: dict[str, float]) -> dict:
+    out_path = run["out_path"]
+    if not os.path.exists(out_path):
+        raise HTTPException(500, "G-code non generato.")
+
+    with open(out_path, "r", encoding="utf-8", errors="ignore") as f:
+        metrics = _parse_slice_metrics(f.read())
+
+    entry = {
+        "metrics": metrics,
+        "prusaslicer_cmd": executed_cmd,
+        "override_settings": applied_overrides,
+    }
+    entry["gcode_path"] = _slice_cache_store(run["cache_key"], out_path, entry)
+    entry["cache"] = {"key": run["cache_key"], "hit": False}
+    return entry
+
+
+def _run_prusaslicer(
+    model_path: str,
+    profiles: dict[str, dict[str, object]],
+    *,
+    override_settings: dict | None = None,
+) -> dict:
+    with tempfile.TemporaryDirectory() as td:
+        run = _begin_slice_run(model_path, profiles, override_settings, td)
+        if run["cached"] is not None:
+            return run["cached"]
         executed_cmd, applied_overrides = _invoke_prusaslicer(
             model_path,
-            out_path,
+            run["out_path"],
             profiles,
             override_settings=override_settings,
-            profile_bundle=bundle_path,
+            profile_bundle=run["bundle_path"],
         )
+        return _finish_slice_run(run, executed_cmd, applied_overrides)
 
-        if not os.path.exists(out_path):
-            raise HTTPException(500, "G-code non generato.")
 
-        with open(out_path, "r", encoding="utf-8", errors="ignore") as f:
-            return f.read(), executed_cmd, applied_overrides
+async def _run_prusaslicer_async(
+    model_path: str,
+    profiles: dict[str, dict[str, object]],
+    *,
+    override_settings: dict | None = None,
+    request: Request | None = None,
+) -> dict:
+    with tempfile.TemporaryDirectory() as td:
+        # hash del modello e parsing del G-code sono CPU/IO: fuori dall'event loop
+        run = await asyncio.to_thread(_begin_slice_run, model_path, profiles, override_settings, td)
+        if run["cached"] is not None:
+            return run["cached"]
+        executed_cmd, applied_overrides = await _invoke_prusaslicer_async(
+            model_path,
+            run["out_path"],
+            profiles,
+            override_settings=override_settings,
+            profile_bundle=run["bundle_path"],
+            request=request,
+        )
+        return await asyncio.to_thread(_finish_slice_run, run, executed_cmd, applied_overrides)
+
 
 def _resolve_model_path(viewer_url: str | None) -> str | None:
     if not viewer_url:
@@ -1376,7 +2448,10 @@ def _resolve_model_path(viewer_url: str | None) -> str | None:
         return None
     file_name = m.group(1)
     path = os.path.join(WEB_DIR, "uploads", file_name)
-    return path if os.path.isfile(path) else None
+    if not os.path.isfile(path):
+        return None
+    _touch_upload(path)
+    return path
 
 
 def _estimate_print_job(
@@ -1389,53 +2464,73 @@ def _estimate_print_job(
     rate: float | None,
     override_settings: dict | None = None,
 ) -> dict:
-    gcode, prusaslicer_cmd, applied_overrides = _run_prusaslicer(
+    sliced = _run_prusaslicer(
         model_path,
         profiles,
         override_settings=override_settings,
     )
+    return _estimate_from_slice(
+        sliced,
+        profiles,
+        material=material,
+        diameter=diameter,
+        price_per_kg=price_per_kg,
+        rate=rate,
+    )
 
-    preset_ids = _parse_preset_ids_from_gcode(gcode)
-    filament_g = None
-    filament_mm = None
-    time_s = None
 
-    grams_comment, mm_comment, vol_comment = _parse_filament_usage_from_comments(gcode)
-    if grams_comment is not None:
-        filament_g = grams_comment
-    if mm_comment is not None:
-        filament_mm = mm_comment
+def _estimate_costs(filament_g, time_s, price_per_kg, rate):
+    """Restituisce ``(tariffa oraria, costo materiale, costo macchina, totale)``."""
+    eff_rate = rate if rate is not None else HOURLY_RATE
+    mat_cost = None
+    if price_per_kg is not None and filament_g is not None:
+        mat_cost = price_per_kg * (filament_g / 1000.0)
+
+    mach_cost = None
+    if eff_rate is not None and time_s is not None:
+        mach_cost = eff_rate * (time_s / 3600.0)
+
+    total_cost = None
+    if mat_cost is not None and mach_cost is not None:
+        total_cost = mat_cost + mach_cost
+    return eff_rate, mat_cost, mach_cost, total_cost
+
+
+def _estimate_from_slice(
+    sliced: dict,
+    profiles: dict[str, dict[str, object]],
+    *,
+    material: str | None,
+    diameter: str | float | None,
+    price_per_kg: float | None,
+    rate: float | None,
+) -> dict:
+    metrics = sliced["metrics"]
+    prusaslicer_cmd = sliced["prusaslicer_cmd"]
+    applied_overrides = sliced["override_settings"]
+
+    preset_ids = metrics.get("preset_ids") or {}
+    filament_g = metrics.get("filament_g_comment")
+    filament_mm = metrics.get("filament_mm_comment")
+    time_s = metrics.get("time_s")
+
+    vol_comment = metrics.get("filament_volume_mm3_comment")
     if filament_g is None and vol_comment is not None:
         filament_g = _grams_from_volume_mm3(vol_comment, material)
 
-    mt = _TIME_PAT.search(gcode)
-    if mt:
-        time_s = _parse_time_to_seconds(mt.group(1))
-
     if filament_g is None and filament_mm is not None:
         diam_val = _to_float(diameter, 1.75) or 1.75
         filament_g = _grams_from_mm(filament_mm, diam_val, material)
 
     if filament_mm is None or filament_g is None:
-        fallback_mm = _estimate_filament_length_from_gcode_text(gcode)
+        fallback_mm = metrics.get("filament_mm_fallback") or 0.0
         if fallback_mm > 0 and filament_mm is None:
             filament_mm = fallback_mm
         if filament_g is None and filament_mm is not None:
             diam_val = _to_float(diameter, 1.75) or 1.75
             filament_g = _grams_from_mm(filament_mm, diam_val, material)
 
-    eff_rate = rate if rate is not None else HOURLY_RATE
-    mat_cost = None
-    if price_per_kg is not None and filament_g is not None:
-        mat_cost = price_per_kg * (filament_g / 1000.0)
-
-    mach_cost = None
-    if eff_rate is not None and time_s is not None:
-        mach_cost = eff_rate * (time_s / 3600.0)
-
-    total_cost = None
-    if mat_cost is not None and mach_cost is not None:
-        total_cost = mat_cost + mach_cost
+    eff_rate, mat_cost, mach_cost, total_cost = _estimate_costs(filament_g, time_s, price_per_kg, rate)
 
     def _profile_summary(kind: str) -> dict[str, object]:
         info = profiles[kind]
@@ -1517,7 +2612,7 @@ def _estimate_print_job(
         )
 
     return {
-        "gcode": gcode,
+        "estimate_id": _remember_estimate(filament_g, filament_mm, time_s, material, price_per_kg, rate),
         "filament_g": filament_g,
         "filament_mm": filament_mm,
         "time_s": time_s,
@@ -1539,10 +2634,12 @@ def _estimate_print_job(
         "presets_used": presets_used,
         "prusaslicer_cmd": prusaslicer_cmd,
         "override_settings": applied_overrides or None,
+        "slice_cache": sliced.get("cache"),
     }
 
 @app.post("/api/estimate")
 async def api_estimate(
+    request: Request,
     model: UploadFile | None = File(default=None),
     viewer_url: str | None = Form(default=None),
     model_url: str | None = Form(default=None),  # alias
@@ -1564,8 +2661,11 @@ async def api_estimate(
             raise HTTPException(400, f"Estensione non supportata: {ext}")
         td = tempfile.mkdtemp(prefix="model-")
         tmp_path = os.path.join(td, os.path.basename(model.filename or "model") or "model")  # nosec
-        with open(tmp_path, "wb") as f:
-            f.write(await model.read())
+        try:
+            await _save_upload(model, tmp_path)
+        except BaseException:
+            shutil.rmtree(td, ignore_errors=True)
+            raise
         model_path = tmp_path
     else:
         model_path = _resolve_model_path(viewer_url) or _resolve_model_path(model_url)
@@ -1575,14 +2675,20 @@ async def api_estimate(
     profiles = _resolve_profiles(preset_print, preset_filament, preset_printer)
 
     try:
-        result = _estimate_print_job(
-            model_path,
+        async with _SLICE_SLOTS:
+            sliced = await _run_prusaslicer_async(
+                model_path,
+                profiles,
+                override_settings=None,
+                request=request,
+            )
+        result = _estimate_from_slice(
+            sliced,
             profiles,
             material=material,
             diameter=diameter,
             price_per_kg=price_per_kg,
             rate=hourly_rate,
-            override_settings=None,
         )
     finally:
         if tmp_path:
@@ -1592,12 +2698,10 @@ async def api_estimate(
             except Exception:
                 pass
 
-    payload = dict(result)
-    payload.pop("gcode", None)
-    return _no_cache(payload)
+    return _no_cache(dict(result))
 
 
-async def _modern_estimate(payload: dict) -> JSONResponse:
+async def _prepare_modern_estimate(payload: dict) -> dict:
     if not isinstance(payload, dict):
         raise HTTPException(400, "Payload JSON non valido")
 
@@ -1641,19 +2745,36 @@ async def _modern_estimate(payload: dict) -> JSONResponse:
 
     settings = payload.get("settings") if isinstance(payload.get("settings"), dict) else {}
 
-    profiles = _resolve_profiles(preset_print, preset_filament, preset_printer)
+    return {
+        "model_path": model_path,
+        "profiles": _resolve_profiles(preset_print, preset_filament, preset_printer),
+        "material": material,
+        "diameter": diameter,
+        "price_per_kg": price_per_kg,
+        "hourly_rate": hourly_rate,
+        "settings": settings,
+        "inventory_context": inventory_context,
+    }
+
+
+def _run_modern_estimate(prepared: dict) -> dict:
     result = _estimate_print_job(
-        model_path,
-        profiles,
-        material=material,
-        diameter=diameter,
-        price_per_kg=price_per_kg,
-        rate=hourly_rate,
-        override_settings=settings,
+        prepared["model_path"],
+        prepared["profiles"],
+        material=prepared["material"],
+        diameter=prepared["diameter"],
+        price_per_kg=prepared["price_per_kg"],
+        rate=prepared["hourly_rate"],
+        override_settings=prepared["settings"],
     )
+    return _modern_estimate_response(prepared, result)
+
 
+def _modern_estimate_response(prepared: dict, result: dict) -> dict:
+    profiles = prepared["profiles"]
+    settings = prepared["settings"]
+    inventory_context = prepared["inventory_context"]
     response = dict(result)
-    response.pop("gcode", None)
 
     debug_payload: dict[str, object] = {
         "presets": {
@@ -1672,6 +2793,12 @@ async def _modern_estimate(payload: dict) -> JSONResponse:
     if debug_payload:
         response["debug"] = debug_payload
 
+    return response
+
+
+async def _modern_estimate(payload: dict) -> JSONResponse:
+    prepared = await _prepare_modern_estimate(payload)
+    response = await _run_in_slice_slot(_run_modern_estimate, prepared)
     return _no_cache(response)
 
 
@@ -1702,33 +2829,451 @@ async def modern_slice_estimate_info():
         }
     )
 
+# ---------- Ricalcolo costi ----------
+# Cambiare solo bobina (prezzo/materiale) o tariffa oraria non richiede un
+# nuovo slicing: ogni stima registra le metriche (grammi, mm, tempo) sotto un
+# estimate_id e POST /slice/recost ricalcola i costi da quelle. Tra materiali
+# diversi il volume estruso è lo stesso, quindi i grammi si correggono solo
+# col rapporto delle densità.
+ESTIMATE_STORE_MAX = max(1, _env_int("ESTIMATE_STORE_MAX", 2000))
+_ESTIMATES: OrderedDict[str, dict] = OrderedDict()
+_ESTIMATES_LOCK = threading.Lock()
+
+
+def _remember_estimate(filament_g, filament_mm, time_s, material, price_per_kg, rate) -> str:
+    estimate_id = uuid.uuid4().hex
+    entry = {
+        "filament_g": filament_g,
+        "filament_mm": filament_mm,
+        "time_s": time_s,
+        "material": material,
+        "price_per_kg": price_per_kg,
+        "rate": rate,
+    }
+    with _ESTIMATES_LOCK:
+        _ESTIMATES[estimate_id] = entry
+        while len(_ESTIMATES) > ESTIMATE_STORE_MAX:
+            _ESTIMATES.popitem(last=False)
+    return estimate_id
+
+
+def _lookup_estimate(estimate_id) -> dict:
+    with _ESTIMATES_LOCK:
+        entry = _ESTIMATES.get(str(estimate_id or ""))
+        if entry is not None:
+            _ESTIMATES.move_to_end(str(estimate_id))
+    if entry is None:
+        raise HTTPException(404, "estimate_id sconosciuto o scaduto: ripeti la stima")
+    return entry
+
+
+@app.post("/slice/recost")
+@app.post("/api/slice/recost")
+async def slice_recost(payload: dict = Body(...)):
+    """Ricalcola i costi di una stima precedente con un'altra bobina o tariffa.
+
+    Payload: ``estimate_id`` più uno o più tra ``inventory_key``, ``material``,
+    ``price_per_kg`` e ``hourly_rate``; quelli assenti restano come nella stima.
+    """
+    if not isinstance(payload, dict):
+        raise HTTPException(400, "Payload JSON non valido")
+    entry = _lookup_estimate(payload.get("estimate_id"))
+
+    inventory_key = payload.get("inventory_key")
+    inventory_context = await _resolve_inventory_context(str(inventory_key)) if inventory_key else {}
+    material = payload.get("material") or inventory_context.get("material") or entry["material"]
+    price_per_kg = payload.get("price_per_kg")
+    if price_per_kg is None:
+        price_per_kg = inventory_context.get("price_per_kg", entry["price_per_kg"])
+    price_per_kg = _to_float(price_per_kg, None)
+    hourly_rate = _to_float(payload.get("hourly_rate"), entry["rate"])
+
+    filament_g = entry["filament_g"]
+    if filament_g is not None and material != entry["material"]:
+        filament_g = filament_g * _density_guess(material) / _density_guess(entry["material"])
+
+    eff_rate, mat_cost, mach_cost, total_cost = _estimate_costs(
+        filament_g, entry["time_s"], price_per_kg, hourly_rate
+    )
+    return _no_cache(
+        {
+            "estimate_id": payload.get("estimate_id"),
+            "material": material,
+            "filament_g": filament_g,
+            "filament_mm": entry["filament_mm"],
+            "time_s": entry["time_s"],
+            "price_per_kg": price_per_kg,
+            "hourly_rate": eff_rate,
+            "cost_material": mat_cost,
+            "cost_machine": mach_cost,
+            "cost_total": total_cost,
+            "currency": CURRENCY,
+        }
+    )
+
+# ---------- Job di slicing ----------
+# PrusaSlicer gira in un thread (asyncio.to_thread) per non bloccare l'event loop;
+# il numero di processi contemporanei è limitato da SLICE_WORKERS (default: core).
+# POST /slice/jobs accoda una stima e risponde subito con l'id del job.
+SLICE_WORKERS = max(1, _env_int("SLICE_WORKERS", os.cpu_count() or 2))
+SLICE_JOBS_MAX = max(1, _env_int("SLICE_JOBS_MAX", 500))
+# job in coda o in esecuzione oltre i quali POST /slice/jobs risponde 429
+SLICE_QUEUE_MAX = max(SLICE_WORKERS, _env_int("SLICE_QUEUE_MAX", 64))
+_SLICE_SLOTS = asyncio.Semaphore(SLICE_WORKERS)
+_SLICE_JOBS: dict[str, dict] = {}
+_JOB_FINAL_STATES = {"done", "error"}
+
+
+async def _run_in_slice_slot(fn, *args, **kwargs):
+    async with _SLICE_SLOTS:
+        return await asyncio.to_thread(fn, *args, **kwargs)
+
+
+def _job_public(job: dict) -> dict:
+    return {k: v for k, v in job.items() if not k.startswith("_")}
+
+
+def _job_update(job: dict, **changes) -> None:
+    job.update(changes)
+    job["updated_at"] = time.time()
+    changed = job["_changed"]
+    job["_changed"] = asyncio.Event()
+    changed.set()
+
+
+def _trim_slice_jobs() -> None:
+    if len(_SLICE_JOBS) <= SLICE_JOBS_MAX:
+        return
+    finished = [job_id for job_id, job in _SLICE_JOBS.items() if job["status"] in _JOB_FINAL_STATES]
+    for job_id in finished[: len(_SLICE_JOBS) - SLICE_JOBS_MAX]:
+        _SLICE_JOBS.pop(job_id, None)
+
+
+async def _execute_slice_job(job: dict, fn, *args) -> None:
+    try:
+        async with _SLICE_SLOTS:
+            _job_update(job, status="running", started_at=time.time())
+            result = await asyncio.to_thread(fn, *args)
+        _job_update(job, status="done", finished_at=time.time(), result=result)
+    except HTTPException as exc:
+        _job_update(
+            job,
+            status="error",
+            finished_at=time.time(),
+            error={"status_code": exc.status_code, "detail": exc.detail},
+        )
+    except Exception as exc:
+        _LOG.exception("Job di slicing %s fallito", job["id"])
+        _job_update(
+            job,
+            status="error",
+            finished_at=time.time(),
+            error={"status_code": 500, "detail": f"{type(exc).__name__}: {exc}"},
+        )
+
+
+def _check_slice_queue() -> None:
+    pending = sum(1 for job in _SLICE_JOBS.values() if job["status"] not in _JOB_FINAL_STATES)
+    if pending >= SLICE_QUEUE_MAX:
+        raise HTTPException(
+            429,
+            f"Coda di slicing piena ({pending} job in attesa o in corso): riprova più tardi.",
+            headers={"Retry-After": "30"},
+        )
+
+
+def _submit_slice_job(kind: str, fn, *args) -> dict:
+    _check_slice_queue()
+    now = time.time()
+    job = {
+        "id": uuid.uuid4().hex,
+        "kind": kind,
+        "status": "queued",
+        "created_at": now,
+        "updated_at": now,
+        "started_at": None,
+        "finished_at": None,
+        "result": None,
+        "error": None,
+        "_changed": asyncio.Event(),
+    }
+    _SLICE_JOBS[job["id"]] = job
+    _trim_slice_jobs()
+    job["_task"] = asyncio.create_task(_execute_slice_job(job, fn, *args))
+    return job
+
+
+def _get_slice_job(job_id: str) -> dict:
+    job = _SLICE_JOBS.get(job_id)
+    if job is None:
+        raise HTTPException(404, "Job non trovato")
+    return job
+
+
+@app.post("/slice/jobs", status_code=202)
+@app.post("/api/slice/jobs", status_code=202)
+async def create_slice_job(payload: dict = Body(...)):
+    _check_slice_queue()
+    prepared = await _prepare_modern_estimate(payload)
+    job = _submit_slice_job("estimate", _run_modern_estimate, prepared)
+    return JSONResponse(
+        {
+            "job_id": job["id"],
+            "status": job["status"],
+            "status_url": f"/slice/jobs/{job['id']}",
+            "events_url": f"/slice/jobs/{job['id']}/events",
+        },
+        status_code=202,
+        headers={"Cache-Control": "no-store, no-cache, must-revalidate, max-age=0"},
+    )
+
+
+@app.get("/slice/jobs/{job_id}")
+@app.get("/api/slice/jobs/{job_id}")
+async def slice_job_status(job_id: str):
+    return _no_cache(_job_public(_get_slice_job(job_id)))
+
+
+@app.get("/slice/jobs/{job_id}/events")
+@app.get("/api/slice/jobs/{job_id}/events")
+async def slice_job_events(job_id: str):
+    job = _get_slice_job(job_id)
+
+    async def _stream():
+        while True:
+            changed = job["_changed"]
+            state = _job_public(job)
+            yield f"event: {state['status']}\ndata: {json.dumps(state)}\n\n"
+            if state["status"] in _JOB_FINAL_STATES:
+                return
+            while not changed.is_set():
+                try:
+                    await asyncio.wait_for(changed.wait(), timeout=15.0)
+                except asyncio.TimeoutError:
+                    yield ": keep-alive\n\n"
+
+    return StreamingResponse(
+        _stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-store", "X-Accel-Buffering": "no"},
+    )
+
+
+# ---------- Confronto preset (sweep) ----------
+# Una sola richiesta stima lo stesso modello con tutti i profili di stampa di
+# _PRINT_PRESET_FILES: i preset girano in parallelo negli slot di SLICE_WORKERS
+# e ogni risultato viene inviato (server-sent events) appena è pronto, così la
+# tabella di confronto si riempie nel tempo di uno slicing invece che di sette.
+def _sweep_print_presets(requested) -> list[str]:
+    presets = list(dict.fromkeys(_PRINT_PRESET_FILES.values()))
+    if not requested:
+        return presets
+    if not isinstance(requested, list):
+        raise HTTPException(400, "presets deve essere una lista")
+    selected: list[str] = []
+    for name in requested:
+        filename = _PRINT_PRESET_FILES.get(_normalize_preset_key(str(name)))
+        if filename is None:
+            raise HTTPException(400, f"Preset di stampa sconosciuto: {name}")
+        if filename not in selected:
+            selected.append(filename)
+    return selected
+
+
+async def _sweep_one(prepared: dict, preset: str, request: Request) -> dict:
+    profiles = _resolve_profiles(
+        preset,
+        prepared["profiles"]["filament"].get("requested"),
+        prepared["profiles"]["printer"].get("requested"),
+    )
+    try:
+        # processo asincrono (non un thread): se il client si disconnette o il
+        # task viene annullato PrusaSlicer viene terminato prima di liberare lo slot
+        async with _SLICE_SLOTS:
+            sliced = await _run_prusaslicer_async(
+                prepared["model_path"],
+                profiles,
+                override_settings=prepared["settings"],
+                request=request,
+            )
+        estimate = _estimate_from_slice(
+            sliced,
+            profiles,
+            material=prepared["material"],
+            diameter=prepared["diameter"],
+            price_per_kg=prepared["price_per_kg"],
+            rate=prepared["hourly_rate"],
+        )
+        result = _modern_estimate_response(dict(prepared, profiles=profiles), estimate)
+        return {"preset": preset, "status": "done", "result": result}
+    except HTTPException as exc:
+        return {"preset": preset, "status": "error", "error": {"status_code": exc.status_code, "detail": exc.detail}}
+    except Exception as exc:
+        _LOG.exception("Sweep preset %s fallito", preset)
+        return {
+            "preset": preset,
+            "status": "error",
+            "error": {"status_code": 500, "detail": f"{type(exc).__name__}: {exc}"},
+        }
+
+
+def _sweep_row(item: dict) -> dict:
+    result = item.get("result") or {}
+    return {
+        "preset": item["preset"],
+        "status": item["status"],
+        "time_s": result.get("time_s"),
+        "filament_g": result.get("filament_g"),
+        "cost_total": result.get("cost_total"),
+    }
+
+
+@app.post("/slice/sweep")
+@app.post("/api/slice/sweep")
+async def slice_sweep(request: Request, payload: dict = Body(...)):
+    """Stima con tutti i preset di stampa (o quelli in ``presets``), in streaming SSE.
+
+    Eventi: ``start`` (preset in coda), un ``result`` per preset nell'ordine in
+    cui finiscono, ``done`` con la tabella riassuntiva.
+    """
+    if not isinstance(payload, dict):
+        raise HTTPException(400, "Payload JSON non valido")
+    presets = _sweep_print_presets(payload.get("presets"))
+    prepared = await _prepare_modern_estimate(dict(payload, preset_print=presets[0]))
+
+    async def _stream():
+        tasks = [asyncio.create_task(_sweep_one(prepared, preset, request)) for preset in presets]
+        rows = []
+        try:
+            yield f"event: start\ndata: {json.dumps({'presets': presets})}\n\n"
+            for next_done in asyncio.as_completed(tasks):
+                item = await next_done
+                rows.append(_sweep_row(item))
+                yield f"event: result\ndata: {json.dumps(item)}\n\n"
+            rows.sort(key=lambda row: presets.index(row["preset"]))
+            yield f"event: done\ndata: {json.dumps({'rows': rows})}\n\n"
+        finally:
+            # client disconnesso: i preset in corso terminano PrusaSlicer, quelli
+            # non ancora partiti non occupano slot
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    return StreamingResponse(
+        _stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-store", "X-Accel-Buffering": "no"},
+    )
+
+
 # ---------- Slice (esporta gcode) ----------
+GCODE_STREAM_CHUNK = 1 << 20
+GCODE_COMPRESS_MIN_BYTES = _env_int("GCODE_COMPRESS_MIN_BYTES", 64 * 1024)
+
+try:  # zstd è opzionale: senza il pacchetto si offre solo gzip
+    import zstandard as _zstd
+except ImportError:
+    _zstd = None
+
+
+def _pick_gcode_encoding(accept_encoding: str | None) -> str | None:
+    offered: set[str] = set()
+    for part in (accept_encoding or "").split(","):
+        name, _, params = part.strip().partition(";")
+        name = name.strip().lower()
+        q = params.strip()
+        if q.startswith("q="):
+            try:
+                if float(q[2:]) <= 0:
+                    continue
+            except ValueError:
+                continue
+        if name:
+            offered.add(name)
+    if _zstd is not None and "zstd" in offered:
+        return "zstd"
+    if "gzip" in offered:
+        return "gzip"
+    return None
+
+
+def _iter_compressed_file(path: str, encoding: str):
+    if encoding == "zstd":
+        compressor = _zstd.ZstdCompressor(level=3).compressobj()
+    else:
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits 31 = container gzip
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(GCODE_STREAM_CHUNK)
+            if not chunk:
+                break
+            data = compressor.compress(chunk)
+            if data:
+                yield data
+    tail = compressor.flush()
+    if tail:
+        yield tail
+
+
+def _gcode_file_response(path: str, request: Request, *, cleanup_dir: str | None = None):
+    """Risposta in streaming per un G-code su disco.
+
+    Senza compressione passa da FileResponse (Content-Length e Range inclusi);
+    con gzip/zstd il corpo viene compresso a blocchi, senza mai tenere il file
+    intero in memoria.
+    """
+    background = BackgroundTask(shutil.rmtree, cleanup_dir, ignore_errors=True) if cleanup_dir else None
+    headers = {"Vary": "Accept-Encoding"}
+    encoding = None
+    if "range" not in request.headers and os.path.getsize(path) >= GCODE_COMPRESS_MIN_BYTES:
+        encoding = _pick_gcode_encoding(request.headers.get("accept-encoding"))
+    if encoding is None:
+        # Range solo sul file così com'è: il corpo compresso non è indirizzabile a byte
+        return FileResponse(
+            path,
+            media_type="text/plain; charset=utf-8",
+            headers={**headers, "Accept-Ranges": "bytes"},
+            background=background,
+        )
+    headers["Content-Encoding"] = encoding
+    return StreamingResponse(
+        _iter_compressed_file(path, encoding),
+        media_type="text/plain; charset=utf-8",
+        headers=headers,
+        background=background,
+    )
+
+
 @app.post("/api/slice", response_class=PlainTextResponse)
 async def slice_model(
+    request: Request,
     model: UploadFile = File(...),
     preset_print: str | None = Form(None),
     preset_filament: str | None = Form(None),
     preset_printer: str | None = Form(None),
 ):
-    with tempfile.TemporaryDirectory() as td:
-        in_path = os.path.join(td, model.filename)
-        with open(in_path, "wb") as f:
-            f.write(await model.read())
+    # la directory temporanea vive fino alla fine dello streaming della risposta
+    td = tempfile.mkdtemp(prefix="slice-")
+    try:
+        in_path = os.path.join(td, os.path.basename(model.filename or "model") or "model")
+        await _save_upload(model, in_path)
         out_path = os.path.join(td, "out.gcode")
         profiles = _resolve_profiles(preset_print, preset_filament, preset_printer)
         bundle_path = _build_profile_bundle(profiles, td)
-        _invoke_prusaslicer(
-            in_path,
-            out_path,
-            profiles,
-            override_settings=None,
-            profile_bundle=bundle_path,
-        )
+        async with _SLICE_SLOTS:
+            await _invoke_prusaslicer_async(
+                in_path,
+                out_path,
+                profiles,
+                override_settings=None,
+                profile_bundle=bundle_path,
+                request=request,
+            )
 
         if not os.path.exists(out_path):
             raise HTTPException(500, "G-code non generato.")
 
-        with open(out_path, "r", encoding="utf-8", errors="ignore") as f:
-            gcode = f.read()
-
-        return PlainTextResponse(gcode)
+        return _gcode_file_response(out_path, request, cleanup_dir=td)
+    except BaseException:
+        shutil.rmtree(td, ignore_errors=True)
+        raise
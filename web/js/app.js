@@ -95,12 +95,43 @@ async function uploadFileOrBlob(file) {
       throw new Error('Risposta non valida dal server');
     }
     await showViewer(data.viewer_url, data.filename);
+    followConversion(data.conversion, data.filename);
   } catch (error) {
     alert(error.message || 'Upload fallito');
     resetViewer();
   }
 }
 
+const CONVERSION_POLL_MS = 1500;
+const CONVERSION_MAX_POLLS = 240;
+
+// L'upload risponde subito con il file originale; se il server sta convertendo
+// il modello in STL, a conversione finita il viewer passa allo STL.
+async function followConversion(conversion, filename) {
+  if (!conversion || !conversion.status_url) return;
+  if (conversion.status === 'done' || conversion.status === 'error') return;
+  const originalUrl = state.currentViewerUrl;
+  for (let attempt = 0; attempt < CONVERSION_MAX_POLLS; attempt += 1) {
+    await new Promise((resolve) => setTimeout(resolve, CONVERSION_POLL_MS));
+    if (state.currentViewerUrl !== originalUrl) return;
+    let job;
+    try {
+      const response = await apiFetch(conversion.status_url);
+      if (!response.ok) return;
+      job = await parseJson(response);
+    } catch (error) {
+      return;
+    }
+    if (job.status === 'done' && job.viewer_url) {
+      if (state.currentViewerUrl === originalUrl) {
+        await showViewer(job.viewer_url, filename);
+      }
+      return;
+    }
+    if (job.status === 'error') return;
+  }
+}
+
 async function handleFetchFromUrl() {
   if (!urlInput) return;
   const url = urlInput.value.trim();
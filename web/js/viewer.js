@@ -14,9 +14,11 @@ import { OrbitControls } from 'three/addons/controls/OrbitControls.js';
 import { STLLoader } from 'three/addons/loaders/STLLoader.js';
 import { OBJLoader } from 'three/addons/loaders/OBJLoader.js';
 import { ThreeMFLoader } from 'three/addons/loaders/3MFLoader.js';
+import { GLTFLoader } from 'three/addons/loaders/GLTFLoader.js';
 
 import { state, setCurrentViewer, resetViewerState } from './state.js';
 import { hexNorm } from './utils/colors.js';
+import { buildApiUrl } from './utils/api.js';
 
 let activeRenderer = null;
 let activeControls = null;
@@ -88,7 +90,7 @@ export async function showViewer(path, name) {
   activeScene = scene;
 
   try {
-    const rawObject = await loadModel(loader, path, ext);
+    const rawObject = (await loadPreview(path, ext)) || (await loadModel(loader, path, ext));
     const materialInfo = getSelectedMaterial();
     const preparedObject = applyMaterial(rawObject, materialInfo.color, materialInfo.transparent);
     scene.add(preparedObject);
@@ -167,6 +169,20 @@ function loadModel(loader, path, ext) {
   });
 }
 
+// Anteprima decimata (GLB quantizzato) preparata dal backend: per le mesh
+// pesanti evita di scaricare e parsare l'originale, che serve solo allo slicing.
+async function loadPreview(path, ext) {
+  if (ext !== 'stl' || !path.startsWith('/files/')) return null;
+  const url = buildApiUrl(`/model/preview?viewer_url=${encodeURIComponent(path.split('?')[0])}`);
+  try {
+    const gltf = await new GLTFLoader().loadAsync(url);
+    return gltf.scene;
+  } catch (error) {
+    console.warn('Anteprima non disponibile, carico il modello originale', error);
+    return null;
+  }
+}
+
 async function handleLoadError({ container, path, ext, renderer, scene, controls, camera }) {
   if (ext === '3mf') {
     try {